@@ -0,0 +1,114 @@
+#!/usr/bin/env python3
+"""Benchmark retrieval with reduced-precision embeddings against float32.
+
+Scores synthetic, clustered embeddings with the float32 embedding matrix,
+and with its float16 and int8 copies followed by rescoring the best chunks
+at full precision (`ask-embedding-precision`). Reports the size of the
+matrix that is scanned, the time to read it, the time per question and the
+recall of the top chunks found by scanning the float32 matrix.
+
+Usage: python benchmarks/embedding_precision.py [--dim 768] [--k 10]
+    [--rescore-factor 4] [--queries 50]
+"""
+
+import argparse
+import tempfile
+import time
+from pathlib import Path
+
+import numpy as np
+
+from papis_ask.store import QUANTIZED_PRECISIONS, EmbeddingMatrix, QuantizedMatrix
+from papis_ask.vectors import MemmapVectorStore
+
+LIBRARY_SIZES = (10000, 50000, 200000)
+CLUSTERS = 200
+
+
+def make_embeddings(n_chunks: int, dim: int, n_queries: int) -> tuple:
+    """Make clustered embeddings and questions close to some of them."""
+    rng = np.random.default_rng(0)
+    centers = rng.normal(size=(CLUSTERS, dim)).astype(np.float32)
+    embeddings = np.empty((n_chunks, dim), dtype=np.float32)
+    for start in range(0, n_chunks, 10000):
+        size = min(10000, n_chunks - start)
+        embeddings[start : start + size] = centers[
+            rng.integers(0, CLUSTERS, size)
+        ] + rng.normal(scale=0.7, size=(size, dim))
+    queries = embeddings[rng.integers(0, n_chunks, n_queries)] + rng.normal(
+        scale=0.5, size=(n_queries, dim)
+    ).astype(np.float32)
+    return embeddings, queries
+
+
+def read_time(*paths: Path) -> float:
+    start = time.perf_counter()
+    for path in paths:
+        if path.exists():
+            np.fromfile(path, dtype=np.uint8)
+    return time.perf_counter() - start
+
+
+def search(vector_store: MemmapVectorStore, queries: np.ndarray, k: int) -> tuple:
+    """Get the best rows for every question and the mean time per question."""
+    rows = np.arange(len(vector_store._matrix), dtype=np.int64)
+    start = time.perf_counter()
+    results = [vector_store._best(query, rows, k)[0] for query in queries]
+    return results, (time.perf_counter() - start) / len(queries)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--dim", type=int, default=768)
+    parser.add_argument("--k", type=int, default=10)
+    parser.add_argument("--rescore-factor", type=int, default=4)
+    parser.add_argument("--queries", type=int, default=50)
+    args = parser.parse_args()
+
+    print(
+        f"{'chunks':>7} {'precision':>9} {'scanned (MB)':>12} {'read (ms)':>9}"
+        f" {'query (ms)':>10} {'recall':>6}"
+    )
+    for n_chunks in LIBRARY_SIZES:
+        embeddings, queries = make_embeddings(n_chunks, args.dim, args.queries)
+        with tempfile.TemporaryDirectory() as tmp:
+            matrix = EmbeddingMatrix(Path(tmp) / "bench.embeddings", None)
+            matrix.append(embeddings)
+            del embeddings
+
+            vector_store = MemmapVectorStore()
+            vector_store._matrix = matrix.open()
+            exact, elapsed = search(vector_store, queries, args.k)
+            print(
+                f"{n_chunks:>7} {'float32':>9}"
+                f" {matrix.path.stat().st_size / 1024**2:>12.1f}"
+                f" {read_time(matrix.path) * 1000:>9.1f} {elapsed * 1000:>10.1f}"
+                f" {1:>6.3f}"
+            )
+
+            for precision in QUANTIZED_PRECISIONS:
+                quantized = QuantizedMatrix(
+                    Path(tmp) / f"bench.embeddings.{precision}", precision, None
+                )
+                quantized.update(vector_store._matrix)
+                vector_store._quantized = quantized.open()
+                vector_store._rescore_factor = args.rescore_factor
+                found, elapsed = search(vector_store, queries, args.k)
+                recall = np.mean(
+                    [len(np.intersect1d(a, b)) / len(a) for a, b in zip(exact, found)]
+                )
+                size = sum(
+                    path.stat().st_size
+                    for path in (quantized.path, quantized.scales_path)
+                    if path.exists()
+                )
+                print(
+                    f"{n_chunks:>7} {precision:>9} {size / 1024**2:>12.1f}"
+                    f" {read_time(quantized.path, quantized.scales_path) * 1000:>9.1f}"
+                    f" {elapsed * 1000:>10.1f} {recall:>6.3f}"
+                )
+                vector_store._quantized = None
+
+
+if __name__ == "__main__":
+    main()
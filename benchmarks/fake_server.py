@@ -0,0 +1,305 @@
+#!/usr/bin/env python3
+"""A local stand-in for the embedding, LLM and Semantic Scholar APIs.
+
+Serves the parts of the OpenAI API that papis-ask uses (`/v1/embeddings` and
+`/v1/chat/completions`, with and without streaming) and the Semantic Scholar
+paper lookups (`/graph/v1/paper/DOI:...` and `/graph/v1/paper/search/match`)
+for the documents of a synthetic library, each after a configurable latency.
+Embeddings are deterministic bags of hashed words, so that retrieval finds
+documents sharing words with the question.
+
+Usage: python benchmarks/fake_server.py [--port 8080] [--dim 256]
+    [--embedding-latency 0.05] [--llm-latency 0.5] [--s2-latency 0.1]
+    [--library DIR]
+"""
+
+import argparse
+import base64
+import hashlib
+import json
+import re
+import threading
+import time
+import zlib
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+from urllib.parse import parse_qs, unquote, urlparse
+
+import numpy as np
+import yaml
+
+CONTEXT_KEY_RE = re.compile(r"pqac-[0-9a-f]{8}")
+# paperqa's prompts show these keys as examples of how to cite
+EXAMPLE_CONTEXT_KEYS = {"pqac-d79ef6fa", "pqac-0f650d59"}
+
+
+def embed(text: str, dim: int) -> np.ndarray:
+    """Embed a text as the normalized counts of its hashed words."""
+    vector = np.zeros(dim, dtype=np.float32)
+    for word in re.findall(r"\w+", text.lower()):
+        vector[zlib.crc32(word.encode()) % dim] += 1
+    norm = np.linalg.norm(vector)
+    return vector / norm if norm else vector
+
+
+def to_semantic_scholar(doc: Dict[str, Any]) -> Dict[str, Any]:
+    """Convert a document of a synthetic library to a Semantic Scholar paper."""
+    authors = [f"{a['given']} {a['family']}" for a in doc["author_list"]]
+    key = doc["author_list"][0]["family"].lower() + str(doc["year"])
+    bibtex = (
+        f"@article{{{key},\n title = {{{doc['title']}}},\n"
+        f" author = {{{' and '.join(authors)}}},\n year = {{{doc['year']}}},\n"
+        f" journal = {{{doc['journal']}}},\n doi = {{{doc['doi']}}}\n}}"
+    )
+    return {
+        "paperId": hashlib.sha1(doc["doi"].encode()).hexdigest(),
+        "externalIds": {"DOI": doc["doi"]},
+        "title": doc["title"],
+        "authors": [{"name": name} for name in authors],
+        "year": doc["year"],
+        "publicationDate": f"{doc['year']}-01-01",
+        "journal": {"name": doc["journal"]},
+        "citationCount": len(doc["title"]),
+        "citationStyles": {"bibtex": bibtex},
+        "url": f"https://doi.org/{doc['doi']}",
+    }
+
+
+class FakeServer:
+    """Serve the fake APIs on a background thread.
+
+    Use as a context manager; `url` is the base URL of the server and
+    `requests` counts the requests to each API.
+    """
+
+    def __init__(
+        self,
+        papers: Optional[List[Dict[str, Any]]] = None,
+        dim: int = 256,
+        embedding_latency: float = 0.0,
+        llm_latency: float = 0.0,
+        s2_latency: float = 0.0,
+        port: int = 0,
+    ) -> None:
+        self.dim = dim
+        self.latency = {
+            "embeddings": embedding_latency,
+            "llm": llm_latency,
+            "semantic_scholar": s2_latency,
+        }
+        self.requests: Counter = Counter()
+        self._lock = threading.Lock()
+        self._by_doi = {}
+        self._by_title = {}
+        for doc in papers or []:
+            paper = to_semantic_scholar(doc)
+            self._by_doi[doc["doi"].lower()] = paper
+            self._by_title[self._normalize(doc["title"])] = paper
+
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, format: str, *args: Any) -> None:
+                pass
+
+            def do_GET(self) -> None:
+                server._handle(self, None)
+
+            def do_POST(self) -> None:
+                length = int(self.headers.get("Content-Length", 0))
+                server._handle(self, json.loads(self.rfile.read(length) or b"{}"))
+
+        self._httpd = ThreadingHTTPServer(("127.0.0.1", port), Handler)
+        self._httpd.daemon_threads = True
+        self.url = "http://127.0.0.1:{}".format(self._httpd.server_address[1])
+
+    def __enter__(self) -> "FakeServer":
+        threading.Thread(target=self._httpd.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, *exc: Any) -> None:
+        self._httpd.shutdown()
+        self._httpd.server_close()
+
+    @staticmethod
+    def _normalize(title: str) -> str:
+        return " ".join(re.findall(r"\w+", title.lower()))
+
+    def _handle(
+        self, handler: BaseHTTPRequestHandler, body: Optional[Dict[str, Any]]
+    ) -> None:
+        url = urlparse(handler.path)
+        if url.path.endswith("/embeddings") and body is not None:
+            api, response = "embeddings", self._embeddings(body)
+        elif url.path.endswith("/chat/completions") and body is not None:
+            api, response = "llm", self._chat(body)
+        elif url.path.startswith("/graph/v1/paper/"):
+            api, response = "semantic_scholar", self._paper(url)
+        else:
+            api, response = "unknown", None
+
+        with self._lock:
+            self.requests[api] += 1
+        time.sleep(self.latency.get(api, 0))
+
+        if response is None:
+            self._send(handler, 404, {"error": "Not found"})
+        elif body is not None and body.get("stream"):
+            self._stream(handler, response)
+        else:
+            self._send(handler, 200, response)
+
+    def _send(
+        self, handler: BaseHTTPRequestHandler, status: int, response: Dict[str, Any]
+    ) -> None:
+        data = json.dumps(response).encode()
+        handler.send_response(status)
+        handler.send_header("Content-Type", "application/json")
+        handler.send_header("Content-Length", str(len(data)))
+        handler.end_headers()
+        handler.wfile.write(data)
+
+    def _stream(
+        self, handler: BaseHTTPRequestHandler, response: Dict[str, Any]
+    ) -> None:
+        """Send a chat completion as server-sent events, a few words at a time."""
+        handler.send_response(200)
+        handler.send_header("Content-Type", "text/event-stream")
+        handler.send_header("Connection", "close")
+        handler.end_headers()
+        handler.close_connection = True
+
+        chunk = {key: response[key] for key in ("id", "created", "model")}
+        chunk["object"] = "chat.completion.chunk"
+        words = response["choices"][0]["message"]["content"].split(" ")
+        events = [
+            {"index": 0, "delta": {"role": "assistant", "content": ""}},
+            *(
+                {"index": 0, "delta": {"content": " ".join(words[i : i + 8]) + " "}}
+                for i in range(0, len(words), 8)
+            ),
+            {"index": 0, "delta": {}, "finish_reason": "stop"},
+        ]
+        for event in events:
+            self._event(handler, {**chunk, "choices": [event]})
+        self._event(handler, {**chunk, "choices": [], "usage": response["usage"]})
+        handler.wfile.write(b"data: [DONE]\n\n")
+        handler.wfile.flush()
+
+    @staticmethod
+    def _event(handler: BaseHTTPRequestHandler, data: Dict[str, Any]) -> None:
+        handler.wfile.write(b"data: " + json.dumps(data).encode() + b"\n\n")
+
+    def _embeddings(self, body: Dict[str, Any]) -> Dict[str, Any]:
+        texts = body["input"] if isinstance(body["input"], list) else [body["input"]]
+        data = []
+        for i, text in enumerate(texts):
+            vector = embed(text, self.dim)
+            if body.get("encoding_format") == "base64":
+                embedding: Any = base64.b64encode(vector.tobytes()).decode()
+            else:
+                embedding = vector.tolist()
+            data.append({"object": "embedding", "index": i, "embedding": embedding})
+        tokens = sum(len(text.split()) for text in texts)
+        return {
+            "object": "list",
+            "data": data,
+            "model": body.get("model", "fake-embedding"),
+            "usage": {"prompt_tokens": tokens, "total_tokens": tokens},
+        }
+
+    def _chat(self, body: Dict[str, Any]) -> Dict[str, Any]:
+        prompt = "\n".join(
+            message["content"]
+            for message in body["messages"]
+            if isinstance(message.get("content"), str)
+        )
+        words = prompt.split()
+        if "relevance_score" in prompt:
+            # summarizing a chunk of a document as evidence
+            content = json.dumps(
+                {
+                    "summary": " ".join(words[-60:]),
+                    "relevance_score": 1 + zlib.crc32(prompt.encode()) % 10,
+                }
+            )
+        else:
+            keys = [
+                key
+                for key in dict.fromkeys(CONTEXT_KEY_RE.findall(prompt))
+                if key not in EXAMPLE_CONTEXT_KEYS
+            ]
+            content = "The evidence suggests that {} {}.".format(
+                " ".join(words[:40]),
+                "({})".format(", ".join(keys[:3])) if keys else "",
+            )
+        prompt_tokens = len(words)
+        completion_tokens = len(content.split())
+        return {
+            "id": "chatcmpl-fake",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": body.get("model", "fake-llm"),
+            "choices": [
+                {
+                    "index": 0,
+                    "message": {"role": "assistant", "content": content},
+                    "finish_reason": "stop",
+                }
+            ],
+            "usage": {
+                "prompt_tokens": prompt_tokens,
+                "completion_tokens": completion_tokens,
+                "total_tokens": prompt_tokens + completion_tokens,
+            },
+        }
+
+    def _paper(self, url: Any) -> Optional[Dict[str, Any]]:
+        path = unquote(url.path)
+        if path.startswith("/graph/v1/paper/DOI:"):
+            return self._by_doi.get(path[len("/graph/v1/paper/DOI:") :].lower())
+        if path == "/graph/v1/paper/search/match":
+            query = parse_qs(url.query).get("query", [""])[0]
+            if paper := self._by_title.get(self._normalize(query)):
+                return {"data": [paper]}
+        return None
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--dim", type=int, default=256)
+    parser.add_argument("--embedding-latency", type=float, default=0.05)
+    parser.add_argument("--llm-latency", type=float, default=0.5)
+    parser.add_argument("--s2-latency", type=float, default=0.1)
+    parser.add_argument(
+        "--library", type=Path, help="a synthetic library to serve the papers of"
+    )
+    args = parser.parse_args()
+
+    papers = []
+    if args.library:
+        for info in sorted(args.library.glob("*/info.yaml")):
+            with open(info) as f:
+                papers.append(yaml.safe_load(f))
+    with FakeServer(
+        papers,
+        dim=args.dim,
+        embedding_latency=args.embedding_latency,
+        llm_latency=args.llm_latency,
+        s2_latency=args.s2_latency,
+        port=args.port,
+    ) as server:
+        print(f"Serving on {server.url}, press Ctrl+C to stop")
+        try:
+            threading.Event().wait()
+        except KeyboardInterrupt:
+            pass
+
+
+if __name__ == "__main__":
+    main()
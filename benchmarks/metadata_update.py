@@ -0,0 +1,158 @@
+#!/usr/bin/env python3
+"""Benchmark metadata updates against the size of the index.
+
+Compares updating the metadata of a fixed number of documents of a
+synthetic library by scanning every Text in memory (how the index used to
+be updated) with `update_index_metadata`, which only writes the documents'
+rows in the index store. The former grows with the total number of chunks,
+the latter should stay flat. External metadata lookups are queued, but not
+made.
+
+Usage: python benchmarks/metadata_update.py [--updates 100] [--chunks 20]
+"""
+
+import argparse
+import asyncio
+import tempfile
+import time
+from pathlib import Path
+from typing import Any, Dict, List
+
+import numpy as np
+import papis.config
+import papis.document
+from synthetic_library import make_library
+
+from papis_ask.index import get_index, get_index_store, update_index_metadata
+
+LIBRARY_NAME = "bench"
+LIBRARY_SIZES = (500, 2000, 8000)
+EMBEDDING_DIM = 768
+CHUNK_TEXT = "lorem ipsum " * 100
+
+
+def configure(tmp: Path) -> Path:
+    """Point Papis at an empty library and cache in `tmp`."""
+    library = tmp / "library"
+    (tmp / "cache").mkdir()
+    papis.config.set("cache-dir", str(tmp / "cache"))
+    papis.config.set("dir", str(library), section=LIBRARY_NAME)
+    papis.config.set_lib_from_name(LIBRARY_NAME)
+    return library
+
+
+def make_index(library: List[Dict[str, Any]], chunks: int) -> list:
+    """Store synthetic chunks of every document and return them without embeddings."""
+    from paperqa.types import Doc, Text
+
+    store = get_index_store()
+    rng = np.random.default_rng(0)
+    texts = []
+    for info in library:
+        doc = Doc(docname=info["ref"], dockey=info["papis_id"], citation=info["title"])
+        doc_texts = [
+            Text(
+                text=CHUNK_TEXT,
+                name=f"{info['ref']} chunk {j}",
+                doc=doc,
+                embedding=rng.random(EMBEDDING_DIM, dtype=np.float32).tolist(),
+            )
+            for j in range(chunks)
+        ]
+        store.save_document(doc, doc_texts)
+        # only the scan needs the texts, and not their embeddings
+        for text in doc_texts:
+            text.embedding = None
+        texts.extend(doc_texts)
+    return texts
+
+
+def scan_texts(texts: list, docs: list) -> float:
+    from paperqa.types import Doc
+
+    start = time.perf_counter()
+    for info in docs:
+        new_doc = Doc(
+            docname=info["ref"], dockey=info["papis_id"], citation=info["title"]
+        )
+        for text in texts:
+            if text.doc.dockey == new_doc.dockey:
+                text.doc = new_doc
+    return time.perf_counter() - start
+
+
+async def update_metadata(library_dir: Path, docs: list) -> float:
+    import aiohttp
+    from paperqa import Settings
+    from paperqa.clients import DocMetadataClient
+    from paperqa.clients.journal_quality import JournalQualityPostProcessor
+
+    from papis_ask.enrichment import MetadataEnricher, TokenBucket
+    from papis_ask.metadata_provider import PapisProvider
+
+    async def skip_lookup(dockey: str, query: Dict[str, Any]) -> bool:
+        return False
+
+    docs_index = get_index(with_texts=False)
+    docs_papis = [
+        papis.document.from_folder(str(library_dir / info["ref"])) for info in docs
+    ]
+    PapisProvider.configure(docs_by_id={doc["papis_id"]: doc for doc in docs_papis})
+    settings = Settings()
+
+    async with aiohttp.ClientSession() as session:
+        clients = {
+            "papis": DocMetadataClient(
+                session=session,
+                clients={PapisProvider, JournalQualityPostProcessor},
+            ),
+            # never started, so the lookups are only queued in the store
+            "enricher": MetadataEnricher(
+                store=get_index_store(),
+                enrich=skip_lookup,
+                rate_limiter=TokenBucket(rate=0),
+                concurrency=1,
+                max_attempts=1,
+            ),
+        }
+        start = time.perf_counter()
+        for doc_papis in docs_papis:
+            file_path = library_dir / doc_papis["ref"] / doc_papis["files"][0]
+            ref = await update_index_metadata(
+                file_path,
+                file_last_indexed=time.time(),
+                dockey=doc_papis["papis_id"],
+                docname=doc_papis["ref"],
+                doc_papis=doc_papis,
+                docs_index=docs_index,
+                clients=clients,
+                settings=settings,
+            )
+            assert ref is not None, f"Failed to update {file_path}"
+        return time.perf_counter() - start
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--updates", type=int, default=100)
+    parser.add_argument("--chunks", type=int, default=20)
+    args = parser.parse_args()
+
+    print(f"{'docs':>6} {'chunks':>8} {'scan (s)':>10} {'store (s)':>10}")
+    for n_docs in LIBRARY_SIZES:
+        with tempfile.TemporaryDirectory() as tmp:
+            library_dir = configure(Path(tmp))
+            library = make_library(library_dir, n_docs, pages=1)
+            texts = make_index(library, args.chunks)
+            step = max(1, n_docs // args.updates)
+            docs = library[::step][: args.updates]
+
+            scan = scan_texts(texts, docs)
+            update = asyncio.run(update_metadata(library_dir, docs))
+            get_index_store().close()
+
+        print(f"{n_docs:>6} {len(texts):>8} {scan:>10.3f} {update:>10.3f}")
+
+
+if __name__ == "__main__":
+    main()
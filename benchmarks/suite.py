@@ -0,0 +1,229 @@
+#!/usr/bin/env python3
+"""Benchmark indexing and answering questions end to end, offline.
+
+Generates a synthetic library, then runs `papis ask index` and `papis ask`
+against it as a user would, with a throwaway Papis configuration that points
+the embedding model, the LLMs and Semantic Scholar at a local fake server
+(see `fake_server.py`) answering after a configurable latency. Reports the
+indexing throughput, the latency percentiles of the questions, the peak
+memory of each command and the size of the index.
+
+Needs papis-ask and a parser for the library's files installed, and no
+network: only tiktoken has to download its encoding once, so run any
+`papis ask index` (or `python -c "import tiktoken;
+tiktoken.get_encoding('cl100k_base')"`) online before, or point
+TIKTOKEN_CACHE_DIR at a copy of its cache.
+
+Usage: python benchmarks/suite.py [--docs 100] [--pages 10] [--format txt]
+    [--questions 20] [--serve] [--embedding-latency 0.05]
+    [--llm-latency 0.5] [--s2-latency 0.1] [--json FILE]
+"""
+
+import argparse
+import json
+import os
+import signal
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+from typing import Any, Dict, List
+
+import numpy as np
+from fake_server import FakeServer
+from synthetic_library import make_library, make_questions
+
+LIBRARY_NAME = "bench"
+SERVE_TIMEOUT = 120  # seconds to wait for the query daemon to load the index
+
+
+def write_config(tmp: Path, library: Path, server_url: str) -> Path:
+    config = tmp / "config" / "papis" / "config"
+    config.parent.mkdir(parents=True)
+    config.write_text(
+        "[settings]\n"
+        f"default-library = {LIBRARY_NAME}\n"
+        f"cache-dir = {tmp / 'cache'}\n"
+        f"[{LIBRARY_NAME}]\n"
+        f"dir = {library}\n"
+        "[ask]\n"
+        "llm = openai/fake-llm\n"
+        "summary-llm = openai/fake-llm\n"
+        "embedding = openai/fake-embedding\n"
+        f"semantic-scholar-url = {server_url}\n"
+        # the fake server doesn't rate limit
+        "metadata-rate = 0\n"
+    )
+    return config
+
+
+def run_measured(args: List[str], env: Dict[str, str]) -> Dict[str, Any]:
+    """Run a command and get its wall time, peak memory and output."""
+    start = time.perf_counter()
+    with tempfile.TemporaryFile() as stdout, tempfile.TemporaryFile() as stderr:
+        process = subprocess.Popen(
+            args, env=env, stdin=subprocess.DEVNULL, stdout=stdout, stderr=stderr
+        )
+        _, status, usage = os.wait4(process.pid, 0)
+        process.returncode = os.waitstatus_to_exitcode(status)
+        elapsed = time.perf_counter() - start
+        stdout.seek(0)
+        stderr.seek(0)
+        if process.returncode:
+            sys.exit(
+                "{} failed:\n{}".format(
+                    " ".join(args), stderr.read().decode(errors="replace")
+                )
+            )
+        return {
+            "seconds": elapsed,
+            "max_rss_mb": usage.ru_maxrss / 1024,  # in KB on Linux
+            "stdout": stdout.read().decode(errors="replace"),
+        }
+
+
+def get_peak_rss(pid: int) -> float:
+    """Get the peak memory of a running process in MB."""
+    with open(f"/proc/{pid}/status") as f:
+        for line in f:
+            if line.startswith("VmHWM:"):
+                return int(line.split()[1]) / 1024
+    return 0.0
+
+
+def get_index_stats(cache: Path) -> Dict[str, Any]:
+    index_file = cache / f"{LIBRARY_NAME}.qa.sqlite"
+    with sqlite3.connect(index_file) as db:
+        chunks = db.execute("SELECT COUNT(*) FROM texts").fetchone()[0]
+    # the store, its embedding matrices, nearest neighbour and full-text index
+    files = [
+        file
+        for path in cache.glob(f"{LIBRARY_NAME}.qa.sqlite*")
+        for file in ([path] if path.is_file() else path.rglob("*"))
+    ]
+    size = sum(file.stat().st_size for file in files if file.is_file())
+    return {"chunks": chunks, "index_mb": size / 1024**2}
+
+
+def percentiles(seconds: List[float]) -> Dict[str, float]:
+    return {f"p{p}_ms": float(np.percentile(seconds, p)) * 1000 for p in (50, 90, 99)}
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--docs", type=int, default=100)
+    parser.add_argument("--pages", type=int, default=10)
+    parser.add_argument("--format", choices=["txt", "pdf"], default="txt")
+    parser.add_argument("--questions", type=int, default=20)
+    parser.add_argument(
+        "--serve", action="store_true", help="answer through `papis ask serve`"
+    )
+    parser.add_argument("--dim", type=int, default=256)
+    parser.add_argument("--embedding-latency", type=float, default=0.05)
+    parser.add_argument("--llm-latency", type=float, default=0.5)
+    parser.add_argument("--s2-latency", type=float, default=0.1)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--json", type=Path, help="also write the results here")
+    args = parser.parse_args()
+
+    results: Dict[str, Any] = {"config": vars(args) | {"json": None}}
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        tmp = Path(tmp_dir)
+        library = make_library(
+            tmp / "library", args.docs, args.pages, args.format, args.seed
+        )
+        questions = make_questions(library, args.questions, args.seed)
+
+        with FakeServer(
+            library,
+            dim=args.dim,
+            embedding_latency=args.embedding_latency,
+            llm_latency=args.llm_latency,
+            s2_latency=args.s2_latency,
+        ) as server:
+            config = write_config(tmp, tmp / "library", server.url)
+            env = os.environ | {
+                "XDG_CONFIG_HOME": str(tmp / "config"),
+                "XDG_CACHE_HOME": str(tmp / "cache"),
+                "OPENAI_API_BASE": f"{server.url}/v1",
+                "OPENAI_API_KEY": "fake",
+                # litellm would otherwise download its model prices
+                "LITELLM_LOCAL_MODEL_COST_MAP": "True",
+            }
+            papis = ["papis", "--config", str(config), "ask"]
+
+            index = run_measured([*papis, "index"], env)
+            stats = get_index_stats(tmp / "cache")
+            results["index"] = {
+                "seconds": index["seconds"],
+                "docs_per_s": args.docs / index["seconds"],
+                "chunks_per_s": stats["chunks"] / index["seconds"],
+                "max_rss_mb": index["max_rss_mb"],
+                **stats,
+                "requests": dict(server.requests),
+            }
+
+            server.requests.clear()
+            daemon = None
+            if args.serve:
+                socket_file = tmp / "cache" / f"{LIBRARY_NAME}.ask.sock"
+                daemon = subprocess.Popen(
+                    [*papis, "serve"],
+                    env=env,
+                    stdout=subprocess.DEVNULL,
+                    stderr=subprocess.DEVNULL,
+                )
+                deadline = time.monotonic() + SERVE_TIMEOUT
+                while not socket_file.exists():
+                    if daemon.poll() is not None or time.monotonic() > deadline:
+                        daemon.kill()
+                        sys.exit("`papis ask serve` didn't start")
+                    time.sleep(0.1)
+
+            try:
+                answers = [
+                    run_measured(
+                        [*papis, "query", "-o", "json", "--no-cache", question], env
+                    )
+                    for question in questions
+                ]
+                results["query"] = {
+                    "questions": len(answers),
+                    **percentiles([answer["seconds"] for answer in answers]),
+                    "max_rss_mb": max(answer["max_rss_mb"] for answer in answers),
+                    "requests": dict(server.requests),
+                }
+                if daemon is not None:
+                    results["query"]["daemon_max_rss_mb"] = get_peak_rss(daemon.pid)
+            finally:
+                if daemon is not None:
+                    daemon.send_signal(signal.SIGINT)
+                    daemon.wait()
+
+    index = results["index"]
+    print(
+        f"Indexed {args.docs} documents ({index['chunks']} chunks) in"
+        f" {index['seconds']:.1f} s: {index['docs_per_s']:.1f} documents/s,"
+        f" {index['chunks_per_s']:.1f} chunks/s, peak RSS"
+        f" {index['max_rss_mb']:.0f} MB, index {index['index_mb']:.1f} MB"
+    )
+    query = results["query"]
+    print(
+        f"Answered {query['questions']} questions"
+        f"{' through the daemon' if args.serve else ''}: p50"
+        f" {query['p50_ms']:.0f} ms, p90 {query['p90_ms']:.0f} ms, p99"
+        f" {query['p99_ms']:.0f} ms, peak RSS {query['max_rss_mb']:.0f} MB"
+        + (
+            f" (daemon {query['daemon_max_rss_mb']:.0f} MB)"
+            if "daemon_max_rss_mb" in query
+            else ""
+        )
+    )
+    if args.json:
+        args.json.write_text(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
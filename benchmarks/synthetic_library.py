@@ -0,0 +1,166 @@
+#!/usr/bin/env python3
+"""Generate a synthetic Papis library for benchmarks.
+
+Every document is a folder with an `info.yaml` and a text or PDF file of
+made-up words. Each document is about a few topic words, which also appear
+in its title, so that questions about a topic have relevant documents. The
+same seed always generates the same library.
+
+Usage: python benchmarks/synthetic_library.py DIR [--docs 100] [--pages 10]
+    [--format txt]
+"""
+
+import argparse
+import random
+import uuid
+from pathlib import Path
+from typing import Any, Dict, List
+
+import yaml
+
+VOCABULARY_SIZE = 5000
+TOPIC_WORDS = 3
+WORDS_PER_LINE = 12
+LINES_PER_PAGE = 40
+JOURNALS = ("Journal of Synthetic Results", "Annals of Benchmarking", "Fake Letters")
+
+
+def make_vocabulary(rng: random.Random) -> List[str]:
+    syllables = ["ka", "lo", "mi", "ne", "ru", "sa", "ti", "vo", "zen", "qua", "pho"]
+    words = set()
+    while len(words) < VOCABULARY_SIZE:
+        words.add("".join(rng.choice(syllables) for _ in range(rng.randint(2, 4))))
+    return sorted(words)
+
+
+def make_pages(
+    rng: random.Random, vocabulary: List[str], topics: List[str], pages: int
+) -> List[List[str]]:
+    """Make pages of lines of words, a tenth of which are the topic words."""
+    return [
+        [
+            " ".join(
+                rng.choice(topics) if rng.random() < 0.1 else rng.choice(vocabulary)
+                for _ in range(WORDS_PER_LINE)
+            )
+            for _ in range(LINES_PER_PAGE)
+        ]
+        for _ in range(pages)
+    ]
+
+
+def write_pdf(path: Path, pages: List[List[str]]) -> None:
+    """Write a minimal PDF with one line of Helvetica text per line."""
+    objects = [
+        b"<< /Type /Catalog /Pages 2 0 R >>",
+        b"",  # the page tree, once the pages are known
+        b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>",
+    ]
+    page_ids = []
+    for lines in pages:
+        text = "BT /F1 10 Tf 50 800 Td 14 TL " + " ".join(
+            "({}) '".format(
+                line.replace("\\", "\\\\").replace("(", "\\(").replace(")", "\\)")
+            )
+            for line in lines
+        )
+        content = text.encode("latin-1", "replace") + b" ET"
+        objects.append(
+            b"<< /Length %d >>\nstream\n%s\nendstream" % (len(content), content)
+        )
+        objects.append(
+            b"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 595 842]"
+            b" /Resources << /Font << /F1 3 0 R >> >> /Contents %d 0 R >>"
+            % (len(objects))
+        )
+        page_ids.append(len(objects))
+    objects[1] = b"<< /Type /Pages /Kids [%s] /Count %d >>" % (
+        b" ".join(b"%d 0 R" % i for i in page_ids),
+        len(page_ids),
+    )
+
+    data = bytearray(b"%PDF-1.4\n")
+    offsets = []
+    for i, obj in enumerate(objects, start=1):
+        offsets.append(len(data))
+        data += b"%d 0 obj\n%s\nendobj\n" % (i, obj)
+    xref = len(data)
+    data += b"xref\n0 %d\n0000000000 65535 f \n" % (len(objects) + 1)
+    data += b"".join(b"%010d 00000 n \n" % offset for offset in offsets)
+    data += b"trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n" % (
+        len(objects) + 1,
+        xref,
+    )
+    path.write_bytes(bytes(data))
+
+
+def make_library(
+    root: Path, docs: int, pages: int, file_format: str = "txt", seed: int = 0
+) -> List[Dict[str, Any]]:
+    """Write a library of `docs` documents to `root` and return their metadata."""
+    rng = random.Random(seed)
+    vocabulary = make_vocabulary(rng)
+    library = []
+    for i in range(docs):
+        topics = rng.sample(vocabulary, TOPIC_WORDS)
+        authors = [
+            {
+                "given": rng.choice(vocabulary).title(),
+                "family": rng.choice(vocabulary).title(),
+            }
+            for _ in range(rng.randint(1, 4))
+        ]
+        info = {
+            "papis_id": uuid.UUID(int=rng.getrandbits(128)).hex,
+            "ref": f"doc{i}",
+            "type": "article",
+            "title": f"On {topics[0]} and {topics[1]} in {topics[2]}".title(),
+            "author": " and ".join(f"{a['family']}, {a['given']}" for a in authors),
+            "author_list": authors,
+            "year": rng.randint(1990, 2025),
+            "journal": rng.choice(JOURNALS),
+            "doi": f"10.5555/synthetic.{seed}.{i}",
+            "files": [f"doc{i}.{file_format}"],
+        }
+
+        folder = root / f"doc{i}"
+        folder.mkdir(parents=True, exist_ok=True)
+        doc_pages = make_pages(rng, vocabulary, topics, pages)
+        if file_format == "pdf":
+            write_pdf(folder / info["files"][0], doc_pages)
+        else:
+            (folder / info["files"][0]).write_text(
+                "\n\n".join("\n".join(lines) for lines in doc_pages)
+            )
+        with open(folder / "info.yaml", "w") as f:
+            yaml.safe_dump(info, f, allow_unicode=True)
+        library.append({**info, "topics": topics})
+    return library
+
+
+def make_questions(
+    library: List[Dict[str, Any]], count: int, seed: int = 0
+) -> List[str]:
+    """Make distinct questions about the topics of random documents."""
+    rng = random.Random(seed)
+    return [
+        f"What is known about {' and '.join(rng.sample(doc['topics'], 2))}? ({i})"
+        for i, doc in enumerate(rng.choices(library, k=count))
+    ]
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("dir", type=Path)
+    parser.add_argument("--docs", type=int, default=100)
+    parser.add_argument("--pages", type=int, default=10)
+    parser.add_argument("--format", choices=["txt", "pdf"], default="txt")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    make_library(args.dir, args.docs, args.pages, args.format, args.seed)
+    print(f"Wrote {args.docs} documents to {args.dir}")
+
+
+if __name__ == "__main__":
+    main()
@@ -53,6 +53,7 @@
                 paper-qa
                 click-default-group
                 rich
+                tantivy
               ]
               ++ paper-qa.optional-dependencies.paper-qa-pypdf;
 
@@ -0,0 +1,126 @@
+"""Approximate nearest neighbour search over the embedding matrix.
+
+This is an inverted file (IVF) index: the embeddings are clustered with
+spherical k-means, and a question is only scored against the embeddings of
+the `nprobe` clusters whose centroids are most similar to it. The index
+stores the centroids and the cluster of every row of the embedding matrix,
+so rows appended by later index runs only have to be assigned to a cluster.
+"""
+
+import os
+from pathlib import Path
+from typing import Any, Optional
+
+import numpy as np
+
+from papis_ask.vectors import SCORE_BLOCK_ROWS, top_k
+
+KMEANS_ITERATIONS = 10
+# Number of embeddings per cluster used to train the centroids
+KMEANS_SAMPLES_PER_CLUSTER = 64
+# Retrain once the matrix has grown this much since training, since the
+# clusters no longer fit the embeddings well
+RETRAIN_GROWTH = 4
+
+
+def normalize(matrix: Any) -> Any:
+    matrix = np.asarray(matrix, dtype=np.float32)
+    norms = np.linalg.norm(matrix, axis=-1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return matrix / norms
+
+
+def assign(matrix: Any, centroids: Any, start: int = 0) -> Any:
+    """Assign the rows of `matrix` from `start` on to their nearest centroid."""
+    labels = np.empty(len(matrix) - start, dtype=np.int32)
+    for block_start in range(start, len(matrix), SCORE_BLOCK_ROWS):
+        block = normalize(matrix[block_start : block_start + SCORE_BLOCK_ROWS])
+        labels[block_start - start : block_start - start + len(block)] = np.argmax(
+            block @ centroids.T, axis=1
+        )
+    return labels
+
+
+def kmeans(matrix: Any, n_clusters: int, seed: int = 0) -> Any:
+    """Cluster a sample of the rows of `matrix` by cosine similarity."""
+    rng = np.random.default_rng(seed)
+    n_samples = min(len(matrix), n_clusters * KMEANS_SAMPLES_PER_CLUSTER)
+    sample = normalize(matrix[np.sort(rng.choice(len(matrix), n_samples, False))])
+    centroids = sample[rng.choice(len(sample), n_clusters, replace=False)]
+
+    for _ in range(KMEANS_ITERATIONS):
+        labels = np.argmax(sample @ centroids.T, axis=1)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, labels, sample)
+        empty = np.bincount(labels, minlength=n_clusters) == 0
+        # restart empty clusters from random samples
+        sums[empty] = sample[rng.choice(len(sample), int(empty.sum()))]
+        centroids = normalize(sums)
+    return centroids
+
+
+class IVFIndex:
+    """Inverted file index over the rows of the embedding matrix."""
+
+    def __init__(self, centroids: Any, labels: Any, trained_rows: int) -> None:
+        self.centroids = centroids
+        self.labels = labels
+        self.trained_rows = trained_rows
+        self._lists: Any = None
+
+    @classmethod
+    def train(cls, matrix: Any) -> "IVFIndex":
+        """Cluster the embeddings and assign every row to a cluster."""
+        n_clusters = max(1, int(np.sqrt(len(matrix))))
+        centroids = kmeans(matrix, n_clusters)
+        return cls(centroids, assign(matrix, centroids), len(matrix))
+
+    @classmethod
+    def load(cls, path: Path) -> Optional["IVFIndex"]:
+        if not path.exists():
+            return None
+        with np.load(path) as data:
+            return cls(data["centroids"], data["labels"], int(data["trained_rows"]))
+
+    def save(self, path: Path) -> None:
+        tmp_path = path.with_name(path.name + ".tmp")
+        with open(tmp_path, "wb") as f:
+            np.savez(
+                f,
+                centroids=self.centroids,
+                labels=self.labels,
+                trained_rows=self.trained_rows,
+            )
+        os.replace(tmp_path, path)
+
+    def needs_training(self, n_rows: int) -> bool:
+        return n_rows < len(self.labels) or n_rows > self.trained_rows * RETRAIN_GROWTH
+
+    def update(self, matrix: Any) -> None:
+        """Assign the rows appended to the matrix since the last update."""
+        if len(matrix) > len(self.labels):
+            self.labels = np.concatenate(
+                [self.labels, assign(matrix, self.centroids, len(self.labels))]
+            )
+
+    def set_rows(self, rows: Any) -> None:
+        """Build the inverted lists of the live matrix rows.
+
+        Rows that haven't been assigned to a cluster yet are always candidates.
+        """
+        assigned = rows[rows < len(self.labels)]
+        labels = self.labels[assigned]
+        order = np.argsort(labels, kind="stable")
+        offsets = np.searchsorted(labels[order], np.arange(len(self.centroids) + 1))
+        self._lists = (assigned[order], offsets, rows[rows >= len(self.labels)])
+
+    def candidates(self, query: Any, nprobe: int) -> Any:
+        """Get the rows in the `nprobe` clusters closest to the query."""
+        sorted_rows, offsets, unassigned = self._lists
+        probed = top_k(self.centroids @ normalize(query), nprobe)
+        return np.sort(
+            np.concatenate(
+                [sorted_rows[offsets[i] : offsets[i + 1]] for i in probed]
+                + [unassigned]
+            )
+        )
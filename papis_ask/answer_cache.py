@@ -0,0 +1,117 @@
+"""Persistent cache of answers to questions."""
+
+import hashlib
+import json
+import pickle
+import sqlite3
+import time
+from pathlib import Path
+from typing import Any, Dict, Optional
+
+import papis.logging
+
+logger = papis.logging.get_logger(__name__)
+
+
+def normalize_question(question: str) -> str:
+    """Normalize a question so that trivially different ones share answers."""
+    return " ".join(question.split()).casefold()
+
+
+def answer_cache_key(question: str, options: Dict[str, Any]) -> bytes:
+    """Get the cache key of a question asked with the given options.
+
+    The options have to include everything the answer depends on, such as
+    the query options and the names of the models.
+    """
+    return hashlib.sha256(
+        json.dumps(
+            {"question": normalize_question(question), **options}, sort_keys=True
+        ).encode()
+    ).digest()
+
+
+class AnswerCache:
+    """Persistent cache of answers, valid for one generation of the index.
+
+    Answers are stored as plain objects (see `papis_ask.daemon.to_plain_answer`)
+    so that reading them doesn't require importing paperqa. Answers for
+    earlier generations of the index are dropped as soon as an answer for a
+    later one is stored, and the least recently used answers are evicted
+    beyond `max_bytes`.
+    """
+
+    SCHEMA = """
+    CREATE TABLE IF NOT EXISTS answers (
+        key BLOB PRIMARY KEY,
+        generation INTEGER NOT NULL,
+        answer BLOB NOT NULL,
+        last_used REAL NOT NULL
+    );
+    CREATE INDEX IF NOT EXISTS answers_last_used ON answers (last_used);
+    """
+
+    def __init__(self, path: Path, generation: int, max_bytes: int) -> None:
+        self.generation = generation
+        self.max_bytes = max_bytes
+        self.connection = sqlite3.connect(path)
+        self.connection.execute("PRAGMA journal_mode = WAL")
+        self.connection.execute("PRAGMA synchronous = NORMAL")
+        with self.connection:
+            self.connection.executescript(self.SCHEMA)
+
+    def close(self) -> None:
+        self.connection.close()
+
+    def get(self, key: bytes) -> Optional[Any]:
+        """Look up an answer, returning `None` if it isn't cached."""
+        row = self.connection.execute(
+            "SELECT answer FROM answers WHERE key = ? AND generation = ?",
+            (key, self.generation),
+        ).fetchone()
+        if row is None:
+            return None
+        try:
+            answer = pickle.loads(row[0])
+        except (pickle.PickleError, AttributeError, ImportError) as e:
+            logger.debug(f"Ignoring unreadable cached answer: {e}")
+            return None
+
+        with self.connection:
+            self.connection.execute(
+                "UPDATE answers SET last_used = ? WHERE key = ?", (time.time(), key)
+            )
+        return answer
+
+    def put(self, key: bytes, answer: Any) -> None:
+        """Store an answer and evict answers that can't be used anymore."""
+        with self.connection:
+            self.connection.execute(
+                "DELETE FROM answers WHERE generation != ?", (self.generation,)
+            )
+            self.connection.execute(
+                "INSERT OR REPLACE INTO answers (key, generation, answer, last_used)"
+                " VALUES (?, ?, ?, ?)",
+                (key, self.generation, pickle.dumps(answer), time.time()),
+            )
+        self.evict()
+
+    def evict(self) -> None:
+        """Drop the least recently used answers beyond the size limit."""
+        (size,) = self.connection.execute(
+            "SELECT COALESCE(SUM(LENGTH(answer)), 0) FROM answers"
+        ).fetchone()
+        if size <= self.max_bytes:
+            return
+
+        evicted = []
+        for key, length in self.connection.execute(
+            "SELECT key, LENGTH(answer) FROM answers ORDER BY last_used"
+        ):
+            if size <= self.max_bytes:
+                break
+            evicted.append((key,))
+            size -= length
+        logger.debug(f"Evicting {len(evicted)} answer(s) from the cache")
+        with self.connection:
+            self.connection.executemany("DELETE FROM answers WHERE key = ?", evicted)
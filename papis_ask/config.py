@@ -11,6 +11,38 @@ DEFAULTS: PapisConfigType = {
         "context": True,
         "excerpt": False,
         "output": "terminal",
+        "index-jobs": 16,
+        "index-parse-concurrency": 0,  # 0 means one worker process per core
+        "index-embedding-concurrency": 4,
+        "index-metadata-concurrency": 1,
+        "index-queue-size": 8,
+        "index-embedding-batch-size": 256,
+        "index-embedding-batch-tokens": 64000,
+        "index-embedding-cache": True,
+        "index-embedding-cache-size": 2048,  # in MB
+        "metadata-cache-ttl": 30,  # in days
+        "metadata-cache-negative-ttl": 1,  # in days
+        "metadata-rate": 1.0,  # requests per second, 0 means unlimited
+        "metadata-burst": 1,
+        "metadata-max-attempts": 5,
+        "semantic-scholar-url": "",  # empty means the public API
+        "ann": True,
+        "ann-min-chunks": 50000,
+        "ann-nprobe": 16,
+        "embedding-precision": "float32",  # or float16 or int8
+        "embedding-rescore-factor": 4,
+        "fulltext": True,
+        "fulltext-candidates": 1000,
+        "retrieval": "dense",
+        "answer-cache": True,
+        "answer-cache-size": 64,  # in MB
+        "summary-cache": True,
+        "summary-cache-size": 256,  # in MB
+        "summary-cache-similarity": 1.0,  # 1 means only the same question
+        "batch-concurrency": 4,
+        "summary-concurrency": 4,
+        "summary-timeout": 120,  # in seconds, 0 means no timeout
+        "rerank-keep": 0,  # 0 means all retrieved chunks are summarized
     }
 }
 
@@ -19,8 +51,13 @@ papis.config.register_default_settings(DEFAULTS)
 
 
 def create_paper_qa_settings():
+    import litellm
     from paperqa import Settings
 
+    # litellm prints hints to stdout, e.g. when it can't price a model, which
+    # would end up in the JSON output
+    litellm.suppress_debug_info = True
+
     settings = Settings()
 
     settings.llm = papis.config.getstring("llm", SECTION_NAME)
@@ -37,5 +74,8 @@ def create_paper_qa_settings():
     settings.answer.answer_length = papis.config.getstring(
         "answer-length", SECTION_NAME
     )
+    settings.answer.max_concurrent_requests = max(
+        1, papis.config.getint("summary-concurrency", SECTION_NAME) or 1
+    )
     settings.parsing.use_doc_details = False
     return settings
@@ -0,0 +1,305 @@
+"""Resident query daemon keeping the index loaded between questions.
+
+The daemon listens on a Unix socket that only the user can access. A request
+is a JSON object with the question and the query options. The response is
+a series of pickled (kind, value) pairs: when streaming, the references
+used in citations ("evidence") and the pieces of the answer ("token"), and
+finally the answer ("ok"), converted to plain objects so that reading it
+doesn't require importing paperqa, or an error message ("error"). All are
+sent as frames prefixed by their length.
+
+This module is imported when asking questions, so anything expensive is
+imported where it's needed.
+"""
+
+import asyncio
+import json
+import os
+import pickle
+import socket
+import struct
+from pathlib import Path
+from types import SimpleNamespace
+from typing import Any, Callable, Dict, Optional, Tuple
+
+import papis.logging
+
+logger = papis.logging.get_logger(__name__)
+
+FRAME_HEADER = struct.Struct(">Q")
+CONNECT_TIMEOUT = 1.0
+
+
+class DaemonError(Exception):
+    """Raised when the daemon failed to answer a question."""
+
+
+def to_plain_answer(answer: Any) -> SimpleNamespace:
+    """Copy the parts of a paperqa answer used for output into plain objects."""
+    return SimpleNamespace(
+        question=answer.question,
+        answer=answer.answer,
+        contexts=[
+            SimpleNamespace(
+                context=context.context,
+                score=context.score,
+                text=SimpleNamespace(
+                    text=context.text.text,
+                    name=context.text.name,
+                    doc=SimpleNamespace(
+                        other=dict(context.text.doc.other),
+                        pages=getattr(context.text.doc, "pages", None),
+                        file_location=getattr(context.text.doc, "file_location", None),
+                    ),
+                ),
+            )
+            for context in answer.contexts
+        ],
+    )
+
+
+def recv_exactly(sock: socket.socket, size: int) -> bytes:
+    data = bytearray()
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        if not chunk:
+            raise ConnectionError("The daemon closed the connection")
+        data.extend(chunk)
+    return bytes(data)
+
+
+def query_daemon(
+    socket_file: Path,
+    request: Dict[str, Any],
+    on_evidence: Optional[Callable[[Dict[str, str]], None]] = None,
+    on_token: Optional[Callable[[str], None]] = None,
+    on_start: Optional[Callable[[], None]] = None,
+) -> Optional[Any]:
+    """Ask the daemon a question, streaming the answer if `on_token` is given.
+
+    Returns `None` if no daemon is listening, so the question can be answered
+    in-process instead. Raises `DaemonError` if the daemon failed to answer,
+    including if it went away while answering. See `answer_question` for the
+    callbacks.
+    """
+    if not hasattr(socket, "AF_UNIX") or not socket_file.exists():
+        return None
+
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.settimeout(CONNECT_TIMEOUT)
+        try:
+            sock.connect(str(socket_file))
+        except OSError as e:
+            logger.debug(f"No daemon listening on {socket_file}: {e}")
+            return None
+        # answering takes as long as the LLM takes
+        sock.settimeout(None)
+
+        logger.debug(f"Asking the daemon listening on {socket_file}")
+        payload = json.dumps({**request, "stream": on_token is not None}).encode()
+        try:
+            sock.sendall(FRAME_HEADER.pack(len(payload)) + payload)
+            while True:
+                (size,) = FRAME_HEADER.unpack(recv_exactly(sock, FRAME_HEADER.size))
+                kind, value = pickle.loads(recv_exactly(sock, size))
+                if kind == "start" and on_start is not None:
+                    on_start()
+                elif kind == "evidence" and on_evidence is not None:
+                    on_evidence(value)
+                elif kind == "token" and on_token is not None:
+                    on_token(value)
+                elif kind == "ok":
+                    return value
+                elif kind == "error":
+                    raise DaemonError(value)
+        except (OSError, EOFError, pickle.UnpicklingError) as e:
+            # e.g. the daemon was stopped or restarted while answering
+            raise DaemonError(f"Lost the connection to the daemon: {e}") from e
+
+
+def get_index_generation(index_file: Path) -> Tuple[Tuple[int, int], ...]:
+    """Get a value that changes whenever the index is written to."""
+    generation = []
+    for suffix in (
+        "",
+        "-wal",
+        ".embeddings",
+        ".embeddings.float16",
+        ".embeddings.int8",
+        ".ann.npz",
+        ".fulltext/meta.json",
+    ):
+        try:
+            stat = os.stat(f"{index_file}{suffix}")
+            generation.append((stat.st_mtime_ns, stat.st_size))
+        except OSError:
+            generation.append((0, 0))
+    return tuple(generation)
+
+
+class QueryDaemon:
+    """Answer questions from an index that's loaded once and reloaded on change."""
+
+    def __init__(self, index_file: Path, summary_cache: Optional[Any] = None) -> None:
+        self.index_file = index_file
+        self.summary_cache = summary_cache
+        # shared by all questions, to bound the summaries made at once
+        self.summary_semaphore: Optional[asyncio.Semaphore] = None
+        self.generation: Optional[Tuple[Tuple[int, int], ...]] = None
+        # loaded indexes by the options they were loaded with
+        self.docs_indexes: Dict[Tuple[bool, Optional[str]], Any] = {}
+
+    def get_docs_index(
+        self, exact: bool = False, retrieval: Optional[str] = None
+    ) -> Any:
+        from papis_ask.index import get_query_index
+
+        generation = get_index_generation(self.index_file)
+        if generation != self.generation:
+            self.docs_indexes.clear()
+            self.generation = generation
+        if (exact, retrieval) not in self.docs_indexes:
+            logger.info("Loading the index")
+            self.docs_indexes[exact, retrieval] = get_query_index(
+                exact=exact, retrieval=retrieval
+            )
+        return self.docs_indexes[exact, retrieval]
+
+    async def answer(
+        self, request: Dict[str, Any], send: Callable[[str, Any], None]
+    ) -> Any:
+        from papis_ask.config import create_paper_qa_settings
+        from papis_ask.index import get_answer_cache, get_answer_cache_key
+        from papis_ask.query import answer_question
+
+        settings = create_paper_qa_settings()
+        settings.answer.answer_max_sources = request["max_sources"]
+        settings.answer.evidence_k = request["evidence_k"]
+        settings.answer.answer_length = request["answer_length"]
+
+        answer_cache = get_answer_cache() if request.get("cache") else None
+        try:
+            cache_key = get_answer_cache_key(
+                request["query"],
+                settings,
+                request.get("exact", False),
+                request.get("retrieval"),
+                request.get("rerank_keep", 0),
+                request.get("filter"),
+            )
+            if (
+                answer_cache is not None
+                and (answer := answer_cache.get(cache_key)) is not None
+            ):
+                logger.info("Using the cached answer")
+                # it may have been asked differently, see `normalize_question`
+                answer.question = request["query"]
+                return answer
+
+            docs_index = self.get_docs_index(
+                request.get("exact", False), request.get("retrieval")
+            )
+            if docs_index is None:
+                raise DaemonError(
+                    "The index is empty. Please index some files before asking question."
+                )
+            if request.get("filter"):
+                from papis_ask.index import filter_query_index
+
+                docs_index = filter_query_index(docs_index, request["filter"])
+
+            if self.summary_semaphore is None:
+                self.summary_semaphore = asyncio.Semaphore(
+                    settings.answer.max_concurrent_requests
+                )
+
+            stream = request.get("stream", False)
+            answer = to_plain_answer(
+                await answer_question(
+                    docs_index,
+                    request["query"],
+                    settings,
+                    on_evidence=(lambda refs: send("evidence", refs))
+                    if stream
+                    else None,
+                    on_token=(lambda token: send("token", token)) if stream else None,
+                    summary_cache=self.summary_cache,
+                    summary_semaphore=self.summary_semaphore,
+                    rerank_keep=request.get("rerank_keep", 0),
+                    on_start=(lambda: send("start", None)) if stream else None,
+                )
+            )
+            if answer_cache is not None:
+                answer_cache.put(cache_key, answer)
+            return answer
+        finally:
+            if answer_cache is not None:
+                answer_cache.close()
+
+    async def handle(
+        self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter
+    ) -> None:
+        def send(kind: str, value: Any) -> None:
+            payload = pickle.dumps((kind, value))
+            writer.write(FRAME_HEADER.pack(len(payload)) + payload)
+
+        try:
+            (size,) = FRAME_HEADER.unpack(await reader.readexactly(FRAME_HEADER.size))
+            request = json.loads(await reader.readexactly(size))
+            logger.info(f"Answering '{request['query']}'")
+            try:
+                send("ok", await self.answer(request, send))
+            except Exception as e:
+                logger.exception("Failed to answer question")
+                send("error", str(e))
+            await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError, ValueError) as e:
+            logger.warning(f"Dropped malformed request: {e}")
+        finally:
+            writer.close()
+            try:
+                await writer.wait_closed()
+            except ConnectionError:
+                pass
+
+
+def is_daemon_running(socket_file: Path) -> bool:
+    """Check whether a daemon is listening on the socket."""
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.settimeout(CONNECT_TIMEOUT)
+        try:
+            sock.connect(str(socket_file))
+        except OSError:
+            return False
+    return True
+
+
+async def serve(socket_file: Path, index_file: Path) -> None:
+    """Listen for questions on `socket_file` until interrupted."""
+    if socket_file.exists():
+        if is_daemon_running(socket_file):
+            raise DaemonError(f"A daemon is already listening on {socket_file}")
+        # left behind by a daemon that didn't shut down cleanly
+        socket_file.unlink()
+
+    import papis.config
+    from papis_ask.config import SECTION_NAME
+    from papis_ask.index import get_summary_cache
+
+    daemon = QueryDaemon(index_file, summary_cache=get_summary_cache())
+    # load the index and paperqa before the first question
+    daemon.get_docs_index(retrieval=papis.config.getstring("retrieval", SECTION_NAME))
+
+    # only the user may ask questions, as they cost money and reveal the library
+    umask = os.umask(0o177)
+    try:
+        server = await asyncio.start_unix_server(daemon.handle, path=str(socket_file))
+    finally:
+        os.umask(umask)
+
+    logger.info(f"Listening on {socket_file}")
+    try:
+        async with server:
+            await server.serve_forever()
+    finally:
+        socket_file.unlink(missing_ok=True)
@@ -0,0 +1,237 @@
+"""Batching and caching of embedding requests across documents."""
+
+import asyncio
+import hashlib
+import sqlite3
+import time
+from pathlib import Path
+from typing import Any, List, Optional, Sequence, Set, Tuple
+
+import papis.logging
+
+from papis_ask.profiling import profile
+
+logger = papis.logging.get_logger(__name__)
+
+# How long to wait for more texts before sending an incomplete batch
+BATCH_LINGER = 0.05
+
+
+def estimate_tokens(text: str) -> int:
+    """Roughly estimate the number of tokens of a text."""
+    return len(text) // 4 + 1
+
+
+class EmbeddingCache:
+    """Persistent cache of chunk embeddings.
+
+    Embeddings are keyed by the hash of the chunk text together with a
+    `namespace` identifying the embedding model and chunking parameters, so
+    they survive regenerating the index as well as moving or renaming files.
+    The least recently used embeddings are evicted beyond `max_bytes`.
+    """
+
+    SCHEMA = """
+    CREATE TABLE IF NOT EXISTS embeddings (
+        key BLOB PRIMARY KEY,
+        embedding BLOB NOT NULL,
+        last_used REAL NOT NULL
+    );
+    CREATE INDEX IF NOT EXISTS embeddings_last_used ON embeddings (last_used);
+    """
+
+    def __init__(self, path: Path, namespace: str, max_bytes: int) -> None:
+        self.namespace = namespace
+        self.max_bytes = max_bytes
+        self.connection = sqlite3.connect(path)
+        self.connection.execute("PRAGMA journal_mode = WAL")
+        self.connection.execute("PRAGMA synchronous = NORMAL")
+        with self.connection:
+            self.connection.executescript(self.SCHEMA)
+
+    def close(self) -> None:
+        self.connection.close()
+
+    def key(self, text: str) -> bytes:
+        return hashlib.sha256(f"{self.namespace}\0{text}".encode()).digest()
+
+    def get_many(self, texts: Sequence[str]) -> List[Optional[List[float]]]:
+        """Look up the embeddings of texts, with `None` for those not cached."""
+        import numpy as np
+
+        keys = [self.key(text) for text in texts]
+        found = {}
+        # stay below SQLite's limit on the number of parameters
+        for start in range(0, len(keys), 500):
+            chunk = keys[start : start + 500]
+            placeholders = ", ".join("?" * len(chunk))
+            found.update(
+                self.connection.execute(
+                    "SELECT key, embedding FROM embeddings"
+                    f" WHERE key IN ({placeholders})",
+                    chunk,
+                )
+            )
+        if found:
+            with self.connection:
+                self.connection.executemany(
+                    "UPDATE embeddings SET last_used = ? WHERE key = ?",
+                    ((time.time(), key) for key in found),
+                )
+        return [
+            np.frombuffer(found[key], dtype=np.float32).tolist()
+            if key in found
+            else None
+            for key in keys
+        ]
+
+    def put_many(self, texts: Sequence[str], embeddings: Sequence[Any]) -> None:
+        """Store the embeddings of texts."""
+        import numpy as np
+
+        now = time.time()
+        with self.connection:
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO embeddings (key, embedding, last_used)"
+                " VALUES (?, ?, ?)",
+                (
+                    (
+                        self.key(text),
+                        np.asarray(embedding, dtype=np.float32).tobytes(),
+                        now,
+                    )
+                    for text, embedding in zip(texts, embeddings)
+                ),
+            )
+
+    def evict(self) -> None:
+        """Drop the least recently used embeddings beyond the size limit."""
+        count, size = self.connection.execute(
+            "SELECT COUNT(*), COALESCE(SUM(LENGTH(embedding)), 0) FROM embeddings"
+        ).fetchone()
+        if size <= self.max_bytes:
+            return
+
+        # embeddings all have about the same size
+        excess = count - int(count * self.max_bytes / size)
+        logger.debug(f"Evicting {excess} embedding(s) from the cache")
+        with self.connection:
+            self.connection.execute(
+                "DELETE FROM embeddings WHERE key IN"
+                " (SELECT key FROM embeddings ORDER BY last_used LIMIT ?)",
+                (excess,),
+            )
+
+
+class EmbeddingBatcher:
+    """Gather texts from many documents into batched embedding requests.
+
+    Texts are sent as soon as a batch reaches `batch_size` texts or
+    `batch_tokens` estimated tokens, or after `BATCH_LINGER` seconds
+    otherwise. At most `concurrency` requests are in flight at once. Texts
+    found in the `cache` aren't sent at all.
+    """
+
+    def __init__(
+        self,
+        embedding_model: Any,
+        batch_size: int,
+        batch_tokens: int,
+        concurrency: int,
+        cache: Optional[EmbeddingCache] = None,
+    ) -> None:
+        self.embedding_model = embedding_model
+        self.cache = cache
+        self.batch_size = max(1, batch_size)
+        self.batch_tokens = max(1, batch_tokens)
+
+        # litellm embedding models split requests into batches of
+        # `config["batch_size"]` themselves, which would undo our batching
+        if isinstance(getattr(embedding_model, "config", None), dict):
+            embedding_model.config["batch_size"] = self.batch_size
+
+        self._semaphore = asyncio.Semaphore(max(1, concurrency))
+        self._pending: List[Tuple[str, asyncio.Future]] = []
+        self._pending_tokens = 0
+        self._timer: Optional[asyncio.TimerHandle] = None
+        self._requests: Set[asyncio.Task] = set()
+
+    async def embed(self, texts: List[str]) -> List[List[float]]:
+        """Embed texts, possibly together with those of other documents."""
+        if self.cache is None:
+            return list(await asyncio.gather(*[self._submit(text) for text in texts]))
+
+        embeddings = self.cache.get_many(texts)
+        missing = [i for i, embedding in enumerate(embeddings) if embedding is None]
+        if missing:
+            computed = await asyncio.gather(*[self._submit(texts[i]) for i in missing])
+            self.cache.put_many([texts[i] for i in missing], computed)
+            for i, embedding in zip(missing, computed):
+                embeddings[i] = embedding
+        return embeddings  # type: ignore[return-value]
+
+    async def aclose(self) -> None:
+        """Send the remaining texts and wait for all requests to finish."""
+        self._flush()
+        if self._requests:
+            await asyncio.gather(*self._requests)
+        if self.cache is not None:
+            self.cache.evict()
+            self.cache.close()
+
+    def _submit(self, text: str) -> asyncio.Future:
+        tokens = estimate_tokens(text)
+        if self._pending and self._pending_tokens + tokens > self.batch_tokens:
+            self._flush()
+
+        future = asyncio.get_running_loop().create_future()
+        self._pending.append((text, future))
+        self._pending_tokens += tokens
+
+        if len(self._pending) >= self.batch_size:
+            self._flush()
+        elif self._timer is None:
+            self._timer = asyncio.get_running_loop().call_later(
+                BATCH_LINGER, self._flush
+            )
+        return future
+
+    def _flush(self) -> None:
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        if not self._pending:
+            return
+
+        batch, self._pending, self._pending_tokens = self._pending, [], 0
+        request = asyncio.create_task(self._send(batch))
+        self._requests.add(request)
+        request.add_done_callback(self._requests.discard)
+
+    async def _send(self, batch: List[Tuple[str, asyncio.Future]]) -> None:
+        queued = time.perf_counter()
+        async with self._semaphore:
+            logger.debug(f"Sending embedding request with {len(batch)} text(s)")
+            try:
+                with profile(
+                    "embedding request",
+                    wait=time.perf_counter() - queued,
+                    nbytes=sum(len(text.encode()) for text, _ in batch),
+                ):
+                    embeddings = await self.embedding_model.embed_documents(
+                        texts=[text for text, _ in batch]
+                    )
+                if len(embeddings) != len(batch):
+                    raise ValueError(
+                        f"Got {len(embeddings)} embedding(s) for {len(batch)} text(s)"
+                    )
+            except Exception as e:
+                # Hand the error to every document waiting on this batch
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                return
+
+        for (_, future), embedding in zip(batch, embeddings):
+            if not future.done():
+                future.set_result(embedding)
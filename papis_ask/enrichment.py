@@ -0,0 +1,158 @@
+"""Background enrichment of indexed documents with external metadata.
+
+External metadata providers (i.e. Semantic Scholar) are strictly rate
+limited. So that indexing doesn't slow down to their pace, documents are
+stored with their Papis metadata right away and queued for enrichment. The
+queue is kept in the index store, so lookups that didn't happen because the
+run was interrupted or kept being rate limited are retried by the next run.
+"""
+
+import asyncio
+import time
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple
+
+import papis.logging
+
+logger = papis.logging.get_logger(__name__)
+
+# Exponential backoff after being rate limited, in seconds
+BACKOFF_BASE = 2.0
+BACKOFF_MAX = 300.0
+
+
+class RateLimitError(Exception):
+    """Raised when a metadata provider rate limits us."""
+
+    def __init__(self, message: str, retry_after: Optional[float] = None) -> None:
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class TokenBucket:
+    """Rate limiter allowing `rate` requests per second, and bursts of `burst`."""
+
+    def __init__(self, rate: float, burst: float = 1) -> None:
+        self.rate = rate
+        self.capacity = max(1.0, burst)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+        self._lock = asyncio.Lock()
+
+    async def acquire(self) -> None:
+        """Wait until a request may be sent."""
+        if self.rate <= 0:
+            return
+        # waiting while holding the lock serves requests in order
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self.paused_until:
+                    await asyncio.sleep(self.paused_until - now)
+                    continue
+                self.tokens = min(
+                    self.capacity, self.tokens + (now - self.updated) * self.rate
+                )
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+    def pause(self, seconds: float) -> None:
+        """Hold back all requests for `seconds`, e.g. after being rate limited."""
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+        # start refilling once the pause is over
+        self.tokens = 0
+        self.updated = self.paused_until
+
+
+class MetadataEnricher:
+    """Queue of documents waiting for external metadata.
+
+    `enrich(dockey, query)` looks up and stores the metadata of a document and
+    returns whether it found any. Lookups that raise `RateLimitError` pause the
+    `rate_limiter` with an exponential backoff and are retried up to
+    `max_attempts` times. Lookups that fail, or that found nothing while
+    `retry_unresolved` is set, stay queued in the store for the next run.
+    """
+
+    def __init__(
+        self,
+        store: Any,
+        enrich: Callable[[str, Dict[str, Any]], Awaitable[bool]],
+        rate_limiter: TokenBucket,
+        concurrency: int,
+        max_attempts: int,
+        retry_unresolved: bool = False,
+    ) -> None:
+        self.store = store
+        self.enrich = enrich
+        self.rate_limiter = rate_limiter
+        self.concurrency = max(1, concurrency)
+        self.max_attempts = max(1, max_attempts)
+        self.retry_unresolved = retry_unresolved
+        self._queue: asyncio.Queue = asyncio.Queue()
+        self._workers: List[asyncio.Task] = []
+
+    def start(self) -> int:
+        """Start looking up metadata, beginning with the lookups left by earlier runs.
+
+        Returns the number of lookups left by earlier runs.
+        """
+        pending = self.store.get_enrichments()
+        for dockey, query in pending:
+            self._queue.put_nowait((dockey, query, 0))
+        self._workers = [
+            asyncio.create_task(self._work()) for _ in range(self.concurrency)
+        ]
+        return len(pending)
+
+    def enqueue(self, dockey: str, query: Dict[str, Any]) -> None:
+        """Queue a document for enrichment."""
+        self.store.queue_enrichment(dockey, query)
+        self._queue.put_nowait((dockey, query, 0))
+
+    async def aclose(self) -> None:
+        """Wait for the queued lookups to finish, then stop."""
+        if waiting := self._queue.qsize():
+            logger.info(f"Waiting for {waiting} metadata lookup(s)")
+        await self._queue.join()
+        for worker in self._workers:
+            worker.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+
+    async def _work(self) -> None:
+        while True:
+            item: Tuple[str, Dict[str, Any], int] = await self._queue.get()
+            try:
+                await self._process(*item)
+            finally:
+                self._queue.task_done()
+
+    async def _process(self, dockey: str, query: Dict[str, Any], attempts: int) -> None:
+        try:
+            found = await self.enrich(dockey, query)
+        except RateLimitError as e:
+            attempts += 1
+            delay = e.retry_after or min(
+                BACKOFF_MAX, BACKOFF_BASE * 2 ** (attempts - 1)
+            )
+            self.rate_limiter.pause(delay)
+            if attempts >= self.max_attempts:
+                logger.warning(
+                    f"Still rate limited after {attempts} attempt(s), metadata for"
+                    f" '{query.get('title') or dockey}' will be fetched next time"
+                )
+                return
+            logger.info(f"Rate limited, retrying metadata lookups in {delay:.0f}s")
+            self._queue.put_nowait((dockey, query, attempts))
+            return
+        except Exception as e:
+            logger.warning(
+                f"Failed to fetch metadata for '{query.get('title') or dockey}': {e}"
+            )
+            return
+
+        if found or not self.retry_unresolved:
+            self.store.finish_enrichment(dockey)
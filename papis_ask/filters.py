@@ -0,0 +1,109 @@
+"""Restricting questions to the indexed documents matching a Papis query.
+
+The metadata of every indexed document is kept in the index store as
+posting lists of (field, term) pairs, where the terms are the lowercased
+words of the field's value. A query is then answered by a few index
+lookups, without loading any document.
+
+Queries use the basic Papis query syntax: whitespace separated
+`field:value` pairs that all have to match, where a value without a field
+may match any field. Every word of a value has to start a word of the
+field, and numeric fields can be compared with e.g. `year:>2015` or
+`year:<=2020`. Values containing spaces have to be quoted.
+"""
+
+import re
+import shlex
+from typing import Any, Iterator, List, Optional, Set, Tuple
+
+# Fields of DocDetails indexed under the name of their Papis key
+DOC_DETAILS_FIELDS = {
+    "title": "title",
+    "authors": "author",
+    "year": "year",
+    "journal": "journal",
+    "doi": "doi",
+    "publisher": "publisher",
+    "volume": "volume",
+    "issue": "issue",
+}
+# Keys of `DocDetails.other` that are bookkeeping rather than metadata
+IGNORED_FIELDS = {
+    "file_last_indexed",
+    "metadata_last_updated",
+    "client_source",
+    "bibtex_source",
+    "files",
+}
+COMPARISON_PATTERN = re.compile(r"^(<=|>=|<|>)(-?\d+)$")
+
+
+class FilterError(Exception):
+    """Raised when a query is malformed or doesn't match any document."""
+
+
+def get_terms(value: Any) -> Iterator[str]:
+    """Get the lowercased words of a metadata value."""
+    if isinstance(value, dict):
+        value = list(value.values())
+    if isinstance(value, (list, tuple, set)):
+        for item in value:
+            yield from get_terms(item)
+    elif isinstance(value, (str, int, float)) and not isinstance(value, bool):
+        yield from (word.casefold() for word in re.findall(r"\w+", str(value)))
+
+
+def get_postings(doc: Any) -> Set[Tuple[str, str]]:
+    """Get the (field, term) pairs of a document's metadata."""
+    fields = [
+        (field, getattr(doc, name, None)) for name, field in DOC_DETAILS_FIELDS.items()
+    ]
+    fields.extend(
+        (key, value)
+        for key, value in (getattr(doc, "other", None) or {}).items()
+        if key not in IGNORED_FIELDS
+    )
+    return {
+        (field.casefold(), term)
+        for field, value in fields
+        if value is not None
+        for term in get_terms(value)
+    }
+
+
+def parse_filter(query: str) -> List[Tuple[Optional[str], str]]:
+    """Split a query into (field, value) pairs, with `None` for any field."""
+    try:
+        tokens = shlex.split(query)
+    except ValueError as e:
+        raise FilterError(f"Malformed query '{query}': {e}") from e
+
+    pairs: List[Tuple[Optional[str], str]] = []
+    for token in tokens:
+        field, sep, value = token.partition(":")
+        if sep and field:
+            pairs.append((field.casefold(), value))
+        else:
+            pairs.append((None, token))
+    return pairs
+
+
+def match_filter(store: Any, query: str) -> Optional[Set[str]]:
+    """Get the dockeys of the documents matching a query.
+
+    Returns `None` if the query doesn't restrict the documents at all.
+    """
+    dockeys: Optional[Set[str]] = None
+    for field, value in parse_filter(query):
+        if comparison := COMPARISON_PATTERN.match(value):
+            operator, number = comparison.groups()
+            found = store.compare_postings(field, operator, int(number))
+        else:
+            words = list(get_terms(value))
+            if not words:
+                continue
+            found = set.intersection(
+                *(store.match_postings(field, word) for word in words)
+            )
+        dockeys = found if dockeys is None else dockeys & found
+    return dockeys
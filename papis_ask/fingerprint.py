@@ -0,0 +1,91 @@
+"""Cheap detection of changed files.
+
+A file's fingerprint is its size, modification time and inode. Only when the
+fingerprint differs from the stored one is the file hashed, and only when
+the hash differs from the indexed content does the file need re-indexing.
+"""
+
+import hashlib
+import mmap
+import os
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Dict, Iterable, NamedTuple, Optional, Set, Tuple
+
+import papis.logging
+
+logger = papis.logging.get_logger(__name__)
+
+
+class Fingerprint(NamedTuple):
+    size: int
+    mtime_ns: int
+    inode: int
+
+
+def get_fingerprint(file_path: Path) -> Fingerprint:
+    """Get the fingerprint of a file."""
+    stat = os.stat(file_path)
+    return Fingerprint(stat.st_size, stat.st_mtime_ns, stat.st_ino)
+
+
+def file_md5(file_path: Path) -> str:
+    """Compute the md5 hash of a file (same as paperqa's `md5sum`).
+
+    The file is memory-mapped rather than read into memory, and hashlib
+    releases the GIL while hashing, so several files can be hashed in threads.
+    """
+    with open(file_path, "rb") as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return hashlib.md5(b"").hexdigest()
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+            return hashlib.md5(m).hexdigest()
+
+
+def hash_files(file_paths: Iterable[Path], jobs: int) -> Dict[Path, Optional[str]]:
+    """Hash files in parallel, with `None` for files that can't be read."""
+
+    def hash_file(file_path: Path) -> Tuple[Path, Optional[str]]:
+        try:
+            return file_path, file_md5(file_path)
+        except OSError as e:
+            logger.warning(f"Failed to hash {file_path}: {e}")
+            return file_path, None
+
+    with ThreadPoolExecutor(max_workers=max(1, jobs)) as executor:
+        return dict(executor.map(hash_file, file_paths))
+
+
+def find_changed_files(
+    indexed_files: Dict[Path, str],
+    fingerprints: Dict[str, Fingerprint],
+    jobs: int,
+) -> Tuple[Set[Path], Dict[Path, Fingerprint]]:
+    """Find the indexed files whose content changed since they were indexed.
+
+    `indexed_files` maps files to their dockey, the md5 hash of the indexed
+    content, and `fingerprints` maps files to their stored fingerprint.
+    Returns the changed files, and the new fingerprints of the files that
+    were touched but whose content is unchanged.
+    """
+    current: Dict[Path, Fingerprint] = {}
+    for file_path in indexed_files:
+        try:
+            current[file_path] = get_fingerprint(file_path)
+        except OSError:
+            continue
+    suspects = [
+        file_path
+        for file_path, fingerprint in current.items()
+        if fingerprints.get(str(file_path)) != fingerprint
+    ]
+    logger.debug(f"{len(suspects)} file(s) have a new fingerprint and will be hashed")
+
+    changed: Set[Path] = set()
+    touched: Dict[Path, Fingerprint] = {}
+    for file_path, md5 in hash_files(suspects, jobs).items():
+        if md5 == indexed_files[file_path]:
+            touched[file_path] = current[file_path]
+        else:
+            changed.add(file_path)
+    return changed, touched
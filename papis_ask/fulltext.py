@@ -0,0 +1,78 @@
+"""Full-text (BM25) index of the text chunks.
+
+The index is kept with tantivy, which is an optional dependency, so this
+module must only be imported where a missing tantivy can be handled. Every
+chunk is indexed with its row in the embedding matrix, which identifies it
+in the index store.
+"""
+
+import re
+import shutil
+from pathlib import Path
+from typing import Iterable, List, Tuple
+
+import tantivy
+
+WRITER_HEAP_SIZE = 64_000_000
+
+
+def build_schema() -> "tantivy.Schema":
+    builder = tantivy.SchemaBuilder()
+    builder.add_integer_field("row", stored=True, indexed=True, fast=True)
+    builder.add_text_field("dockey", tokenizer_name="raw")
+    builder.add_text_field("text")
+    return builder.build()
+
+
+def to_query_string(question: str) -> str:
+    """Turn a question into a query matching any of its words.
+
+    Only the words are kept, so that punctuation in questions isn't taken
+    for query syntax, and they're lowercased so that e.g. "AND" isn't taken
+    for an operator.
+    """
+    return " ".join(word.lower() for word in re.findall(r"\w+", question))
+
+
+class FullTextIndex:
+    """tantivy index of the text chunks in the index store."""
+
+    def __init__(self, path: Path) -> None:
+        self.path = path
+        path.mkdir(parents=True, exist_ok=True)
+        self.index = tantivy.Index(build_schema(), path=str(path))
+
+    @property
+    def num_docs(self) -> int:
+        self.index.reload()
+        return self.index.searcher().num_docs
+
+    def add(self, texts: Iterable[Tuple[int, str, str]]) -> int:
+        """Index (row, dockey, text) triples and return the last row indexed."""
+        last_row = -1
+        writer = self.index.writer(heap_size=WRITER_HEAP_SIZE)
+        for row, dockey, text in texts:
+            writer.add_document(tantivy.Document(row=row, dockey=dockey, text=text))
+            last_row = max(last_row, row)
+        writer.commit()
+        writer.wait_merging_threads()
+        return last_row
+
+    def clear(self) -> None:
+        shutil.rmtree(self.path, ignore_errors=True)
+        self.path.mkdir(parents=True)
+        self.index = tantivy.Index(build_schema(), path=str(self.path))
+
+    def search(self, question: str, limit: int) -> List[int]:
+        """Get the rows of the chunks best matching a question, best first."""
+        query_string = to_query_string(question)
+        if not query_string or limit <= 0:
+            return []
+
+        query, _ = self.index.parse_query_lenient(query_string, ["text"])
+        self.index.reload()
+        searcher = self.index.searcher()
+        return [
+            searcher.doc(address)["row"][0]
+            for _, address in searcher.search(query, limit).hits
+        ]
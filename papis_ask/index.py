@@ -0,0 +1,605 @@
+"""Loading, saving and updating the paperqa index."""
+
+import pickle
+import os
+import sqlite3
+import time
+from pathlib import Path
+from typing import Any, Dict, Iterable, List, Optional, Set, Tuple
+
+import papis.config
+from papis.config import get_lib
+import papis.logging
+from papis.utils import get_cache_home
+
+from papis_ask.answer_cache import AnswerCache, answer_cache_key
+from papis_ask.config import SECTION_NAME
+from papis_ask.fingerprint import Fingerprint
+from papis_ask.profiling import profile
+from papis_ask.store import QUANTIZED_PRECISIONS, IndexStore
+from papis_ask.summary_cache import SummaryCache
+
+logger = papis.logging.get_logger(__name__)
+
+_index_store: Optional[IndexStore] = None
+
+# Options that change the answer to a question but aren't part of the paperqa
+# settings, see `get_answer_cache_key`
+ANSWER_OPTIONS = (
+    "ann",
+    "ann-nprobe",
+    "fulltext-candidates",
+    "embedding-precision",
+    "embedding-rescore-factor",
+    "summary-timeout",
+    "summary-cache-similarity",
+)
+
+
+def remove_document_from_index(docs_index: Any, dockey: str) -> Tuple[str, str]:
+    """Remove a document from the index."""
+    # Get the document from the index
+    doc = docs_index.docs.get(dockey)
+
+    # Get file_location if it exists
+    file_location = doc.file_location
+    ref = doc.other["ref"]
+
+    # Get docname for removal
+    docname = doc.docname
+
+    # Remove document from index
+    docs_index.delete(dockey=dockey)
+    docs_index.deleted_dockeys.remove(dockey)
+    docs_index.docnames.remove(docname)
+    with profile("remove", file_location):
+        get_index_store().delete_document(dockey)
+
+    return file_location, ref
+
+
+async def update_index_metadata(
+    file_path: Path,
+    file_last_indexed: float,
+    dockey: str,
+    docname: str,
+    doc_papis: Dict[str, Any],
+    docs_index: Any,
+    clients: Any,
+    settings: Any,
+    texts: Optional[List[Any]] = None,
+) -> Optional[str]:
+    """Update metadata for a file in the paperqa index.
+
+    `texts` are the document's Texts held in memory, if any. The index is
+    loaded without texts when indexing, so only the Texts of documents added
+    in the current run have to be updated.
+    """
+    # Extract metadata from Papis document
+    ref, papis_id, _ = extract_doc_papis_metadata(doc_papis)
+
+    # Fetch document details from metadata client
+    with profile("metadata/papis", file_path):
+        doc_details = await clients["papis"].query(
+            settings=settings,
+            papis_id=papis_id,
+            file_location=str(file_path),
+            file_last_indexed=file_last_indexed,
+            metadata_last_updated=time.time(),
+        )
+    if doc_details:
+        doc_details.fields_to_overwrite_from_metadata = {
+            "citation"
+        }  # Restrict what can be overwritten, needed for below
+        doc_details.doc_id = dockey
+        doc_details.dockey = dockey
+        doc_details.docname = docname
+        doc_details.key = docname
+
+        # Overwrite the Doc with a DocDetails
+        docs_index.docs[dockey] = doc_details
+
+        # Update doc reference in the Text objects that point to this document
+        for text in texts or []:
+            text.doc = doc_details
+
+        # Save the updated document (stored texts refer to it by dockey)
+        with profile("metadata/save", file_path):
+            save_document(doc_details, texts or [])
+
+        # External metadata is rate limited, so it's added in the background
+        clients["enricher"].enqueue(dockey, get_enrichment_query(doc_details))
+        return ref
+
+
+def get_enrichment_query(doc_details: Any) -> Dict[str, Any]:
+    """Get the external metadata query for a document's Papis metadata."""
+    return {
+        key: value
+        for key, value in {
+            # we can do this being sure that the fields exist as PapisProvider
+            # assigns `None` if a value doesn't exist
+            "title": doc_details["title"],
+            "doi": doc_details["doi"],
+            "authors": doc_details["authors"],
+            "journal": doc_details["journal"],
+        }.items()
+        if value is not None
+    }
+
+
+async def enrich_document(
+    dockey: str,
+    query: Dict[str, Any],
+    docs_index: Any,
+    clients: Any,
+    settings: Any,
+) -> bool:
+    """Add external metadata to a stored document.
+
+    Returns whether any metadata was found.
+    """
+    other_details = await clients["other"].query(
+        settings=settings,
+        # we don't need the doi, title, and authors but they are needed
+        # for semantic scholar search
+        fields=[
+            "citation_count",
+            "source_quality",
+            "is_retracted",
+            "doi",
+            "title",
+            "authors",
+        ],
+        **query,
+    )
+    if not other_details:
+        return False
+
+    store = get_index_store()
+    doc = store.get_doc(dockey)
+    if doc is None:
+        # removed from the index in the meantime
+        return True
+
+    doc_details = other_details + doc
+    doc_details.fields_to_overwrite_from_metadata = {"citation"}
+    doc_details.doc_id = dockey
+    doc_details.dockey = dockey
+    doc_details.docname = doc.docname
+    doc_details.key = doc.docname
+
+    if dockey in docs_index.docs:
+        docs_index.docs[dockey] = doc_details
+    store.save_doc(doc_details)
+    return True
+
+
+def get_index_file() -> Path:
+    """Get the path of the paperqa index file."""
+    return Path(get_cache_home()) / "{}.qa.sqlite".format(get_lib().name)
+
+
+def get_legacy_index_file() -> Path:
+    """Get the path of the pickled paperqa index used by earlier versions."""
+    return Path(get_cache_home()) / "{}.qa".format(get_lib().name)
+
+
+def get_embedding_cache_file() -> Path:
+    """Get the path of the embedding cache, which is shared by all libraries."""
+    return Path(get_cache_home()) / "ask-embeddings.sqlite"
+
+
+def get_metadata_cache_file() -> Path:
+    """Get the path of the metadata cache, which is shared by all libraries."""
+    return Path(get_cache_home()) / "ask-metadata.sqlite"
+
+
+def get_socket_file() -> Path:
+    """Get the path of the socket the query daemon listens on."""
+    return Path(get_cache_home()) / "{}.ask.sock".format(get_lib().name)
+
+
+def get_answer_cache_file() -> Path:
+    """Get the path of the answer cache of the library."""
+    return Path(get_cache_home()) / "{}.ask-answers.sqlite".format(get_lib().name)
+
+
+def get_summary_cache_file() -> Path:
+    """Get the path of the evidence summary cache, which is shared by all libraries."""
+    return Path(get_cache_home()) / "ask-summaries.sqlite"
+
+
+def get_last_modified(file_path: Path) -> float:
+    """Get the last modified time of a file."""
+    return os.path.getmtime(file_path)
+
+
+def get_index_store() -> IndexStore:
+    """Open the index store, migrating a pickled index if necessary."""
+    global _index_store
+
+    file = get_index_file()
+    if _index_store is None or _index_store.path != file:
+        _index_store = IndexStore(file)
+        migrate_legacy_index(_index_store)
+    return _index_store
+
+
+def migrate_legacy_index(store: IndexStore) -> None:
+    """Move the documents of a pickled index into the index store."""
+    legacy_file = get_legacy_index_file()
+    if not legacy_file.exists() or not store.is_empty():
+        return
+
+    logger.info(f"Migrating index from {legacy_file} to {store.path}")
+    with open(legacy_file, "rb") as f:
+        store.replace_all(pickle.load(f))
+
+    # Keep the old index around in case something went wrong
+    legacy_file.rename(legacy_file.with_name(legacy_file.name + ".bak"))
+
+
+def get_index_generation() -> Optional[int]:
+    """Get the number of changes made to the index, or `None` if there's none."""
+    if not get_index_file().exists():
+        return None
+    return get_index_store().get_generation()
+
+
+def get_answer_cache() -> Optional[AnswerCache]:
+    """Open the answer cache for the current state of the index.
+
+    Returns `None` if there's no index, whose answers could be cached.
+    """
+    generation = get_index_generation()
+    if generation is None:
+        return None
+    max_megabytes = papis.config.getint("answer-cache-size", SECTION_NAME) or 0
+    return AnswerCache(get_answer_cache_file(), generation, max_megabytes * 1024 * 1024)
+
+
+def get_answer_cache_key(
+    question: str,
+    settings: Any,
+    exact: bool,
+    retrieval: Optional[str],
+    rerank_keep: int,
+    filter_query: Optional[str],
+) -> bytes:
+    """Get the answer cache key of a question answered with `settings`.
+
+    The paperqa settings, which include the models, prompts and answer
+    options, are keyed by their hash.
+    """
+    return answer_cache_key(
+        question,
+        {
+            "settings": settings.md5,
+            "exact": exact,
+            "retrieval": retrieval,
+            "rerank_keep": rerank_keep,
+            "filter": filter_query,
+            **{name: papis.config.get(name, SECTION_NAME) for name in ANSWER_OPTIONS},
+        },
+    )
+
+
+def get_summary_cache() -> Optional[SummaryCache]:
+    """Open the evidence summary cache, unless it's disabled."""
+    if not papis.config.getboolean("summary-cache", SECTION_NAME):
+        return None
+    max_megabytes = papis.config.getint("summary-cache-size", SECTION_NAME) or 0
+    return SummaryCache(
+        get_summary_cache_file(),
+        max_bytes=max_megabytes * 1024 * 1024,
+        similarity=papis.config.getfloat("summary-cache-similarity", SECTION_NAME),
+    )
+
+
+# NOTE: no types because we'd have to globally import Docs
+def get_index(with_texts: bool = True):
+    """Load the paperqa index from disk, optionally without the Texts."""
+    if not get_index_file().exists() and not get_legacy_index_file().exists():
+        return None
+    try:
+        store = get_index_store()
+        if store.is_empty():
+            return None
+        return store.load(with_texts=with_texts)
+    except (OSError, sqlite3.Error, pickle.PickleError) as e:
+        logger.error(f"Failed to load index: {e}")
+        raise
+
+
+# NOTE: no types because we'd have to globally import Docs
+def get_query_index(exact: bool = False, retrieval: Optional[str] = None):
+    """Load the paperqa index for answering questions.
+
+    Only the embedding matrix is memory-mapped. Texts and their documents are
+    loaded from the index store once they are retrieved. Unless `exact` is
+    set, the approximate nearest neighbour index is used if there is one.
+    `retrieval` is one of "dense", "prefilter" and "fusion" (see
+    `MemmapVectorStore`) and defaults to the `retrieval` setting.
+    """
+    if not get_index_file().exists() and not get_legacy_index_file().exists():
+        return None
+    try:
+        store = get_index_store()
+        if store.is_empty():
+            return None
+
+        from paperqa import Docs
+        from papis_ask.vectors import MemmapVectorStore
+
+        nprobe = (
+            0
+            if exact or not papis.config.getboolean("ann", SECTION_NAME)
+            else papis.config.getint("ann-nprobe", SECTION_NAME) or 0
+        )
+        if retrieval is None:
+            retrieval = papis.config.getstring("retrieval", SECTION_NAME)
+        return Docs(
+            texts_index=MemmapVectorStore.from_store(
+                store,
+                nprobe=nprobe,
+                retrieval=retrieval,
+                fulltext_candidates=papis.config.getint(
+                    "fulltext-candidates", SECTION_NAME
+                )
+                or 0,
+                precision=papis.config.getstring("embedding-precision", SECTION_NAME),
+                rescore_factor=papis.config.getint(
+                    "embedding-rescore-factor", SECTION_NAME
+                )
+                or 1,
+            )
+        )
+    except (OSError, sqlite3.Error) as e:
+        logger.error(f"Failed to load index: {e}")
+        raise
+
+
+# NOTE: no types because we'd have to globally import Docs
+def filter_query_index(docs_index, query: str):
+    """Restrict a query index to the documents matching a Papis query.
+
+    Raises `FilterError` if the query is malformed or no document matches.
+    """
+    from paperqa import Docs
+    from papis_ask.filters import FilterError, match_filter
+
+    store = get_index_store()
+    dockeys = match_filter(store, query)
+    if dockeys is None:
+        return docs_index
+    if not dockeys:
+        raise FilterError(f"No indexed documents match '{query}'")
+    logger.debug(f"Restricting the question to {len(dockeys)} document(s)")
+    return Docs(
+        texts_index=docs_index.texts_index.restricted_to(store.get_rows(dockeys))
+    )
+
+
+def update_ann_index() -> None:
+    """Train or extend the approximate nearest neighbour index.
+
+    Libraries with fewer than `ann-min-chunks` chunks are searched exactly,
+    which is fast enough, so they don't get an index.
+    """
+    store = get_index_store()
+    matrix = store.embeddings.open()
+    min_chunks = papis.config.getint("ann-min-chunks", SECTION_NAME) or 0
+    if not papis.config.getboolean("ann", SECTION_NAME) or len(matrix) < min_chunks:
+        if store.ann_path.exists():
+            store.ann_path.unlink()
+            store.bump_generation()
+        return
+
+    from papis_ask.ann import IVFIndex
+
+    ann = IVFIndex.load(store.ann_path)
+    if ann is None or ann.needs_training(len(matrix)):
+        logger.info(f"Building nearest neighbour index of {len(matrix)} chunks")
+        ann = IVFIndex.train(matrix)
+    else:
+        ann.update(matrix)
+    ann.save(store.ann_path)
+    store.bump_generation()
+
+
+def update_quantized_index() -> None:
+    """Extend the reduced-precision copy of the embedding matrix.
+
+    The copy is only kept with an `embedding-precision` other than float32.
+    """
+    store = get_index_store()
+    precision = papis.config.getstring("embedding-precision", SECTION_NAME)
+    for other in QUANTIZED_PRECISIONS:
+        if other != precision:
+            store.get_quantized(other).clear()
+    if precision not in QUANTIZED_PRECISIONS:
+        if precision != "float32":
+            logger.error(f"Unknown embedding precision '{precision}'")
+        return
+
+    if added := store.get_quantized(precision).update(store.embeddings.open()):
+        logger.debug(f"Stored {added} embedding(s) as {precision}")
+        store.bump_generation()
+
+
+def update_fulltext_index() -> None:
+    """Add the texts stored since the last run to the full-text index.
+
+    This requires tantivy, which is optional. The index is rebuilt once it
+    mostly consists of texts that were removed from the index store.
+    """
+    if not papis.config.getboolean("fulltext", SECTION_NAME):
+        return
+    try:
+        from papis_ask.fulltext import FullTextIndex
+    except ImportError:
+        logger.debug("tantivy is not installed, so there's no full-text index")
+        return
+
+    store = get_index_store()
+    fulltext = FullTextIndex(store.fulltext_path)
+    next_row = int(store.get_meta("fulltext_next_row") or 0)
+    if fulltext.num_docs > 2 * len(store.get_rows()):
+        logger.info("Rebuilding the full-text index")
+        fulltext.clear()
+        next_row = 0
+
+    last_row = fulltext.add(store.get_texts_from_row(next_row))
+    if last_row >= next_row:
+        store.save_meta("fulltext_next_row", last_row + 1)
+        store.bump_generation()
+
+
+def get_index_size() -> int:
+    """Get the size of the index store and the files kept next to it in bytes."""
+    store = get_index_store()
+    files = [Path(f"{store.path}{suffix}") for suffix in ("", "-wal", "-shm")] + [
+        store.embeddings.path,
+        store.ann_path,
+    ]
+    for precision in QUANTIZED_PRECISIONS:
+        quantized = store.get_quantized(precision)
+        files.extend([quantized.path, quantized.scales_path])
+    if store.fulltext_path.exists():
+        files.extend(store.fulltext_path.rglob("*"))
+    return sum(file.stat().st_size for file in files if file.is_file())
+
+
+def time_query_index_load() -> float:
+    """Time loading the index for answering questions, in seconds."""
+    import importlib
+
+    # imports aren't part of loading the index once the daemon runs
+    for module in ("paperqa", "papis_ask.vectors", "papis_ask.ann"):
+        importlib.import_module(module)
+
+    start = time.perf_counter()
+    get_query_index()
+    return time.perf_counter() - start
+
+
+def compact_index() -> None:
+    """Compact the index store and rebuild the indexes of its embedding matrix."""
+    store = get_index_store()
+    size, load_time = get_index_size(), time_query_index_load()
+    removed = store.compact()
+    for kind, count in removed.items():
+        if count:
+            logger.info(f"Removed {count} {kind}")
+
+    update_ann_index()
+    update_quantized_index()
+    update_fulltext_index()
+    logger.info(
+        f"Index size: {size / 1024**2:.1f} MB -> {get_index_size() / 1024**2:.1f} MB"
+    )
+    logger.info(f"Load time: {load_time:.2f} s -> {time_query_index_load():.2f} s")
+
+    legacy_file = get_legacy_index_file()
+    legacy_backup = legacy_file.with_name(legacy_file.name + ".bak")
+    if legacy_backup.exists():
+        logger.info(
+            f"The backup of the index of earlier versions ({legacy_backup}) is"
+            " no longer needed and can be deleted"
+        )
+
+
+# NOTE: no types because we'd have to globally import Docs
+def save_index(docs):
+    """Save the whole paperqa index to disk, replacing what's stored."""
+    try:
+        get_index_store().replace_all(docs)
+    except (OSError, sqlite3.Error) as e:
+        logger.error(f"Failed to save index: {e}")
+        raise
+
+
+def save_document(doc: Any, texts: List[Any]) -> None:
+    """Save a single document of the paperqa index to disk."""
+    try:
+        store = get_index_store()
+        if store.has_texts(doc.dockey):
+            # Only the metadata changed
+            store.save_doc(doc)
+        else:
+            store.save_document(doc, texts)
+    except (OSError, sqlite3.Error) as e:
+        logger.error(f"Failed to save document: {e}")
+        raise
+
+
+def get_fingerprints() -> Dict[str, Fingerprint]:
+    """Get the stored fingerprints of the indexed files."""
+    return get_index_store().get_fingerprints()
+
+
+def save_fingerprints(fingerprints: Iterable[Tuple[Path, str, Fingerprint]]) -> None:
+    """Save the fingerprints of indexed (file path, dockey, fingerprint) triples."""
+    get_index_store().save_fingerprints(
+        (str(file_path), dockey, fingerprint)
+        for file_path, dockey, fingerprint in fingerprints
+    )
+
+
+def extract_doc_papis_metadata(
+    doc_papis,
+) -> tuple[str, str, Optional[str]]:
+    """Extract standard metadata from a papis document."""
+    ref: str = doc_papis.get("ref") or ""
+    papis_id: str = doc_papis.get("papis_id")
+    # fallback ref based on papis_id
+    if ref.strip() == "":
+        ref = papis_id
+
+    doi: Optional[str] = doc_papis.get("doi")
+
+    return ref, papis_id, doi
+
+
+def determine_file_status(
+    file_path: Path,
+    info_yaml_path: Path,
+    index_files_to_dockey: Dict[str, str],
+    docs_index: Any,
+    changed_files: Set[Path],
+) -> Tuple[bool, bool]:
+    """Determine if a file needs to be re-indexed or just have its metadata updated.
+
+    `changed_files` are the indexed files whose content changed (see
+    `find_changed_files`).
+    """
+    dockey = index_files_to_dockey.get(str(file_path))
+
+    # If file isn't in the index, it needs indexing
+    if dockey is None:
+        return True, False
+
+    doc = docs_index.docs.get(dockey)
+    if doc is None:
+        return True, False
+
+    # Get timestamps
+    info_yaml_last_modified = (
+        get_last_modified(info_yaml_path) if info_yaml_path.exists() else 0
+    )
+
+    # Get stored timestamps
+    metadata_last_updated = getattr(doc, "other", {}).get("metadata_last_updated", 0)
+
+    # Check if file content has changed since last indexing
+    needs_indexing = file_path in changed_files
+
+    # Check if metadata has changed since last update
+    needs_metadata_update = info_yaml_last_modified > metadata_last_updated
+
+    # If we need to re-index, we don't need to separately update metadata
+    if needs_indexing:
+        needs_metadata_update = False
+
+    return needs_indexing, needs_metadata_update
@@ -1,26 +1,20 @@
-import pickle
-import os
-import time
+import json
+import sys
+from contextlib import nullcontext
 from pathlib import Path
-from typing import Any, Dict, Optional, Set, Tuple
+from typing import Any, Callable, Dict, Optional, Set, Tuple
 
 import papis.cli
 import papis.config
-from papis.config import get_lib
-from papis.api import get_all_documents_in_lib
 import papis.logging
-from papis.utils import get_cache_home
 
 import click
 from click_default_group import DefaultGroup
-import asyncio
 
-from papis_ask.config import SECTION_NAME, create_paper_qa_settings
-from papis_ask.output import (
-    to_terminal_output,
-    to_json_output,
-    to_markdown_output,
-)
+# Every papis command loads this module to find its subcommands, including
+# shell completion, so anything beyond click and the papis configuration is
+# imported by the subcommands themselves (see tests/test_import_time.py)
+from papis_ask.config import SECTION_NAME
 
 logger = papis.logging.get_logger(__name__)
 
@@ -29,236 +23,6 @@ settings = None
 FILE_ENDINGS = (".pdf", ".txt", ".html")
 
 
-def remove_document_from_index(docs_index: Any, dockey: str) -> Tuple[str, str]:
-    """Remove a document from the index."""
-    # Get the document from the index
-    doc = docs_index.docs.get(dockey)
-
-    # Get file_location if it exists
-    file_location = doc.file_location
-    ref = doc.other["ref"]
-
-    # Get docname for removal
-    docname = doc.docname
-
-    # Remove document from index
-    docs_index.delete(dockey=dockey)
-    docs_index.deleted_dockeys.remove(dockey)
-    docs_index.docnames.remove(docname)
-
-    return file_location, ref
-
-
-async def add_file_to_index(
-    file_path: Path,
-    doc_papis: Dict[str, Any],
-    docs_index: Any,
-    clients: Any,
-    settings: Any,
-) -> Optional[str]:
-    """Add a file to the paperqa index."""
-    from paperqa.utils import md5sum
-
-    dockey = md5sum(file_path)
-
-    _, papis_id, _ = extract_doc_papis_metadata(doc_papis)
-
-    try:
-        if (
-            docname := await docs_index.aadd(
-                file_path,
-                dockey=dockey,
-                docname=papis_id,  # to give somewhat sensible docnames (we don't depend on it)
-                citation=papis_id,  # to avoid unnecessary llm calls
-                settings=settings,
-            )
-        ):
-            if ref := await update_index_metadata(
-                file_path=file_path,
-                file_last_indexed=time.time(),
-                dockey=dockey,
-                docname=docname,
-                doc_papis=doc_papis,
-                docs_index=docs_index,
-                clients=clients,
-                settings=settings,
-            ):
-                return ref
-            else:
-                logger.warning("Couldn't upgrade Doc to DocDetails.")
-                logger.warning("Usually, this means the 'info.yaml' has faults.")
-
-    except ValueError as e:
-        if "This does not look like a text document" in str(e):
-            logger.warning(f"File not recognised as text document: {file_path}")
-            logger.warning("Usually, this means the file is faulty or not ocr'ed")
-        else:
-            # Re-raise other ValueErrors
-            raise
-
-    return None
-
-
-async def update_index_metadata(
-    file_path: Path,
-    file_last_indexed: float,
-    dockey: str,
-    docname: str,
-    doc_papis: Dict[str, Any],
-    docs_index: Any,
-    clients: Any,
-    settings: Any,
-) -> Optional[str]:
-    """Update metadata for a file in the paperqa index."""
-    # Extract metadata from Papis document
-    ref, papis_id, _ = extract_doc_papis_metadata(doc_papis)
-
-    # Fetch document details from metadata client
-    if doc_details := await clients["papis"].query(
-        settings=settings,
-        papis_id=papis_id,
-        file_location=str(file_path),
-        file_last_indexed=file_last_indexed,
-        metadata_last_updated=time.time(),
-    ):
-        query_args = {
-            "settings": settings,
-            # we don't need the doi, title, and authors but they are needed
-            # for semantic scholar search
-            "fields": [
-                "citation_count",
-                "source_quality",
-                "is_retracted",
-                "doi",
-                "title",
-                "authors",
-            ],
-            **{
-                key: value
-                for key, value in {
-                    # we can do this being sure that the fields exist as PapisProvider
-                    # assigns `None` if a value doesn't exist
-                    "title": doc_details["title"],
-                    "doi": doc_details["doi"],
-                    "authors": doc_details["authors"],
-                    "journal": doc_details["journal"],
-                }.items()
-                if value is not None
-            },
-        }
-        if other_details := await clients["other"].query(**query_args):
-            doc_details = other_details + doc_details
-        doc_details.fields_to_overwrite_from_metadata = {
-            "citation"
-        }  # Restrict what can be overwritten, needed for below
-        doc_details.doc_id = dockey
-        doc_details.dockey = dockey
-        doc_details.docname = docname
-        doc_details.key = docname
-
-        # Overwrite the Doc with a DocDetails
-        docs_index.docs[dockey] = doc_details
-
-        # Update doc reference in all Text objects that point to this document
-        for text in docs_index.texts:
-            if text.doc.dockey == dockey:
-                text.doc = doc_details
-
-        # Save the updated index
-        save_index(docs_index)
-        return ref
-
-
-def get_index_file() -> Path:
-    """Get the path of the paperqa index file."""
-    return Path(get_cache_home()) / "{}.qa".format(get_lib().name)
-
-
-def get_last_modified(file_path: Path) -> float:
-    """Get the last modified time of a file."""
-    return os.path.getmtime(file_path)
-
-
-# NOTE: no types because we'd have to globally import Docs
-def get_index():
-    """Load the paperqa index from disk."""
-    file = get_index_file()
-    try:
-        if file.exists():
-            with open(file, "rb") as f:
-                return pickle.load(f)
-        return None
-    except (OSError, pickle.PickleError) as e:
-        logger.error(f"Failed to load index: {e}")
-        raise
-
-
-# NOTE: no types because we'd have to globally import Docs
-def save_index(docs):
-    """Save the paperqa index to disk."""
-    try:
-        with open(get_index_file(), "wb") as f:
-            pickle.dump(docs, f)
-    except OSError as e:
-        logger.error(f"Failed to save index: {e}")
-        raise
-
-
-def extract_doc_papis_metadata(
-    doc_papis,
-) -> tuple[str, str, Optional[str]]:
-    """Extract standard metadata from a papis document."""
-    ref: str = doc_papis.get("ref") or ""
-    papis_id: str = doc_papis.get("papis_id")
-    # fallback ref based on papis_id
-    if ref.strip() == "":
-        ref = papis_id
-
-    doi: Optional[str] = doc_papis.get("doi")
-
-    return ref, papis_id, doi
-
-
-def determine_file_status(
-    file_path: Path,
-    info_yaml_path: Path,
-    index_files_to_dockey: Dict[str, str],
-    docs_index: Any,
-) -> Tuple[bool, bool]:
-    """Determine if a file needs to be re-indexed or just have its metadata updated."""
-    dockey = index_files_to_dockey.get(str(file_path))
-
-    # If file isn't in the index, it needs indexing
-    if dockey is None:
-        return True, False
-
-    doc = docs_index.docs.get(dockey)
-    if doc is None:
-        return True, False
-
-    # Get timestamps
-    file_last_modified = get_last_modified(file_path)
-    info_yaml_last_modified = (
-        get_last_modified(info_yaml_path) if info_yaml_path.exists() else 0
-    )
-
-    # Get stored timestamps
-    file_last_indexed = getattr(doc, "other", {}).get("file_last_indexed", 0)
-    metadata_last_updated = getattr(doc, "other", {}).get("metadata_last_updated", 0)
-
-    # Check if file content has changed since last indexing
-    needs_indexing = file_last_modified > file_last_indexed
-
-    # Check if metadata has changed since last update
-    needs_metadata_update = info_yaml_last_modified > metadata_last_updated
-
-    # If we need to re-index, we don't need to separately update metadata
-    if needs_indexing:
-        needs_metadata_update = False
-
-    return needs_indexing, needs_metadata_update
-
-
 @click.group("ask", cls=DefaultGroup, default="query", default_if_no_args=True)
 @click.help_option("-h", "--help")
 def cli():
@@ -309,6 +73,39 @@ def cli():
     help="Show context including excerpt for each source.",
     default=lambda: papis.config.getboolean("excerpt", SECTION_NAME),
 )
+@click.option(
+    "--exact",
+    help="Search all chunks rather than using the nearest neighbour index.",
+    is_flag=True,
+    default=False,
+)
+@click.option(
+    "--retrieval",
+    "-r",
+    help="How to find evidence: by embeddings only, or also by the question's words.",
+    type=click.Choice(["dense", "prefilter", "fusion"]),
+    default=lambda: papis.config.getstring("retrieval", SECTION_NAME),
+)
+@click.option(
+    "--rerank-keep",
+    "-k",
+    help="Number of retrieved chunks to summarize after reranking them (0 for all).",
+    type=int,
+    default=lambda: papis.config.getint("rerank-keep", SECTION_NAME),
+)
+@click.option(
+    "--filter",
+    "-f",
+    "filter_query",
+    help="Only use the documents matching a Papis query, e.g. 'author:smith year:>2015'.",
+    type=str,
+    default=None,
+)
+@papis.cli.bool_flag(
+    "--cache/--no-cache",
+    help="Reuse the answer to the same question if the index hasn't changed.",
+    default=lambda: papis.config.getboolean("answer-cache", SECTION_NAME),
+)
 def query_cmd(
     query: str,
     output: str,
@@ -317,39 +114,425 @@ def query_cmd(
     answer_length: str,
     context: bool,
     excerpt: bool,
+    exact: bool,
+    retrieval: str,
+    rerank_keep: int,
+    filter_query: Optional[str],
+    cache: bool,
 ) -> None:
     """Ask questions about your library."""
+    from papis_ask.daemon import DaemonError, query_daemon
+    from papis_ask.filters import FilterError
+    from papis_ask.index import get_socket_file
+    from papis_ask.output import (
+        StreamingTerminalOutput,
+        to_json_output,
+        to_markdown_output,
+        to_terminal_output,
+    )
+
     logger.debug(
-        f"Starting 'ask' with query={query}, output={output}, evidence_k={evidence_k}, max_sources={max_sources}, answer_length={answer_length}, context={context}, excerpt={excerpt} "
+        f"Starting 'ask' with query={query}, output={output}, evidence_k={evidence_k}, max_sources={max_sources}, answer_length={answer_length}, context={context}, excerpt={excerpt}, exact={exact}, retrieval={retrieval}, rerank_keep={rerank_keep}, filter={filter_query}, cache={cache} "
+    )
+
+    if evidence_k <= max_sources:
+        logger.error("evidence_k must be larger than max_source")
+        return
+    if 0 < rerank_keep <= max_sources:
+        logger.error("rerank_keep must be larger than max_source")
+        return
+
+    # only the terminal output is shown while the answer is generated
+    stream = StreamingTerminalOutput(query) if output == "terminal" else None
+    on_evidence = stream.set_refs if stream else None
+    on_token = stream.add_token if stream else None
+    on_start = stream.start if stream else None
+    answer = None
+    try:
+        try:
+            answer = query_daemon(
+                get_socket_file(),
+                {
+                    "query": query,
+                    "evidence_k": evidence_k,
+                    "max_sources": max_sources,
+                    "answer_length": answer_length,
+                    "exact": exact,
+                    "retrieval": retrieval,
+                    "rerank_keep": rerank_keep,
+                    "filter": filter_query,
+                    "cache": cache,
+                },
+                on_evidence=on_evidence,
+                on_token=on_token,
+                on_start=on_start,
+            )
+        except DaemonError as e:
+            logger.error(f"The daemon failed to answer: {e}")
+            return
+
+        if answer is None:
+            answer = _query_in_process(
+                query,
+                evidence_k,
+                max_sources,
+                answer_length,
+                exact,
+                retrieval,
+                rerank_keep,
+                filter_query,
+                cache,
+                on_evidence=on_evidence,
+                on_token=on_token,
+                on_start=on_start,
+            )
+    except FilterError as e:
+        logger.error(str(e))
+        return
+    finally:
+        # otherwise, `stream.finish` draws the answer before stopping
+        if stream is not None and answer is None:
+            stream.stop()
+
+    if answer is None:
+        logger.info(
+            "The index is empty. Please index some files before asking question."
+        )
+        return
+
+    if output == "json":
+        output = to_json_output(answer)
+        print(output)
+    elif output == "markdown":
+        output = to_markdown_output(answer, context, excerpt)
+        print(output)
+    elif stream is not None:
+        stream.finish(answer, context, excerpt)
+    else:
+        to_terminal_output(answer, context, excerpt)
+
+
+def _query_in_process(
+    query: str,
+    evidence_k: int,
+    max_sources: int,
+    answer_length: str,
+    exact: bool,
+    retrieval: str,
+    rerank_keep: int,
+    filter_query: Optional[str],
+    cache: bool,
+    on_evidence: Optional[Callable[[Dict[str, str]], None]] = None,
+    on_token: Optional[Callable[[str], None]] = None,
+    on_start: Optional[Callable[[], None]] = None,
+) -> Optional[Any]:
+    import asyncio
+
+    from papis_ask.config import create_paper_qa_settings
+    from papis_ask.daemon import to_plain_answer
+    from papis_ask.index import (
+        filter_query_index,
+        get_answer_cache,
+        get_answer_cache_key,
+        get_query_index,
+        get_summary_cache,
     )
+    from papis_ask.query import answer_question
 
     settings = create_paper_qa_settings()
     settings.answer.answer_max_sources = max_sources
     settings.answer.evidence_k = evidence_k
     settings.answer.answer_length = answer_length
 
-    if evidence_k <= max_sources:
-        logger.error("evidence_k must be larger than max_source")
-        return
+    answer_cache = get_answer_cache() if cache else None
+    summary_cache = None
+    try:
+        cache_key = get_answer_cache_key(
+            query, settings, exact, retrieval, rerank_keep, filter_query
+        )
+        if (
+            answer_cache is not None
+            and (answer := answer_cache.get(cache_key)) is not None
+        ):
+            logger.debug("Using the cached answer")
+            # it may have been asked differently, see `normalize_question`
+            answer.question = query
+            return answer
+
+        docs_index = get_query_index(exact=exact, retrieval=retrieval)
+        if not docs_index:
+            return None
+        if filter_query:
+            docs_index = filter_query_index(docs_index, filter_query)
+        summary_cache = get_summary_cache()
+        answer = asyncio.run(
+            answer_question(
+                docs_index,
+                query,
+                settings,
+                on_evidence=on_evidence,
+                on_token=on_token,
+                summary_cache=summary_cache,
+                rerank_keep=rerank_keep,
+                on_start=on_start,
+            )
+        )
+        if answer_cache is not None:
+            answer_cache.put(cache_key, to_plain_answer(answer))
+        return answer
+    finally:
+        if summary_cache is not None:
+            summary_cache.close()
+        if answer_cache is not None:
+            answer_cache.close()
 
-    docs_index = get_index()
 
-    if docs_index:
-        answer = docs_index.query(query, settings=settings)
+@cli.command("serve")
+@click.help_option("--help", "-h")
+def serve_cmd() -> None:
+    """Keep the index loaded to answer questions faster."""
+    import asyncio
 
-        if output == "json":
-            output = to_json_output(answer)
-            print(output)
-        elif output == "markdown":
-            output = to_markdown_output(answer, context, excerpt)
-            print(output)
-        else:
-            to_terminal_output(answer, context, excerpt)
+    from papis_ask.daemon import DaemonError, serve
+    from papis_ask.index import get_index_file, get_socket_file
 
-    else:
-        logger.info(
-            "The index is empty. Please index some files before asking question."
+    try:
+        asyncio.run(serve(get_socket_file(), get_index_file()))
+    except DaemonError as e:
+        logger.error(str(e))
+    except KeyboardInterrupt:
+        pass
+
+
+@cli.command("batch")
+@click.argument(
+    "questions_file",
+    type=click.Path(exists=True, dir_okay=False, path_type=Path),
+)
+@click.help_option("--help", "-h")
+@click.option(
+    "--output",
+    "-o",
+    "output_file",
+    help="File to append the answers to. Questions answered in it are skipped.",
+    type=click.Path(dir_okay=False, path_type=Path),
+    default=None,
+)
+@click.option(
+    "--jobs",
+    "-j",
+    help="Number of questions answered at once.",
+    type=int,
+    default=lambda: papis.config.getint("batch-concurrency", SECTION_NAME),
+)
+@click.option(
+    "--evidence-k",
+    "-e",
+    help="Number of evidence pieces to retrieve.",
+    type=int,
+    default=lambda: papis.config.getint("evidence-k", SECTION_NAME),
+)
+@click.option(
+    "--max-sources",
+    "-m",
+    help="Maximum number of sources for an answer.",
+    type=int,
+    default=lambda: papis.config.getint("max-sources", SECTION_NAME),
+)
+@click.option(
+    "--answer-length",
+    "-l",
+    help="Length of the answer.",
+    type=str,
+    default=lambda: papis.config.getstring("answer-length", SECTION_NAME),
+)
+@click.option(
+    "--exact",
+    help="Search all chunks rather than using the nearest neighbour index.",
+    is_flag=True,
+    default=False,
+)
+@click.option(
+    "--retrieval",
+    "-r",
+    help="How to find evidence: by embeddings only, or also by the question's words.",
+    type=click.Choice(["dense", "prefilter", "fusion"]),
+    default=lambda: papis.config.getstring("retrieval", SECTION_NAME),
+)
+@click.option(
+    "--rerank-keep",
+    "-k",
+    help="Number of retrieved chunks to summarize after reranking them (0 for all).",
+    type=int,
+    default=lambda: papis.config.getint("rerank-keep", SECTION_NAME),
+)
+@click.option(
+    "--filter",
+    "-f",
+    "filter_query",
+    help="Only use the documents matching a Papis query, e.g. 'author:smith year:>2015'.",
+    type=str,
+    default=None,
+)
+@papis.cli.bool_flag(
+    "--cache/--no-cache",
+    help="Reuse the answers to the same questions if the index hasn't changed.",
+    default=lambda: papis.config.getboolean("answer-cache", SECTION_NAME),
+)
+def batch_cmd(
+    questions_file: Path,
+    output_file: Optional[Path],
+    jobs: int,
+    evidence_k: int,
+    max_sources: int,
+    answer_length: str,
+    exact: bool,
+    retrieval: str,
+    rerank_keep: int,
+    filter_query: Optional[str],
+    cache: bool,
+) -> None:
+    """Answer the questions in a file, one per line, as JSON Lines."""
+    import asyncio
+
+    from papis_ask.answer_cache import normalize_question
+    from papis_ask.config import create_paper_qa_settings
+    from papis_ask.daemon import to_plain_answer
+    from papis_ask.filters import FilterError
+    from papis_ask.index import (
+        filter_query_index,
+        get_answer_cache,
+        get_answer_cache_key,
+        get_query_index,
+        get_summary_cache,
+    )
+    from papis_ask.output import to_json_dict
+    from papis_ask.query import answer_questions
+
+    if evidence_k <= max_sources:
+        logger.error("evidence_k must be larger than max_source")
+        return
+    if 0 < rerank_keep <= max_sources:
+        logger.error("rerank_keep must be larger than max_source")
+        return
+
+    questions = list(
+        dict.fromkeys(
+            line.strip()
+            for line in questions_file.read_text().splitlines()
+            if line.strip()
         )
+    )
+    if output_file is not None and output_file.exists():
+        done = _get_answered_questions(output_file)
+        if skipped := sum(
+            normalize_question(question) in done for question in questions
+        ):
+            logger.info(f"Skipping {skipped} question(s) answered in {output_file}")
+            questions = [
+                question
+                for question in questions
+                if normalize_question(question) not in done
+            ]
+
+    with (
+        open(output_file, "a") if output_file is not None else nullcontext(sys.stdout)
+    ) as out:
+
+        def write(answer: Any) -> None:
+            out.write(json.dumps(to_json_dict(answer)) + "\n")
+            out.flush()
+
+        settings = create_paper_qa_settings()
+        settings.answer.answer_max_sources = max_sources
+        settings.answer.evidence_k = evidence_k
+        settings.answer.answer_length = answer_length
+
+        answer_cache = get_answer_cache() if cache else None
+        summary_cache = None
+        try:
+            cache_keys = {
+                question: get_answer_cache_key(
+                    question, settings, exact, retrieval, rerank_keep, filter_query
+                )
+                for question in questions
+            }
+            pending = []
+            for question in questions:
+                answer = (
+                    answer_cache.get(cache_keys[question])
+                    if answer_cache is not None
+                    else None
+                )
+                if answer is not None:
+                    # it may have been asked differently, see `normalize_question`
+                    answer.question = question
+                    write(answer)
+                else:
+                    pending.append(question)
+            if not pending:
+                return
+
+            docs_index = get_query_index(exact=exact, retrieval=retrieval)
+            if not docs_index:
+                logger.info(
+                    "The index is empty. Please index some files before asking question."
+                )
+                return
+            if filter_query:
+                try:
+                    docs_index = filter_query_index(docs_index, filter_query)
+                except FilterError as e:
+                    logger.error(str(e))
+                    return
+
+            summary_cache = get_summary_cache()
+
+            async def answer_all() -> int:
+                answered = 0
+                async for question, answer in answer_questions(
+                    docs_index,
+                    pending,
+                    settings,
+                    jobs,
+                    summary_cache=summary_cache,
+                    rerank_keep=rerank_keep,
+                ):
+                    if isinstance(answer, Exception):
+                        logger.error(f"Failed to answer '{question}': {answer}")
+                        continue
+                    answer = to_plain_answer(answer)
+                    write(answer)
+                    if answer_cache is not None:
+                        answer_cache.put(cache_keys[question], answer)
+                    answered += 1
+                return answered
+
+            answered = asyncio.run(answer_all())
+            logger.info(f"Answered {answered} of {len(pending)} question(s)")
+        finally:
+            if summary_cache is not None:
+                summary_cache.close()
+            if answer_cache is not None:
+                answer_cache.close()
+
+
+def _get_answered_questions(output_file: Path) -> Set[str]:
+    """Get the questions answered in a JSON Lines file written by 'batch'.
+
+    They're normalized as for the answer cache (see `normalize_question`).
+    """
+    from papis_ask.answer_cache import normalize_question
+
+    answered = set()
+    with open(output_file) as f:
+        for line in f:
+            try:
+                answered.add(normalize_question(json.loads(line)["question"]))
+            except (ValueError, KeyError, TypeError, AttributeError):
+                # e.g. a line cut short by interrupting an earlier run
+                continue
+    return answered
 
 
 @cli.command("index")
@@ -361,30 +544,122 @@ def query_cmd(
     is_flag=True,
     default=False,
 )
-def index_cmd(query: Optional[str], force: bool):
+@click.option(
+    "--jobs",
+    "-j",
+    help="Number of files to index concurrently.",
+    type=int,
+    default=lambda: papis.config.getint("index-jobs", SECTION_NAME),
+)
+@click.option(
+    "--offline-metadata",
+    help="Only use cached metadata from Semantic Scholar.",
+    is_flag=True,
+    default=False,
+)
+@click.option(
+    "--compact",
+    help="Drop what removed documents left behind and shrink the index, rather than updating it.",
+    is_flag=True,
+    default=False,
+)
+@click.option(
+    "--profile",
+    "profile_file",
+    help="Log how long each stage took and write a trace of it for each file to this file.",
+    type=click.Path(dir_okay=False, path_type=Path),
+    default=None,
+)
+def index_cmd(
+    query: Optional[str],
+    force: bool,
+    jobs: int,
+    offline_metadata: bool,
+    compact: bool,
+    profile_file: Optional[Path],
+):
     """Update the library index."""
-    logger.debug(f"Starting 'index' with query={query}, force={force}")
-    asyncio.run(_index_async(query, force))
+    logger.debug(
+        f"Starting 'index' with query={query}, force={force}, jobs={jobs}, offline_metadata={offline_metadata}, compact={compact}, profile_file={profile_file}"
+    )
+    if compact:
+        from papis_ask.index import compact_index, get_index_file
+
+        if not get_index_file().exists():
+            logger.info("There's no index to compact.")
+            return
+        compact_index()
+        return
+
+    import asyncio
+
+    from papis_ask.profiling import profiling
 
+    with profiling(profile_file) if profile_file is not None else nullcontext():
+        asyncio.run(_index_async(query, force, jobs, offline_metadata))
 
-async def _index_async(query: Optional[str], force: bool) -> None:
+
+async def _index_async(
+    query: Optional[str],
+    force: bool,
+    jobs: int = 1,
+    offline_metadata: bool = False,
+) -> None:
     # importing all this here rather than globally since
     # it slows down shell autocmplete otherwise
-    from papis_ask.metadata_provider import PapisProvider
+    import aiohttp
+    from papis.api import get_all_documents_in_lib
+
+    from papis_ask.config import create_paper_qa_settings
+    from papis_ask.index import (
+        determine_file_status,
+        enrich_document,
+        get_fingerprints,
+        get_index,
+        get_index_store,
+        get_metadata_cache_file,
+        remove_document_from_index,
+        save_fingerprints,
+        save_index,
+        update_ann_index,
+        update_fulltext_index,
+        update_index_metadata,
+        update_quantized_index,
+    )
+    from papis_ask.metadata_provider import (
+        PapisProvider,
+        RateLimitAwareSemanticScholarProvider,
+    )
     from paperqa.clients import DocMetadataClient
 
-    from paperqa.clients.semantic_scholar import SemanticScholarProvider
     from paperqa.clients.journal_quality import JournalQualityPostProcessor
     from paperqa.types import DocDetails
+    from papis_ask.fingerprint import find_changed_files
+    from papis_ask.enrichment import MetadataEnricher, TokenBucket
+    from papis_ask.metadata_cache import (
+        SECONDS_PER_DAY,
+        CachedMetadataClient,
+        MetadataCache,
+    )
+    from papis_ask.pipeline import (
+        as_completed_bounded,
+        get_stage_concurrency,
+        run_index_pipeline,
+    )
+    from papis_ask.profiling import profile
 
     settings = create_paper_qa_settings()
 
-    docs_index = get_index()
+    # The texts aren't needed to add, update or remove documents
+    with profile("load index"):
+        docs_index = get_index(with_texts=False)
     if docs_index is None or force:
         from paperqa import Docs
 
         logger.debug("Creating new empty Docs instance")
         docs_index = Docs()
+        if force:
+            save_index(docs_index)
 
     logger.debug(f"The paper-qa index contains {len(docs_index.docs)} document(s)")
 
@@ -399,171 +674,254 @@ async def _index_async(query: Optional[str], force: bool) -> None:
     papis_id_to_doc = {doc["papis_id"]: doc for doc in docs_papis}
     PapisProvider.configure(docs_by_id=papis_id_to_doc)
 
-    clients = {
+    RateLimitAwareSemanticScholarProvider.configure(
+        base_url=papis.config.getstring("semantic-scholar-url", SECTION_NAME)
+    )
+    rate_limiter = TokenBucket(
+        rate=papis.config.getfloat("metadata-rate", SECTION_NAME) or 0,
+        burst=papis.config.getint("metadata-burst", SECTION_NAME) or 1,
+    )
+    # One session for all lookups, rather than one per lookup
+    session = aiohttp.ClientSession()
+    clients: Dict[str, Any] = {
         "papis": DocMetadataClient(
+            session=session,
             clients={
                 PapisProvider,
                 JournalQualityPostProcessor,
-            }
+            },
         ),
-        "other": DocMetadataClient(
-            clients={
-                SemanticScholarProvider,
-            }
+        # Semantic Scholar is strictly rate limited, so its responses are cached
+        "other": CachedMetadataClient(
+            DocMetadataClient(
+                session=session,
+                clients={
+                    RateLimitAwareSemanticScholarProvider,
+                },
+            ),
+            MetadataCache(
+                get_metadata_cache_file(),
+                ttl=papis.config.getint("metadata-cache-ttl", SECTION_NAME)
+                * SECONDS_PER_DAY,
+                negative_ttl=papis.config.getint(
+                    "metadata-cache-negative-ttl", SECTION_NAME
+                )
+                * SECONDS_PER_DAY,
+            ),
+            offline=offline_metadata,
+            rate_limiter=rate_limiter,
         ),
     }
-
-    files_to_index: Set[Tuple[Path, str]] = set()
-    files_to_update_metadata: Set[Tuple[Path, str]] = set()
-    files_to_delete: Set[Path] = set()
-
-    # Track existing files to later determine which ones to delete
-    files_on_disk: Set[Path] = set()
-
-    # Create a mapping of filenames to dockeys
-    index_files_to_dockey: Dict[str, str] = {}
-    for dockey, doc in docs_index.docs.items():
-        if type(doc) is DocDetails and hasattr(doc, "file_location"):
-            index_files_to_dockey[str(doc["file_location"])] = dockey
-
-    # check all files in the library
-    for papis_id, doc_papis in papis_id_to_doc.items():
-        info_yaml_path = Path(doc_papis.get_info_file())
-
-        # Figure out what documents need to be indexed
-        for file_path in doc_papis.get_files():
-            file_path = Path(file_path)
-            file_ending = file_path.suffix
-            if file_ending in FILE_ENDINGS:
-                files_on_disk.add(file_path)
-
-                # Skip processing if force is enabled (everything will be re-indexed)
-                if force:
-                    files_to_index.add((file_path, papis_id))
-                    continue
-
-                # Use the function to determine file status
-                needs_indexing, needs_metadata_update = determine_file_status(
-                    file_path, info_yaml_path, index_files_to_dockey, docs_index
-                )
-
-                if needs_indexing:
-                    logger.debug(f"File {file_path} needs to be indexed")
-                    files_to_index.add((file_path, papis_id))
-                elif needs_metadata_update:
-                    logger.debug(f"File {file_path} needs metadata update")
-                    files_to_update_metadata.add((file_path, papis_id))
-
-    logger.info(f"{len(files_to_index)} file(s) will be indexed")
-
-    # Removing all files needing to be indexed from those that need metadata updated
-    files_to_update_metadata -= files_to_index
-    logger.info(
-        f"{len(files_to_update_metadata)} file(s) will have their metadata updated"
-    )
-
-    # Figure out which documents need to be deleted
-    files_to_delete = {
-        Path(file) for file in index_files_to_dockey.keys()
-    } - files_on_disk
-    logger.info(f"{len(files_to_delete)} file(s) will be removed from the index")
-
-    unchanged_files = max(
-        0,
-        (
-            len(index_files_to_dockey)
-            - len(files_to_update_metadata)
-            - len(files_to_index)
-            - len(files_to_delete)
+    # and its metadata is added in the background, independently of indexing
+    clients["enricher"] = MetadataEnricher(
+        store=get_index_store(),
+        enrich=lambda dockey, query: enrich_document(
+            dockey, query, docs_index, clients, settings
         ),
+        rate_limiter=rate_limiter,
+        concurrency=get_stage_concurrency()["metadata"],
+        max_attempts=papis.config.getint("metadata-max-attempts", SECTION_NAME) or 1,
+        retry_unresolved=offline_metadata,
     )
-    logger.info(f"{unchanged_files} file(s) will remain unchanged")
-
-    # Find files to be deleted because they don't exist on disk anymore
-    dockeys_to_delete_bc_missing: list[str] = [
-        index_files_to_dockey[str(file)] for file in files_to_delete
-    ]
-
-    # find files to be deleted because they changed and will be replaced with new ones
-    dockeys_to_delete_bc_updated: list[str] = [
-        index_files_to_dockey[str(file)]
-        for file, _ in files_to_index
-        if str(file) in index_files_to_dockey
-    ]
-
-    # Delete files that have been updated (to avoid having duplicates of same file with different hashes)
-    for dockey in dockeys_to_delete_bc_updated:
-        remove_document_from_index(docs_index, dockey)
-
-    # Delete files that have been deleted
-    counter = 0
-    total_files = len(dockeys_to_delete_bc_missing)
-    for dockey in dockeys_to_delete_bc_missing:
-        counter += 1
-        file_location, ref = remove_document_from_index(docs_index, dockey)
-        if file_location:
-            logger.info(
-                "%d/%d: Removed @%s (%s)",
-                counter,
-                total_files,
-                ref,
-                file_location,
+    try:
+        if pending := clients["enricher"].start():
+            logger.info(f"Resuming {pending} metadata lookup(s) from an earlier run")
+
+        files_to_index: Set[Tuple[Path, str]] = set()
+        files_to_update_metadata: Set[Tuple[Path, str]] = set()
+        files_to_delete: Set[Path] = set()
+
+        # Track existing files to later determine which ones to delete
+        files_on_disk: Set[Path] = set()
+
+        # Create a mapping of filenames to dockeys
+        index_files_to_dockey: Dict[str, str] = {}
+        for dockey, doc in docs_index.docs.items():
+            if type(doc) is DocDetails and hasattr(doc, "file_location"):
+                index_files_to_dockey[str(doc["file_location"])] = dockey
+
+        # Find the indexed files whose content changed. Only files whose
+        # fingerprint (size, mtime, inode) changed get hashed
+        changed_files: Set[Path] = set()
+        if not force:
+            with profile("find changed files"):
+                changed_files, touched_files = find_changed_files(
+                    {
+                        Path(file): dockey
+                        for file, dockey in index_files_to_dockey.items()
+                    },
+                    get_fingerprints(),
+                    get_stage_concurrency()["parse"],
+                )
+            save_fingerprints(
+                (file_path, index_files_to_dockey[str(file_path)], fingerprint)
+                for file_path, fingerprint in touched_files.items()
             )
+            logger.debug(f"{len(touched_files)} file(s) were touched but are unchanged")
+
+        # check all files in the library
+        for papis_id, doc_papis in papis_id_to_doc.items():
+            info_yaml_path = Path(doc_papis.get_info_file())
+
+            # Figure out what documents need to be indexed
+            for file_path in doc_papis.get_files():
+                file_path = Path(file_path)
+                file_ending = file_path.suffix
+                if file_ending in FILE_ENDINGS:
+                    files_on_disk.add(file_path)
+
+                    # Skip processing if force is enabled (everything will be re-indexed)
+                    if force:
+                        files_to_index.add((file_path, papis_id))
+                        continue
+
+                    # Use the function to determine file status
+                    needs_indexing, needs_metadata_update = determine_file_status(
+                        file_path,
+                        info_yaml_path,
+                        index_files_to_dockey,
+                        docs_index,
+                        changed_files,
+                    )
+
+                    if needs_indexing:
+                        logger.debug(f"File {file_path} needs to be indexed")
+                        files_to_index.add((file_path, papis_id))
+                    elif needs_metadata_update:
+                        logger.debug(f"File {file_path} needs metadata update")
+                        files_to_update_metadata.add((file_path, papis_id))
+
+        logger.info(f"{len(files_to_index)} file(s) will be indexed")
+
+        # Removing all files needing to be indexed from those that need metadata updated
+        files_to_update_metadata -= files_to_index
+        logger.info(
+            f"{len(files_to_update_metadata)} file(s) will have their metadata updated"
+        )
 
-    # index all new files or changed files
-    counter = 0
-    total_files = len(files_to_index)
-    for file_path, papis_id in files_to_index:
-        counter += 1
+        # Figure out which documents need to be deleted
+        files_to_delete = {
+            Path(file) for file in index_files_to_dockey.keys()
+        } - files_on_disk
+        logger.info(f"{len(files_to_delete)} file(s) will be removed from the index")
+
+        unchanged_files = max(
+            0,
+            (
+                len(index_files_to_dockey)
+                - len(files_to_update_metadata)
+                - len(files_to_index)
+                - len(files_to_delete)
+            ),
+        )
+        logger.info(f"{unchanged_files} file(s) will remain unchanged")
+
+        # Find files to be deleted because they don't exist on disk anymore
+        dockeys_to_delete_bc_missing: list[str] = [
+            index_files_to_dockey[str(file)] for file in files_to_delete
+        ]
+
+        # find files to be deleted because they changed and will be replaced with new ones
+        dockeys_to_delete_bc_updated: list[str] = [
+            index_files_to_dockey[str(file)]
+            for file, _ in files_to_index
+            if str(file) in index_files_to_dockey
+        ]
+
+        # Delete files that have been updated (to avoid having duplicates of same file with different hashes)
+        for dockey in dockeys_to_delete_bc_updated:
+            remove_document_from_index(docs_index, dockey)
+
+        # Delete files that have been deleted
+        counter = 0
+        total_files = len(dockeys_to_delete_bc_missing)
+        for dockey in dockeys_to_delete_bc_missing:
+            counter += 1
+            file_location, ref = remove_document_from_index(docs_index, dockey)
+            if file_location:
+                logger.info(
+                    "%d/%d: Removed @%s (%s)",
+                    counter,
+                    total_files,
+                    ref,
+                    file_location,
+                )
 
-        doc_papis = papis_id_to_doc[papis_id]
+        # index all new files or changed files
+        counter = 0
+        total_files = len(files_to_index)
 
-        if ref := await add_file_to_index(
-            file_path=file_path,
-            doc_papis=doc_papis,
-            docs_index=docs_index,
-            clients=clients,
-            settings=settings,
-        ):
-            logger.info(
-                "%d/%d: Indexed @%s (%s)",
-                counter,
-                total_files,
-                ref,
-                file_path.name,
+        def report_indexed(file_path: Path, ref: Optional[str]) -> None:
+            nonlocal counter
+            counter += 1
+            if ref:
+                logger.info(
+                    "%d/%d: Indexed @%s (%s)",
+                    counter,
+                    total_files,
+                    ref,
+                    file_path.name,
+                )
+            else:
+                logger.warning("Failed to index file: %s", file_path)
+
+        with profile("index files"):
+            await run_index_pipeline(
+                files_to_index=(
+                    (file_path, papis_id_to_doc[papis_id])
+                    for file_path, papis_id in files_to_index
+                ),
+                docs_index=docs_index,
+                clients=clients,
+                settings=settings,
+                jobs=jobs,
+                on_done=report_indexed,
             )
-        else:
-            logger.warning("Failed to index file: %s", file_path)
-
-    # update metadata for papis documents that have changed
-    counter = 0
-    total_files = len(files_to_update_metadata)
-    for file_path, papis_id in files_to_update_metadata:
-        counter += 1
-
-        doc_papis = papis_id_to_doc[papis_id]
-        dockey = index_files_to_dockey.get(str(file_path))
-        doc_index = docname = docs_index.docs[dockey]
-        docname = doc_index.docname
-        if type(doc_index) is DocDetails:
-            file_last_indexed = docs_index.docs[dockey].other["file_last_indexed"]  # type: ignore (they should all be DocDetails)
 
+        # update metadata for papis documents that have changed
+        async def update_file_metadata(
+            file_path: Path, papis_id: str
+        ) -> Tuple[Path, Optional[str]]:
+            doc_papis = papis_id_to_doc[papis_id]
+            dockey = index_files_to_dockey.get(str(file_path))
             if not dockey:
                 logger.warning(
                     "File %s is not in the index, skipping metadata update",
                     file_path,
                 )
-                continue
-            if ref := await update_index_metadata(
-                file_path=file_path,
-                file_last_indexed=file_last_indexed,
-                doc_papis=doc_papis,
-                docs_index=docs_index,
-                dockey=dockey,
-                docname=docname,
-                clients=clients,
-                settings=settings,
-            ):
+                return file_path, None
+            doc_index = docs_index.docs[dockey]
+            docname = doc_index.docname
+            if type(doc_index) is not DocDetails:
+                logger.warning(
+                    f"Skipped {file_path} because it is not a DocDetails object"
+                )
+                return file_path, None
+            file_last_indexed = doc_index.other["file_last_indexed"]
+            with profile("metadata", file_path):
+                ref = await update_index_metadata(
+                    file_path=file_path,
+                    file_last_indexed=file_last_indexed,
+                    doc_papis=doc_papis,
+                    docs_index=docs_index,
+                    dockey=dockey,
+                    docname=docname,
+                    clients=clients,
+                    settings=settings,
+                )
+            return file_path, ref
+
+        counter = 0
+        total_files = len(files_to_update_metadata)
+        async for file_path, ref in as_completed_bounded(
+            (
+                update_file_metadata(file_path, papis_id)
+                for file_path, papis_id in files_to_update_metadata
+            ),
+            get_stage_concurrency()["metadata"],
+        ):
+            counter += 1
+            if ref:
                 logger.info(
                     "%d/%d: Updated metadata for @%s (%s)",
                     counter,
@@ -573,7 +931,16 @@ async def _index_async(query: Optional[str], force: bool) -> None:
                 )
             else:
                 logger.warning("Failed to update metadata for file: %s", file_path)
-        else:
-            logger.warning(f"Skipped {file_path} because it is not a DocDetails object")
 
-    save_index(docs_index)
+        with profile("finish metadata lookups"):
+            await clients["enricher"].aclose()
+    finally:
+        clients["other"].close()
+        await session.close()
+
+    with profile("ann index"):
+        update_ann_index()
+    with profile("quantized index"):
+        update_quantized_index()
+    with profile("fulltext index"):
+        update_fulltext_index()
@@ -0,0 +1,154 @@
+"""Persistent cache of external metadata lookups."""
+
+import pickle
+import re
+import sqlite3
+import time
+from pathlib import Path
+from typing import Any, Dict, Optional, Tuple
+
+import papis.logging
+
+from papis_ask.enrichment import TokenBucket
+from papis_ask.profiling import profile
+
+logger = papis.logging.get_logger(__name__)
+
+SECONDS_PER_DAY = 24 * 60 * 60
+
+
+def normalize(value: Any) -> str:
+    """Normalize a title or author name for use in a cache key."""
+    return re.sub(r"\W+", " ", str(value)).strip().casefold()
+
+
+def metadata_cache_key(query: Dict[str, Any]) -> Optional[str]:
+    """Get the cache key of a metadata query.
+
+    Queries are keyed by DOI if there is one, by title and authors otherwise.
+    Returns `None` for queries that can't be keyed.
+    """
+    fields = ",".join(sorted(query.get("fields") or []))
+    if doi := query.get("doi"):
+        return f"doi:{doi.strip().lower()}|{fields}"
+    if title := query.get("title"):
+        authors = ";".join(normalize(author) for author in query.get("authors") or [])
+        return f"title:{normalize(title)}|{authors}|{fields}"
+    return None
+
+
+class MetadataCache:
+    """Persistent cache of metadata lookups.
+
+    Lookups that found nothing are cached too, but expire after
+    `negative_ttl` seconds rather than `ttl`, since they may be caused by
+    a provider being down.
+    """
+
+    SCHEMA = """
+    CREATE TABLE IF NOT EXISTS responses (
+        key TEXT PRIMARY KEY,
+        details BLOB,
+        fetched REAL NOT NULL
+    );
+    """
+
+    def __init__(self, path: Path, ttl: float, negative_ttl: float) -> None:
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.connection = sqlite3.connect(path)
+        self.connection.execute("PRAGMA journal_mode = WAL")
+        self.connection.execute("PRAGMA synchronous = NORMAL")
+        with self.connection:
+            self.connection.executescript(self.SCHEMA)
+
+    def close(self) -> None:
+        """Drop expired responses and close the cache."""
+        now = time.time()
+        with self.connection:
+            self.connection.execute(
+                "DELETE FROM responses WHERE"
+                " (details IS NOT NULL AND fetched < ?)"
+                " OR (details IS NULL AND fetched < ?)",
+                (now - self.ttl, now - self.negative_ttl),
+            )
+        self.connection.close()
+
+    def get(self, key: str) -> Tuple[bool, Any]:
+        """Look up a response, returning whether it was found and the response."""
+        row = self.connection.execute(
+            "SELECT details, fetched FROM responses WHERE key = ?", (key,)
+        ).fetchone()
+        if row is None:
+            return False, None
+
+        details, fetched = row
+        ttl = self.ttl if details is not None else self.negative_ttl
+        if time.time() - fetched > ttl:
+            return False, None
+        try:
+            return True, pickle.loads(details) if details is not None else None
+        except (pickle.PickleError, AttributeError, ImportError) as e:
+            # e.g. written by an incompatible version of paperqa
+            logger.debug(f"Ignoring unreadable cached metadata for {key}: {e}")
+            return False, None
+
+    def put(self, key: str, details: Any) -> None:
+        """Store a response, where `None` means nothing was found."""
+        with self.connection:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO responses (key, details, fetched)"
+                " VALUES (?, ?, ?)",
+                (
+                    key,
+                    pickle.dumps(details) if details is not None else None,
+                    time.time(),
+                ),
+            )
+
+
+class CachedMetadataClient:
+    """Metadata client answering queries from a `MetadataCache` when possible.
+
+    In `offline` mode, the wrapped client is never queried and queries that
+    aren't cached find nothing. Otherwise, queries that aren't cached wait for
+    the `rate_limiter`, if any.
+    """
+
+    def __init__(
+        self,
+        client: Any,
+        cache: MetadataCache,
+        offline: bool = False,
+        rate_limiter: Optional[TokenBucket] = None,
+    ):
+        self.client = client
+        self.cache = cache
+        self.offline = offline
+        self.rate_limiter = rate_limiter
+
+    async def query(self, **kwargs: Any) -> Any:
+        key = metadata_cache_key(kwargs)
+        if key is not None:
+            found, details = self.cache.get(key)
+            if found:
+                logger.debug(f"Using cached metadata for {key}")
+                return details
+        if self.offline:
+            return None
+
+        queued = time.perf_counter()
+        if self.rate_limiter is not None:
+            await self.rate_limiter.acquire()
+        with profile(
+            "semantic scholar",
+            kwargs.get("doi") or kwargs.get("title", ""),
+            time.perf_counter() - queued,
+        ):
+            details = await self.client.query(**kwargs)
+        if key is not None:
+            self.cache.put(key, details)
+        return details
+
+    def close(self) -> None:
+        self.cache.close()
@@ -1,14 +1,35 @@
 """Metadata provider for fetching metadata from local Papis database."""
 
 from datetime import datetime
-from typing import Optional, List, Any, Dict, ClassVar
+from http import HTTPStatus
+from typing import Optional, List, Any, Dict, ClassVar, Union
 
+import aiohttp
 from papis.document import Document
 import papis.logging
 
 from paperqa.types import DocDetails
 from paperqa.utils import BIBTEX_MAPPING
-from paperqa.clients.client_models import MetadataProvider, ClientQuery
+from paperqa.clients.client_models import (
+    ClientQuery,
+    DOIQuery,
+    MetadataProvider,
+    TitleAuthorQuery,
+)
+from paperqa.clients.exceptions import DOINotFoundError
+from paperqa.clients.semantic_scholar import (
+    SEMANTIC_SCHOLAR_API_FIELDS,
+    SEMANTIC_SCHOLAR_API_MAPPING,
+    SEMANTIC_SCHOLAR_BASE_URL,
+    SemanticScholarProvider,
+    SemanticScholarSearchType,
+    _s2_get_with_retrying,
+    parse_s2_to_doc_details,
+    s2_authors_match,
+)
+from paperqa.utils import strings_similarity, union_collections_to_ordered_list
+
+from papis_ask.enrichment import RateLimitError
 
 logger = papis.logging.get_logger(__name__)
 
@@ -166,3 +187,90 @@ class PapisProvider(MetadataProvider[LocalDocQuery]):
                 f"Papis provider query missing required fields: {', '.join(missing_fields)}"
             )
         return LocalDocQuery(**query)
+
+
+class RateLimitAwareSemanticScholarProvider(SemanticScholarProvider):
+    """Semantic Scholar provider raising `RateLimitError` when rate limited.
+
+    paperqa treats all client errors as if nothing was found, which would
+    make a rate limited lookup indistinguishable from an unknown paper.
+    Requests are sent to `base_url`, e.g. a mirror or proxy, which paperqa
+    has no setting for.
+    """
+
+    # Class variable to store the API URL
+    base_url: ClassVar[str] = SEMANTIC_SCHOLAR_BASE_URL
+
+    @classmethod
+    def configure(cls, base_url: str) -> None:
+        """Configure the provider with the API URL, empty for the public API."""
+        cls.base_url = base_url.rstrip("/") or SEMANTIC_SCHOLAR_BASE_URL
+
+    async def _query(
+        self, query: Union[TitleAuthorQuery, DOIQuery]
+    ) -> Optional[DocDetails]:
+        try:
+            return await self._get_doc_details(query)
+        except aiohttp.ClientResponseError as e:
+            if e.status != HTTPStatus.TOO_MANY_REQUESTS:
+                raise
+            retry_after = (e.headers or {}).get("Retry-After")
+            raise RateLimitError(
+                f"Rate limited by {self.__class__.__name__}",
+                retry_after=float(retry_after)
+                if retry_after and retry_after.isdigit()
+                else None,
+            ) from e
+
+    async def _get_doc_details(
+        self, query: Union[TitleAuthorQuery, DOIQuery]
+    ) -> DocDetails:
+        """Look up a paper like `SemanticScholarProvider`, but at `base_url`."""
+        if query.fields:
+            fields = ",".join(
+                union_collections_to_ordered_list(
+                    SEMANTIC_SCHOLAR_API_MAPPING[field]
+                    for field in query.fields
+                    if field in SEMANTIC_SCHOLAR_API_MAPPING
+                )
+            )
+        else:
+            fields = SEMANTIC_SCHOLAR_API_FIELDS
+
+        if isinstance(query, DOIQuery):
+            name = query.doi
+            path, params = SemanticScholarSearchType.DOI.make_url_params(
+                {"fields": fields}, query=query.doi, include_base_url=False
+            )
+        else:
+            name = query.title
+            path, params = SemanticScholarSearchType.MATCH.make_url_params(
+                {"query": query.title, "fields": fields}, include_base_url=False
+            )
+        data = await _s2_get_with_retrying(
+            url=f"{self.base_url}{path}",
+            params=params,
+            session=query.session,
+            http_exception_mappings={
+                HTTPStatus.NOT_FOUND: DOINotFoundError(
+                    f"Could not find DOI for {name}."
+                )
+            },
+        )
+
+        if isinstance(query, TitleAuthorQuery):
+            # the title search only matches titles, so check the authors too
+            try:
+                paper = data["data"][0] if "data" in data else data
+            except (KeyError, IndexError) as e:
+                raise DOINotFoundError(f"Could not find DOI for {name}.") from e
+            if query.authors and not s2_authors_match(query.authors, data=paper):
+                raise DOINotFoundError(
+                    f"Could not find DOI for {name} - author disagreement."
+                )
+            similarity = strings_similarity(paper.get("title", ""), query.title)
+            if similarity < query.title_similarity_threshold:
+                raise DOINotFoundError(
+                    f"Semantic Scholar results did not match for title {name!r}."
+                )
+        return await parse_s2_to_doc_details(data, query.session)
@@ -1,9 +1,10 @@
 import re
 import json
 from pathlib import Path
-from typing import Any
+from typing import Any, Dict, Optional
 
 from rich.console import Console
+from rich.live import Live
 from rich.panel import Panel
 from rich.text import Text
 from rich.table import Table
@@ -18,22 +19,22 @@ def to_latex_math(text: str) -> str:
     )
 
 
-def transform_answer(answer: Any) -> Any:
-    """Transform the answer to format references correctly using Papis references."""
-    # Convert to latex math
-    answer.answer = to_latex_math(answer.answer)
-
-    # Create a mapping of document names to references
+def get_citation_refs(contexts: Any) -> Dict[str, str]:
+    """Map the document names used in citations to Papis references."""
     papis_id_to_ref = {}
-
-    # First pass: collect all document names and their references and convert to latex math
-    for context in answer.contexts:
-        context.context = to_latex_math(context.context)
+    for context in contexts:
         ref = context.text.doc.other.get("ref", context.text.doc.other.get("papis_id"))
         papis_id_to_ref[context.text.name.split()[0]] = ref
+    return papis_id_to_ref
+
+
+def format_citations(text: str, papis_id_to_ref: Dict[str, str]) -> str:
+    """Replace citations like (papis_id pages X-N) with [@ref, p. X-N].
+
+    Only complete citations are replaced, so this can be applied to an answer
+    that's still being generated.
+    """
 
-    # Replace references in the answer text
-    # Pattern: (papis_id pages X-N) -> [@ref, p. X-N]
     def replace_citation(match):
         papis_id = match.group(1)
         pages = match.group(2)
@@ -49,32 +50,33 @@ def transform_answer(answer: Any) -> Any:
 
     # Pattern to match citations like (papis_id pages X-N)
     citation_pattern = r"\(([^)\s]+?)(?:\s+pages\s+([^)]+))?\)"
-    answer.answer = re.sub(citation_pattern, replace_citation, answer.answer)
+    return re.sub(citation_pattern, replace_citation, text)
 
-    return answer
 
+def transform_answer(answer: Any) -> Any:
+    """Transform the answer to format references correctly using Papis references."""
+    # Convert to latex math
+    answer.answer = to_latex_math(answer.answer)
+    for context in answer.contexts:
+        context.context = to_latex_math(context.context)
 
-def to_terminal_output(
-    answer: Any,
-    context: bool,
-    excerpt: bool,
-) -> None:
-    """Format and print the answer with optional context and excerpts."""
-    answer = transform_answer(answer)
-    console = Console()
+    # Replace references in the answer text
+    answer.answer = format_citations(answer.answer, get_citation_refs(answer.contexts))
 
-    # Format question
-    question_md = Text(answer.question)
-    console.print(
-        Panel(
-            question_md,
-            title=Text("Question", style="magenta bold"),
-            border_style="bright_black",
-        )
+    return answer
+
+
+def question_panel(question: str) -> Panel:
+    return Panel(
+        Text(question),
+        title=Text("Question", style="magenta bold"),
+        border_style="bright_black",
     )
 
+
+def answer_panel(answer: str) -> Panel:
     # Create a Text object for the answer
-    answer_text = Text(answer.answer)
+    answer_text = Text(answer)
 
     # Define a regex pattern for citations like [@XYZ]
     citation_pattern = r"\[@[^\]]+\]"
@@ -82,15 +84,28 @@ def to_terminal_output(
     # Highlight all matches in blue
     answer_text.highlight_regex(citation_pattern, style="blue")
 
-    # Display in panel
-    console.print(
-        Panel(
-            answer_text,
-            title=Text("Answer", style="green bold"),
-            border_style="bright_black",
-        )
+    return Panel(
+        answer_text,
+        title=Text("Answer", style="green bold"),
+        border_style="bright_black",
     )
 
+
+def to_terminal_output(
+    answer: Any,
+    context: bool,
+    excerpt: bool,
+) -> None:
+    """Format and print the answer with optional context and excerpts."""
+    answer = transform_answer(answer)
+    console = Console()
+    console.print(question_panel(answer.question))
+    console.print(answer_panel(answer.answer))
+    print_sources(console, answer, context, excerpt)
+
+
+def print_sources(console: Console, answer: Any, context: bool, excerpt: bool) -> None:
+    """Print the references and, optionally, the context of a transformed answer."""
     # Create references with colored names
     references = []
     for answer_context in answer.contexts:
@@ -148,9 +163,62 @@ def to_terminal_output(
             )
 
 
-def to_json_output(answer: Any) -> str:
+class StreamingTerminalOutput:
+    """Print the answer to the terminal while it's being generated.
+
+    The question is printed by `start`, once the index is loaded, and the
+    answer is updated in a live panel as tokens arrive. Citations are
+    formatted as soon as they're complete, which requires the references
+    passed to `set_refs`.
+    """
+
+    def __init__(self, question: str) -> None:
+        self.console = Console()
+        self.question = question
+        self.text = ""
+        self.papis_id_to_ref: Dict[str, str] = {}
+        self.live: Optional[Live] = None
+
+    def start(self) -> None:
+        self.console.print(question_panel(self.question))
+        self.live = Live(
+            Panel(
+                Text("Gathering evidence...", style="bright_black"),
+                title=Text("Answer", style="green bold"),
+                border_style="bright_black",
+            ),
+            console=self.console,
+        )
+        self.live.start()
+
+    def set_refs(self, papis_id_to_ref: Dict[str, str]) -> None:
+        self.papis_id_to_ref = papis_id_to_ref
+
+    def add_token(self, token: str) -> None:
+        self.text += token
+        self.live.update(
+            answer_panel(
+                format_citations(to_latex_math(self.text), self.papis_id_to_ref)
+            )
+        )
+
+    def finish(self, answer: Any, context: bool, excerpt: bool) -> None:
+        """Replace the streamed answer with the final one and print the sources."""
+        answer = transform_answer(answer)
+        if self.live is None:
+            self.start()
+        self.live.update(answer_panel(answer.answer))
+        self.stop()
+        print_sources(self.console, answer, context, excerpt)
+
+    def stop(self) -> None:
+        if self.live is not None:
+            self.live.stop()
+
+
+def to_json_dict(answer: Any) -> Dict[str, Any]:
     """Convert the answer object to a JSON-serializable dictionary."""
-    output = {
+    return {
         "question": answer.question,
         "answer": answer.answer,
         "references": [
@@ -171,7 +239,11 @@ def to_json_output(answer: Any) -> str:
             for context in answer.contexts
         ],
     }
-    return json.dumps(output, indent=2)
+
+
+def to_json_output(answer: Any) -> str:
+    """Convert the answer object to JSON."""
+    return json.dumps(to_json_dict(answer), indent=2)
 
 
 def to_markdown_output(
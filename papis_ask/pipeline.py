@@ -0,0 +1,350 @@
+"""Staged indexing pipeline.
+
+Files flow through three stages connected by bounded queues:
+
+1. parse: fingerprinting, hashing, text extraction and chunking in a pool of
+   worker processes
+2. embed: embedding the chunks and adding them to the shared Docs instance;
+   the chunks of all documents in this stage are batched into shared requests
+3. metadata: upgrading the Doc to a DocDetails with the Papis metadata and
+   saving the index; external metadata is added in the background by the
+   `MetadataEnricher`, so it doesn't hold up indexing
+
+CPU-bound parsing thus overlaps with the network-bound stages instead of
+blocking the event loop.
+"""
+
+import asyncio
+import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from typing import (
+    Any,
+    AsyncIterator,
+    Awaitable,
+    Callable,
+    Dict,
+    Iterable,
+    List,
+    Optional,
+    Tuple,
+    TypeVar,
+)
+
+import papis.config
+import papis.logging
+
+from papis_ask.config import SECTION_NAME
+from papis_ask.embeddings import EmbeddingBatcher, EmbeddingCache
+from papis_ask.fingerprint import Fingerprint, file_md5, get_fingerprint
+from papis_ask.index import (
+    extract_doc_papis_metadata,
+    get_embedding_cache_file,
+    save_fingerprints,
+    update_index_metadata,
+)
+from papis_ask.profiling import profile, record
+
+logger = papis.logging.get_logger(__name__)
+
+T = TypeVar("T")
+
+NOT_TEXT_DOCUMENT_ERROR = "This does not look like a text document"
+
+
+async def as_completed_bounded(
+    coros: Iterable[Awaitable[T]], jobs: int
+) -> AsyncIterator[T]:
+    """Run awaitables with at most `jobs` at once, yielding results as they complete."""
+    semaphore = asyncio.Semaphore(max(1, jobs))
+
+    async def bounded(coro: Awaitable[T]) -> T:
+        async with semaphore:
+            return await coro
+
+    for future in asyncio.as_completed([bounded(coro) for coro in coros]):
+        yield await future
+
+
+async def parse_file(
+    file_path: Path,
+    dockey: str,
+    papis_id: str,
+    parse_config: Any,
+) -> Tuple[Any, List[Any]]:
+    """Parse and chunk a file into a paperqa Doc and its (not yet embedded) Texts.
+
+    Takes only the parsing settings, which (unlike the full settings) can be
+    pickled for the worker processes.
+    """
+    from paperqa.readers import read_doc
+    from paperqa.types import Doc
+    from paperqa.utils import maybe_is_text
+
+    doc = Doc(
+        docname=papis_id,  # to give somewhat sensible docnames (we don't depend on it)
+        citation=papis_id,  # to avoid unnecessary llm calls
+        dockey=dockey,
+    )
+    texts = await read_doc(
+        file_path,
+        doc,
+        chunk_chars=parse_config.chunk_size,
+        overlap=parse_config.overlap,
+        page_size_limit=parse_config.page_size_limit,
+        use_block_parsing=parse_config.pdfs_use_block_parsing,
+        parse_pdf=parse_config.parse_pdf,
+    )
+
+    # Same loose check that `Docs.aadd` uses to see if the document was loaded
+    if (
+        not texts
+        or len(texts[0].text) < 10
+        or (
+            not parse_config.disable_doc_valid_check
+            and not maybe_is_text("".join(text.text for text in texts[:5]))
+        )
+    ):
+        raise ValueError(f"{NOT_TEXT_DOCUMENT_ERROR}: {file_path}")
+
+    return doc, texts
+
+
+def parse_file_in_process(
+    file_path: Path,
+    papis_id: str,
+    parse_config: Any,
+) -> Tuple[Fingerprint, str, Any, List[Any], Dict[str, float]]:
+    """Fingerprint, hash and parse a file. This runs in a worker process.
+
+    Also returns how long each step took, in seconds, for profiling.
+    """
+    start = time.perf_counter()
+    # fingerprint before hashing, so that changes made meanwhile are detected
+    fingerprint = get_fingerprint(file_path)
+    fingerprinted = time.perf_counter()
+    dockey = file_md5(file_path)
+    hashed = time.perf_counter()
+    doc, texts = asyncio.run(parse_file(file_path, dockey, papis_id, parse_config))
+    timings = {
+        "fingerprint": fingerprinted - start,
+        "md5": hashed - fingerprinted,
+        "read": time.perf_counter() - hashed,
+    }
+    return fingerprint, dockey, doc, texts, timings
+
+
+def record_parse(
+    file_path: Path,
+    submitted: float,
+    timings: Dict[str, float],
+    nbytes: int,
+) -> None:
+    """Record the steps a worker process took to parse a file.
+
+    The worker's clock isn't necessarily comparable with ours, so the steps
+    are placed right before the result arrived, and the rest of the time
+    since the file was submitted counts as waiting for a worker.
+    """
+    received = time.perf_counter()
+    start = received - sum(timings.values())
+    record("parse", file_path, start, received, start - submitted, nbytes)
+    for step, seconds in timings.items():
+        record(
+            f"parse/{step}",
+            file_path,
+            start,
+            start + seconds,
+            nbytes=0 if step == "fingerprint" else nbytes,
+        )
+        start += seconds
+
+
+async def embed_texts(texts: List[Any], batcher: EmbeddingBatcher) -> None:
+    """Compute the embeddings of Texts in place."""
+    embeddings = await batcher.embed([text.text for text in texts])
+    for text, embedding in zip(texts, embeddings):
+        text.embedding = embedding
+
+
+def create_embedding_cache(settings: Any) -> Optional[EmbeddingCache]:
+    """Open the embedding cache for the configured model and chunking."""
+    if not papis.config.getboolean("index-embedding-cache", SECTION_NAME):
+        return None
+
+    parse_config = settings.parsing
+    namespace = "|".join(
+        str(part)
+        for part in (
+            settings.embedding,
+            parse_config.chunk_size,
+            parse_config.overlap,
+            parse_config.pdfs_use_block_parsing,
+        )
+    )
+    max_megabytes = papis.config.getint("index-embedding-cache-size", SECTION_NAME)
+    return EmbeddingCache(
+        path=get_embedding_cache_file(),
+        namespace=namespace,
+        max_bytes=(max_megabytes or 0) * 1024 * 1024,
+    )
+
+
+def create_embedding_batcher(settings: Any, concurrency: int) -> EmbeddingBatcher:
+    """Create an embedding batcher for the configured embedding model."""
+    return EmbeddingBatcher(
+        embedding_model=settings.get_embedding_model(),
+        batch_size=papis.config.getint("index-embedding-batch-size", SECTION_NAME) or 1,
+        batch_tokens=papis.config.getint("index-embedding-batch-tokens", SECTION_NAME)
+        or 1,
+        concurrency=concurrency,
+        cache=create_embedding_cache(settings),
+    )
+
+
+def get_stage_concurrency() -> Dict[str, int]:
+    """Get the number of workers of each indexing stage from the config."""
+    return {
+        # use all cores for parsing unless configured otherwise
+        "parse": papis.config.getint("index-parse-concurrency", SECTION_NAME)
+        or os.cpu_count()
+        or 1,
+        # number of concurrent embedding requests
+        "embedding": papis.config.getint("index-embedding-concurrency", SECTION_NAME)
+        or 1,
+        "metadata": papis.config.getint("index-metadata-concurrency", SECTION_NAME)
+        or 1,
+    }
+
+
+async def run_index_pipeline(
+    files_to_index: Iterable[Tuple[Path, Dict[str, Any]]],
+    docs_index: Any,
+    clients: Any,
+    settings: Any,
+    jobs: int,
+    on_done: Callable[[Path, Optional[str]], None],
+) -> None:
+    """Index files through the parse, embed and metadata stages.
+
+    At most `jobs` files are in flight at once. `on_done` is called with the
+    file path and its ref (or `None` on failure) as each file completes.
+    """
+    concurrency = get_stage_concurrency()
+    queue_size = papis.config.getint("index-queue-size", SECTION_NAME) or 1
+
+    embed_queue: asyncio.Queue = asyncio.Queue(maxsize=queue_size)
+    metadata_queue: asyncio.Queue = asyncio.Queue(maxsize=queue_size)
+    in_flight = asyncio.Semaphore(max(1, jobs))
+    # Guards mutations of the shared Docs instance
+    docs_lock = asyncio.Lock()
+    loop = asyncio.get_running_loop()
+    batcher = create_embedding_batcher(settings, concurrency["embedding"])
+    # Enough documents are embedded at once to fill the batches, while the
+    # batcher bounds the number of requests
+    embed_workers = max(concurrency["embedding"], queue_size)
+
+    fingerprints: Dict[Path, Fingerprint] = {}
+
+    def finish(file_path: Path, ref: Optional[str]) -> None:
+        fingerprints.pop(file_path, None)
+        in_flight.release()
+        on_done(file_path, ref)
+
+    async def parse_one(
+        pool: ProcessPoolExecutor, file_path: Path, doc_papis: Dict[str, Any]
+    ) -> None:
+        _, papis_id, _ = extract_doc_papis_metadata(doc_papis)
+        submitted = time.perf_counter()
+        try:
+            fingerprint, dockey, doc, texts, timings = await loop.run_in_executor(
+                pool, parse_file_in_process, file_path, papis_id, settings.parsing
+            )
+        except ValueError as e:
+            if NOT_TEXT_DOCUMENT_ERROR in str(e):
+                logger.warning(f"File not recognised as text document: {file_path}")
+                logger.warning("Usually, this means the file is faulty or not ocr'ed")
+                finish(file_path, None)
+                return
+            # Re-raise other ValueErrors
+            raise
+        record_parse(file_path, submitted, timings, fingerprint.size)
+        fingerprints[file_path] = fingerprint
+        await embed_queue.put(
+            (file_path, doc_papis, dockey, doc, texts, time.perf_counter())
+        )
+
+    async def parse_stage(pool: ProcessPoolExecutor) -> None:
+        async with asyncio.TaskGroup() as tg:
+            for file_path, doc_papis in files_to_index:
+                await in_flight.acquire()
+                tg.create_task(parse_one(pool, file_path, doc_papis))
+        for _ in range(embed_workers):
+            await embed_queue.put(None)
+
+    async def embed_worker() -> None:
+        while (item := await embed_queue.get()) is not None:
+            file_path, doc_papis, dockey, doc, texts, queued = item
+            nbytes = sum(len(text.text.encode()) for text in texts)
+            with profile("embed", file_path, time.perf_counter() - queued, nbytes):
+                with profile("embed/embedding", file_path, nbytes=nbytes):
+                    await embed_texts(texts, batcher)
+                # The texts are already embedded, so this only updates the Docs instance
+                locking = time.perf_counter()
+                async with docs_lock:
+                    with profile("embed/add", file_path, time.perf_counter() - locking):
+                        added = await docs_index.aadd_texts(
+                            texts, doc, settings=settings
+                        )
+            if added:
+                await metadata_queue.put(
+                    (file_path, doc_papis, dockey, doc, texts, time.perf_counter())
+                )
+            else:
+                finish(file_path, None)
+
+    async def embed_stage() -> None:
+        async with asyncio.TaskGroup() as tg:
+            for _ in range(embed_workers):
+                tg.create_task(embed_worker())
+        for _ in range(concurrency["metadata"]):
+            await metadata_queue.put(None)
+
+    async def metadata_worker() -> None:
+        while (item := await metadata_queue.get()) is not None:
+            file_path, doc_papis, dockey, doc, texts, queued = item
+            with profile("metadata", file_path, time.perf_counter() - queued):
+                ref = await update_index_metadata(
+                    file_path=file_path,
+                    file_last_indexed=time.time(),
+                    dockey=dockey,
+                    docname=doc.docname,  # might have been made unique by `aadd_texts`
+                    doc_papis=doc_papis,
+                    docs_index=docs_index,
+                    clients=clients,
+                    settings=settings,
+                    texts=texts,
+                )
+            if ref:
+                save_fingerprints([(file_path, dockey, fingerprints[file_path])])
+            else:
+                logger.warning("Couldn't upgrade Doc to DocDetails.")
+                logger.warning("Usually, this means the 'info.yaml' has faults.")
+            finish(file_path, ref)
+
+    # spawn rather than fork, since forking a process running an event loop
+    # (and litellm's threads) is prone to deadlocks
+    with ProcessPoolExecutor(
+        max_workers=concurrency["parse"],
+        mp_context=multiprocessing.get_context("spawn"),
+    ) as pool:
+        try:
+            async with asyncio.TaskGroup() as tg:
+                tg.create_task(parse_stage(pool))
+                tg.create_task(embed_stage())
+                for _ in range(concurrency["metadata"]):
+                    tg.create_task(metadata_worker())
+        finally:
+            await batcher.aclose()
@@ -0,0 +1,251 @@
+"""Profiling of indexing runs.
+
+With `papis ask index --profile FILE`, every stage of indexing a file is
+recorded as a span: when the stage started and ended, how long the file
+waited for it beforehand (for a worker process, a queue, a lock or the rate
+limiter) and how many bytes it processed. Stages named "stage/part" are
+parts of "stage", and spans without a file cover the whole run.
+
+Recording a span only takes the time twice and appends it to a list, so
+profiling is cheap enough to leave on. At the end of the run, a summary of
+each stage is logged and the spans are written as a Chrome trace, which can
+be opened in Perfetto (https://ui.perfetto.dev) or chrome://tracing.
+"""
+
+import heapq
+import json
+import time
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+import papis.logging
+
+logger = papis.logging.get_logger(__name__)
+
+
+class Span:
+    """A stage of indexing a file, or of the whole run if `file` is empty."""
+
+    __slots__ = ("stage", "file", "start", "end", "wait", "nbytes")
+
+    def __init__(
+        self,
+        stage: str,
+        file: Any = "",
+        start: float = 0.0,
+        end: float = 0.0,
+        wait: float = 0.0,
+        nbytes: int = 0,
+    ) -> None:
+        self.stage = stage
+        self.file = file
+        self.start = start
+        self.end = end
+        self.wait = wait
+        self.nbytes = nbytes
+
+
+class IndexProfiler:
+    """Spans recorded during an indexing run."""
+
+    def __init__(self) -> None:
+        self.origin = time.perf_counter()
+        self.spans: List[Span] = []
+
+    def summary(self, slowest: int = 5) -> List[str]:
+        """Get a table of the time spent in each stage and the slowest files."""
+        stages: Dict[str, List[Span]] = {}
+        for span in sorted(self.spans, key=lambda span: span.start):
+            stages.setdefault(span.stage, []).append(span)
+        # parts follow their stage
+        order = list(dict.fromkeys(stage.split("/")[0] for stage in stages))
+        rows = sorted(
+            stages.items(),
+            key=lambda item: (order.index(item[0].split("/")[0]), item[0]),
+        )
+
+        lines = [
+            f"{'stage':<24} {'spans':>7} {'wall (s)':>9} {'mean (ms)':>9}"
+            f" {'max (ms)':>9} {'wait (s)':>9} {'MB':>8}"
+        ]
+        for stage, spans in rows:
+            durations = [span.end - span.start for span in spans]
+            lines.append(
+                f"{stage:<24} {len(spans):>7} {sum(durations):>9.2f}"
+                f" {sum(durations) / len(spans) * 1000:>9.1f}"
+                f" {max(durations) * 1000:>9.1f}"
+                f" {sum(span.wait for span in spans):>9.2f}"
+                f" {sum(span.nbytes for span in spans) / 1024**2:>8.1f}"
+            )
+        lines.append(f"Run took {time.perf_counter() - self.origin:.2f} s")
+
+        # a file's time is that of its stages, as their parts overlap them
+        files: Dict[str, float] = {}
+        for span in self.spans:
+            if span.file and "/" not in span.stage:
+                files[str(span.file)] = (
+                    files.get(str(span.file), 0.0) + span.end - span.start + span.wait
+                )
+        if files:
+            lines.append("Slowest files (including waiting):")
+            lines.extend(
+                f"{seconds:>9.2f} s  {file}"
+                for file, seconds in sorted(
+                    files.items(), key=lambda item: item[1], reverse=True
+                )[:slowest]
+            )
+        return lines
+
+    def write_trace(self, path: Path) -> None:
+        """Write the spans as a Chrome trace, with a process for each stage.
+
+        Each stage gets as many threads as it had spans at once, and the
+        time a file waited for the stage is shown right before its span.
+        """
+
+        def microseconds(seconds: float) -> float:
+            return round((seconds - self.origin) * 1e6, 1)
+
+        events: List[Dict[str, Any]] = []
+        pids: Dict[str, int] = {}
+        stages: Dict[str, List[Span]] = {}
+        for span in self.spans:
+            stages.setdefault(span.stage, []).append(span)
+        tid = 0
+        for stage, spans in stages.items():
+            process = stage.split("/")[0]
+            if process not in pids:
+                pids[process] = len(pids) + 1
+                events.append(
+                    {
+                        "ph": "M",
+                        "name": "process_name",
+                        "pid": pids[process],
+                        "args": {"name": process},
+                    }
+                )
+            pid = pids[process]
+
+            # (free from, tid) of the threads of this stage
+            threads: List[Tuple[float, int]] = []
+            for span in sorted(spans, key=lambda span: span.start - span.wait):
+                begin = span.start - span.wait
+                if threads and threads[0][0] <= begin:
+                    _, thread = heapq.heappop(threads)
+                else:
+                    tid += 1
+                    thread = tid
+                    events.append(
+                        {
+                            "ph": "M",
+                            "name": "thread_name",
+                            "pid": pid,
+                            "tid": thread,
+                            "args": {"name": stage},
+                        }
+                    )
+                heapq.heappush(threads, (span.end, thread))
+
+                args = {"file": str(span.file)} if span.file else {}
+                if span.wait > 0:
+                    events.append(
+                        {
+                            "ph": "X",
+                            "name": "waiting",
+                            "cat": stage,
+                            "pid": pid,
+                            "tid": thread,
+                            "ts": microseconds(begin),
+                            "dur": round(span.wait * 1e6, 1),
+                            "args": args,
+                        }
+                    )
+                events.append(
+                    {
+                        "ph": "X",
+                        "name": stage,
+                        "cat": stage,
+                        "pid": pid,
+                        "tid": thread,
+                        "ts": microseconds(span.start),
+                        "dur": round((span.end - span.start) * 1e6, 1),
+                        "args": {
+                            **args,
+                            "wait_ms": round(span.wait * 1000, 3),
+                            "bytes": span.nbytes,
+                        },
+                    }
+                )
+
+        with open(path, "w") as f:
+            json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, f)
+
+
+_profiler: Optional[IndexProfiler] = None
+
+# handed out when not profiling, so that callers needn't check
+_unrecorded = Span("")
+
+
+def start_profiling() -> IndexProfiler:
+    """Start recording spans."""
+    global _profiler
+    _profiler = IndexProfiler()
+    return _profiler
+
+
+def stop_profiling() -> None:
+    """Stop recording spans."""
+    global _profiler
+    _profiler = None
+
+
+@contextmanager
+def profiling(trace_file: Path) -> Iterator[IndexProfiler]:
+    """Record the spans of the enclosed code, then log a summary and write a trace.
+
+    The summary and trace are also written if the enclosed code fails.
+    """
+    profiler = start_profiling()
+    try:
+        yield profiler
+    finally:
+        stop_profiling()
+        for line in profiler.summary():
+            logger.info(line)
+        profiler.write_trace(trace_file)
+        logger.info(f"Wrote the trace to {trace_file}, open it in Perfetto")
+
+
+@contextmanager
+def profile(
+    stage: str, file: Any = "", wait: float = 0.0, nbytes: int = 0
+) -> Iterator[Span]:
+    """Record the enclosed code as a span of `stage` for `file`.
+
+    The span is yielded so that its bytes can be set once they are known.
+    """
+    profiler = _profiler
+    if profiler is None:
+        yield _unrecorded
+        return
+    span = Span(stage, file, time.perf_counter(), 0.0, wait, nbytes)
+    try:
+        yield span
+    finally:
+        span.end = time.perf_counter()
+        profiler.spans.append(span)
+
+
+def record(
+    stage: str,
+    file: Any,
+    start: float,
+    end: float,
+    wait: float = 0.0,
+    nbytes: int = 0,
+) -> None:
+    """Record a span that was timed elsewhere, e.g. in a worker process."""
+    if _profiler is not None:
+        _profiler.spans.append(Span(stage, file, start, end, wait, nbytes))
@@ -0,0 +1,287 @@
+"""Answering questions from the paperqa index."""
+
+import asyncio
+from typing import (
+    Any,
+    AsyncIterator,
+    Callable,
+    Dict,
+    List,
+    Optional,
+    Sequence,
+    Tuple,
+)
+
+import papis.config
+import papis.logging
+
+from papis_ask.config import SECTION_NAME
+from papis_ask.summary_cache import SummaryCache, prompt_version
+
+logger = papis.logging.get_logger(__name__)
+
+
+async def summarize(
+    text: Any,
+    question: str,
+    settings: Any,
+    summary_llm_model: Any,
+    prompt_templates: Tuple[str, str],
+    timeout: Optional[float],
+) -> Any:
+    """Summarize a text with respect to a question, within `timeout` seconds."""
+    from paperqa.core import llm_parse_json, map_fxn_summary
+
+    return await asyncio.wait_for(
+        map_fxn_summary(
+            text=text,
+            question=question,
+            summary_llm_model=summary_llm_model,
+            prompt_templates=prompt_templates,
+            extra_prompt_data={
+                "summary_length": settings.answer.evidence_summary_length,
+                "citation": f"{text.name}: {text.doc.formatted_citation}",
+            },
+            parser=llm_parse_json if settings.prompts.use_json else None,
+        ),
+        timeout,
+    )
+
+
+async def gather_evidence(
+    docs_index: Any,
+    question: str,
+    settings: Any,
+    summary_cache: Optional[SummaryCache] = None,
+    summary_semaphore: Optional[asyncio.Semaphore] = None,
+    rerank_keep: int = 0,
+) -> Any:
+    """Retrieve and summarize the evidence for a question.
+
+    This does what `Docs.aget_evidence` does, except that:
+
+    - with `rerank_keep` > 0, only that many of the retrieved chunks are
+      summarized, after reranking them locally (see `papis_ask.rerank`)
+    - the summaries are looked up in the `summary_cache` first, and only the
+      missing ones are made by the summary LLM
+    - every summary has to be made within `summary-timeout` seconds, and
+      summaries that time out or fail are left out, unless all of them do
+    - at most `summary_semaphore` summaries are made at once, which may be
+      shared by several questions (`max_concurrent_requests` otherwise)
+    """
+    answer_config = settings.answer
+    prompt_config = settings.prompts
+    if not answer_config.evidence_retrieval or answer_config.evidence_skip_summary:
+        return await docs_index.aget_evidence(question, settings=settings)
+
+    from lmi.types import set_llm_session_ids
+    from lmi.utils import gather_with_concurrency
+    from paperqa.types import Context, PQASession, Text
+
+    session = PQASession(question=question, config_md5=settings.md5)
+    if not docs_index.docs and len(docs_index.texts_index) == 0:
+        return session
+
+    embedding_model = settings.get_embedding_model()
+    # embedded once, to retrieve the texts and to look up similar questions
+    await docs_index.texts_index.embed_queries([question], embedding_model)
+    matches = await docs_index.retrieve_texts(
+        question, answer_config.evidence_k, settings, embedding_model
+    )
+    if 0 < rerank_keep < len(matches):
+        from papis_ask.rerank import rerank
+
+        logger.debug(f"Keeping {rerank_keep} of {len(matches)} retrieved chunks")
+        matches = rerank(question, matches, rerank_keep)
+
+    if prompt_config.use_json:
+        prompt_templates = (
+            prompt_config.summary_json,
+            prompt_config.summary_json_system,
+        )
+    else:
+        prompt_templates = (prompt_config.summary, prompt_config.system)
+    cache_options: Dict[str, Any] = {
+        "question": question,
+        "model": settings.summary_llm,
+        "version": prompt_version(
+            *prompt_templates,
+            prompt_config.use_json,
+            answer_config.evidence_summary_length,
+        ),
+    }
+    cached: List[Any] = [None] * len(matches)
+    if summary_cache is not None:
+        if summary_cache.uses_similar_questions:
+            embedding = await docs_index.texts_index.embed_query(
+                question, embedding_model
+            )
+            cache_options.update(
+                embedding_model=settings.embedding, embedding=embedding
+            )
+        cached = summary_cache.get_many([m.text for m in matches], **cache_options)
+        logger.debug(
+            f"Found {sum(summary is not None for summary in cached)} of"
+            f" {len(matches)} evidence summaries in the cache"
+        )
+    missing = [m for m, summary in zip(matches, cached) if summary is None]
+
+    timeout = papis.config.getfloat("summary-timeout", SECTION_NAME) or None
+    summary_llm_model = settings.get_summary_llm()
+
+    async def try_summarize(text: Any) -> Any:
+        try:
+            return await summarize(
+                text, question, settings, summary_llm_model, prompt_templates, timeout
+            )
+        except asyncio.TimeoutError as e:
+            return TimeoutError(f"timed out after {timeout:g}s") if timeout else e
+        except Exception as e:
+            return e
+
+    with set_llm_session_ids(session.id):
+        results = await gather_with_concurrency(
+            summary_semaphore or answer_config.max_concurrent_requests,
+            [try_summarize(m) for m in missing],
+        )
+
+    made: List[Tuple[Any, Any]] = []
+    errors = []
+    for m, result in zip(missing, results):
+        if isinstance(result, Exception):
+            logger.warning(f"Left out the evidence from '{m.name}': {result}")
+            errors.append(result)
+            continue
+        context, llm_result = result
+        session.add_tokens(llm_result)
+        made.append((m, context))
+    if errors and len(errors) == len(matches):
+        # e.g. the summary LLM isn't reachable at all
+        raise errors[0]
+
+    if summary_cache is not None and made:
+        summary_cache.put_many(
+            [m.text for m, _ in made],
+            [
+                (
+                    context.context,
+                    context.score,
+                    # extra fields parsed from JSON summaries
+                    context.model_dump(
+                        exclude={"id", "context", "question", "text", "score"}
+                    ),
+                )
+                for _, context in made
+            ],
+            **cache_options,
+        )
+
+    made_by_text = {id(m): context for m, context in made}
+    for m, summary in zip(matches, cached):
+        if summary is None:
+            if id(m) in made_by_text:
+                session.contexts.append(made_by_text[id(m)])
+            continue
+        context, score, extras = summary
+        session.contexts.append(
+            Context(
+                context=context,
+                question=question,
+                text=Text(
+                    doc=m.doc.model_dump(exclude={"embedding"}),
+                    **m.model_dump(exclude={"embedding", "doc"}),
+                ),
+                score=score,
+                **extras,
+            )
+        )
+    return session
+
+
+async def answer_question(
+    docs_index: Any,
+    question: str,
+    settings: Any,
+    on_evidence: Optional[Callable[[Dict[str, str]], None]] = None,
+    on_token: Optional[Callable[[str], None]] = None,
+    summary_cache: Optional[SummaryCache] = None,
+    summary_semaphore: Optional[asyncio.Semaphore] = None,
+    rerank_keep: int = 0,
+    on_start: Optional[Callable[[], None]] = None,
+) -> Any:
+    """Answer a question, optionally streaming the answer.
+
+    See `gather_evidence` for the `summary_cache`, `summary_semaphore` and
+    `rerank_keep`.
+    `on_start` is called before gathering evidence. Once the evidence is
+    gathered, `on_evidence` is called with the Papis
+    references of the document names used in citations (see
+    `get_citation_refs`). Then, `on_token` is called with every piece of the
+    answer as it's generated.
+    """
+    if on_start is not None:
+        on_start()
+    session = await gather_evidence(
+        docs_index, question, settings, summary_cache, summary_semaphore, rerank_keep
+    )
+    if on_evidence is not None:
+        from papis_ask.output import get_citation_refs
+
+        on_evidence(get_citation_refs(session.contexts))
+
+    callbacks = None
+    if on_token is not None:
+
+        def stream(text: str, name: Optional[str] = None) -> None:
+            # ignore the optional pre and post prompts
+            if name == "answer":
+                on_token(text)
+
+        callbacks = [stream]
+
+    # the evidence is gathered, even if none was found
+    answer_settings = settings.model_copy(deep=True)
+    answer_settings.answer.get_evidence_if_no_contexts = False
+    return await docs_index.aquery(
+        session, settings=answer_settings, callbacks=callbacks
+    )
+
+
+async def answer_questions(
+    docs_index: Any,
+    questions: Sequence[str],
+    settings: Any,
+    concurrency: int,
+    summary_cache: Optional[SummaryCache] = None,
+    rerank_keep: int = 0,
+) -> AsyncIterator[Tuple[str, Any]]:
+    """Answer many questions, at most `concurrency` at once.
+
+    The questions are embedded together up front, and the limit on the
+    number of summaries made at once applies to all questions together.
+    (question, answer) pairs are yielded in the order the questions are
+    answered, with the exception instead of the answer for questions that
+    couldn't be answered.
+    """
+    await docs_index.texts_index.embed_queries(
+        questions, settings.get_embedding_model()
+    )
+    semaphore = asyncio.Semaphore(max(1, concurrency))
+    summary_semaphore = asyncio.Semaphore(settings.answer.max_concurrent_requests)
+
+    async def answer(question: str) -> Tuple[str, Any]:
+        async with semaphore:
+            try:
+                return question, await answer_question(
+                    docs_index,
+                    question,
+                    settings,
+                    summary_cache=summary_cache,
+                    summary_semaphore=summary_semaphore,
+                    rerank_keep=rerank_keep,
+                )
+            except Exception as e:
+                return question, e
+
+    for result in asyncio.as_completed([answer(question) for question in questions]):
+        yield await result
@@ -0,0 +1,56 @@
+"""Local reranking of retrieved chunks before they are summarized.
+
+Every retrieved chunk is summarized by the summary LLM, which is where the
+time and cost of answering a question go. To retrieve many chunks but only
+summarize the best of them, the retrieval order (by embeddings) is fused
+with the order by BM25 score of the question's words, computed over the
+retrieved chunks only, and only the best chunks are kept.
+"""
+
+import math
+import re
+from collections import Counter
+from typing import Any, List, Sequence
+
+from papis_ask.vectors import reciprocal_rank_fusion
+
+# BM25 parameters: term frequency saturation and document length normalization
+BM25_K1 = 1.2
+BM25_B = 0.75
+
+
+def tokenize(text: str) -> List[str]:
+    return [word.casefold() for word in re.findall(r"\w+", text)]
+
+
+def bm25_scores(query: str, texts: Sequence[str]) -> List[float]:
+    """Score texts by the words of a query, with statistics from the texts only."""
+    documents = [Counter(tokenize(text)) for text in texts]
+    if not documents:
+        return []
+    lengths = [sum(document.values()) for document in documents]
+    average_length = sum(lengths) / len(lengths) or 1.0
+
+    scores = [0.0] * len(documents)
+    for term in set(tokenize(query)):
+        frequency = sum(term in document for document in documents)
+        if frequency == 0:
+            continue
+        idf = math.log(1 + (len(documents) - frequency + 0.5) / (frequency + 0.5))
+        for i, (document, length) in enumerate(zip(documents, lengths)):
+            count = document[term]
+            scores[i] += (
+                idf
+                * count
+                * (BM25_K1 + 1)
+                / (count + BM25_K1 * (1 - BM25_B + BM25_B * length / average_length))
+            )
+    return scores
+
+
+def rerank(question: str, texts: Sequence[Any], keep: int) -> List[Any]:
+    """Keep the `keep` best of the retrieved texts, which are in retrieval order."""
+    scores = bm25_scores(question, [text.text for text in texts])
+    lexical = sorted(range(len(texts)), key=lambda i: -scores[i])
+    ranking = reciprocal_rank_fusion([range(len(texts)), lexical])
+    return [texts[i] for i in ranking[:keep]]
@@ -0,0 +1,668 @@
+"""SQLite storage of the paperqa index.
+
+Every document is stored as one row in `docs` and its text chunks as rows in
+`texts`, so adding, updating or removing a document only writes that
+document's rows in a single transaction.
+
+The embeddings of all text chunks are kept in a separate, append-only file
+forming one contiguous float32 matrix, which can be memory-mapped when
+answering questions. Each text row refers to its row in that matrix, and
+the rows of removed texts are only dropped by compacting the store. An
+optional approximate nearest neighbour index of the matrix is kept next to
+it (see `papis_ask.ann`), as is an optional full-text index of the texts
+(see `papis_ask.fulltext`).
+
+The `files` table holds the fingerprint of every indexed file, which is
+used to detect changed files without hashing them. The `enrichment` table
+queues documents waiting for external metadata, and the `postings` table
+lists the terms of every document's metadata (see `papis_ask.filters`).
+The `generation` meta key
+counts the changes to the index, so that answers can be cached until the
+index changes.
+"""
+
+import pickle
+import shutil
+import sqlite3
+import time
+from pathlib import Path
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Set, Tuple
+
+import papis.logging
+
+from papis_ask.filters import get_postings
+from papis_ask.fingerprint import Fingerprint
+
+logger = papis.logging.get_logger(__name__)
+
+SCHEMA_VERSION = 1
+# embeddings copied at once when rewriting or converting the embedding matrix
+COMPACT_BATCH_ROWS = 16384
+# precisions of the optional reduced-precision copy of the embedding matrix
+QUANTIZED_PRECISIONS = ("float16", "int8")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS docs (
+    dockey TEXT PRIMARY KEY,
+    docname TEXT NOT NULL,
+    doc BLOB NOT NULL
+);
+CREATE TABLE IF NOT EXISTS texts (
+    id INTEGER PRIMARY KEY,
+    dockey TEXT NOT NULL,
+    seq INTEGER NOT NULL,
+    name TEXT NOT NULL,
+    text TEXT NOT NULL,
+    row INTEGER
+);
+CREATE INDEX IF NOT EXISTS texts_dockey ON texts (dockey, seq);
+CREATE TABLE IF NOT EXISTS files (
+    path TEXT PRIMARY KEY,
+    dockey TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    inode INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS enrichment (
+    dockey TEXT PRIMARY KEY,
+    query BLOB NOT NULL,
+    queued REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS postings (
+    field TEXT NOT NULL,
+    term TEXT NOT NULL,
+    dockey TEXT NOT NULL,
+    PRIMARY KEY (field, term, dockey)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS postings_term ON postings (term);
+CREATE INDEX IF NOT EXISTS postings_dockey ON postings (dockey);
+"""
+
+
+class EmbeddingMatrix:
+    """Append-only file of float32 embeddings, one row per text chunk."""
+
+    def __init__(self, path: Path, dim: Optional[int]) -> None:
+        self.path = path
+        self.dim = dim
+
+    @property
+    def row_bytes(self) -> int:
+        return 4 * (self.dim or 0)
+
+    def __len__(self) -> int:
+        if not self.dim or not self.path.exists():
+            return 0
+        return self.path.stat().st_size // self.row_bytes
+
+    def append(self, embeddings: List[List[float]]) -> int:
+        """Append embeddings and return the row of the first one."""
+        import numpy as np
+
+        matrix = np.asarray(embeddings, dtype=np.float32)
+        if matrix.ndim != 2:
+            raise ValueError("Embeddings must all have the same dimension")
+        if self.dim is None:
+            self.dim = matrix.shape[1]
+        elif matrix.shape[1] != self.dim:
+            raise ValueError(
+                f"Embeddings have dimension {matrix.shape[1]} but the index uses"
+                f" {self.dim}. Regenerate the index with 'papis ask index --force'"
+                " after changing the embedding model."
+            )
+
+        first_row = len(self)
+        with open(self.path, "ab") as f:
+            # drop a partially written row left behind by an interrupted run
+            f.truncate(first_row * self.row_bytes)
+            f.write(matrix.tobytes())
+        return first_row
+
+    def open(self) -> Any:
+        """Memory-map the matrix read-only."""
+        import numpy as np
+
+        rows = len(self)
+        if rows == 0:
+            return np.zeros((0, self.dim or 0), dtype=np.float32)
+        return np.memmap(self.path, dtype=np.float32, mode="r", shape=(rows, self.dim))
+
+    def clear(self) -> None:
+        self.path.unlink(missing_ok=True)
+        self.dim = None
+
+
+class QuantizedMatrix:
+    """Reduced-precision copy of the embedding matrix, extended like it.
+
+    Every row is normalized before it's stored as "float16" or "int8", so
+    that its dot product with a normalized question is the cosine
+    similarity. With "int8", every row is scaled so that its largest value
+    is 127, and the scales are stored as float32 in a separate file.
+    """
+
+    def __init__(self, path: Path, precision: str, dim: Optional[int]) -> None:
+        if precision not in QUANTIZED_PRECISIONS:
+            raise ValueError(f"Unknown embedding precision '{precision}'")
+        self.path = path
+        self.scales_path = path.with_name(path.name + ".scales")
+        self.precision = precision
+        self.dim = dim
+
+    @property
+    def row_bytes(self) -> int:
+        return (1 if self.precision == "int8" else 2) * (self.dim or 0)
+
+    def __len__(self) -> int:
+        if not self.dim or not self.path.exists():
+            return 0
+        rows = self.path.stat().st_size // self.row_bytes
+        if self.precision == "int8":
+            scales = self.scales_path.stat().st_size if self.scales_path.exists() else 0
+            rows = min(rows, scales // 4)
+        return rows
+
+    def update(self, matrix: Any) -> int:
+        """Add the rows appended to the embedding matrix since the last update.
+
+        The copy is rebuilt if it has more rows than the matrix, which was
+        then rewritten. Returns the number of rows added.
+        """
+        import numpy as np
+
+        if len(self) > len(matrix) or self.dim != matrix.shape[1]:
+            self.clear()
+            self.dim = matrix.shape[1]
+        first_row = len(self)
+        if first_row == len(matrix):
+            return 0
+
+        # drop partially written rows left behind by an interrupted run
+        if self.precision == "int8":
+            with open(self.scales_path, "ab") as scales:
+                scales.truncate(first_row * 4)
+        with open(self.path, "ab") as values:
+            values.truncate(first_row * self.row_bytes)
+            for start in range(first_row, len(matrix), COMPACT_BATCH_ROWS):
+                block = np.asarray(
+                    matrix[start : start + COMPACT_BATCH_ROWS], dtype=np.float32
+                )
+                norms = np.linalg.norm(block, axis=1, keepdims=True)
+                norms[norms == 0] = 1.0
+                block = block / norms
+                if self.precision == "float16":
+                    values.write(block.astype(np.float16).tobytes())
+                    continue
+
+                row_scales = np.abs(block).max(axis=1, keepdims=True) / 127
+                row_scales[row_scales == 0] = 1.0
+                # the scales first, as the shorter file determines the length
+                with open(self.scales_path, "ab") as scales:
+                    scales.write(row_scales.astype(np.float32).tobytes())
+                values.write(np.rint(block / row_scales).astype(np.int8).tobytes())
+        return len(matrix) - first_row
+
+    def open(self) -> Tuple[Any, Optional[Any]]:
+        """Memory-map the rows and, with "int8", their scales read-only."""
+        import numpy as np
+
+        rows = len(self)
+        dtype = np.int8 if self.precision == "int8" else np.float16
+        if rows == 0:
+            return np.zeros((0, self.dim or 0), dtype=dtype), None
+        values = np.memmap(self.path, dtype=dtype, mode="r", shape=(rows, self.dim))
+        if self.precision != "int8":
+            return values, None
+        return values, np.memmap(
+            self.scales_path, dtype=np.float32, mode="r", shape=(rows,)
+        )
+
+    def clear(self) -> None:
+        self.path.unlink(missing_ok=True)
+        self.scales_path.unlink(missing_ok=True)
+
+
+class IndexStore:
+    """Transactional per-document storage of a paperqa Docs instance."""
+
+    def __init__(self, path: Path) -> None:
+        self.path = path
+        self.connection = sqlite3.connect(path)
+        self.connection.execute("PRAGMA journal_mode = WAL")
+        self.connection.execute("PRAGMA synchronous = NORMAL")
+        with self.connection:
+            self.connection.executescript(SCHEMA)
+            if self.get_meta("schema_version") is None:
+                self.set_meta("schema_version", SCHEMA_VERSION)
+
+        dim = self.get_meta("embedding_dim")
+        self.embeddings = EmbeddingMatrix(
+            path.with_name(path.name + ".embeddings"), int(dim) if dim else None
+        )
+        # approximate nearest neighbour index of the embedding matrix
+        self.ann_path = path.with_name(path.name + ".ann.npz")
+        # full-text index of the texts
+        self.fulltext_path = path.with_name(path.name + ".fulltext")
+        # embedding matrix rewritten by `compact`
+        self.compacted_path = path.with_name(path.name + ".embeddings.compact")
+        if self.get_meta("compacted_rows") is not None:
+            logger.info("Finishing an interrupted compaction of the index")
+            self._replace_compacted_embeddings()
+
+    def get_quantized(self, precision: str) -> QuantizedMatrix:
+        """Get the reduced-precision copy of the embedding matrix."""
+        return QuantizedMatrix(
+            self.path.with_name(f"{self.path.name}.embeddings.{precision}"),
+            precision,
+            self.embeddings.dim,
+        )
+
+    def clear_quantized(self) -> None:
+        for precision in QUANTIZED_PRECISIONS:
+            self.get_quantized(precision).clear()
+
+    def close(self) -> None:
+        self.connection.close()
+
+    def get_meta(self, key: str) -> Optional[str]:
+        row = self.connection.execute(
+            "SELECT value FROM meta WHERE key = ?", (key,)
+        ).fetchone()
+        return row[0] if row else None
+
+    def set_meta(self, key: str, value: Any) -> None:
+        self.connection.execute(
+            "INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", (key, str(value))
+        )
+
+    def save_meta(self, key: str, value: Any) -> None:
+        with self.connection:
+            self.set_meta(key, value)
+
+    def get_generation(self) -> int:
+        """Get the number of changes made to the index so far."""
+        return int(self.get_meta("generation") or 0)
+
+    def bump_generation(self) -> None:
+        """Record a change to the index that isn't written through the store."""
+        with self.connection:
+            self._bump_generation()
+
+    def is_empty(self) -> bool:
+        """Check whether the store contains any documents."""
+        return self.connection.execute("SELECT 1 FROM docs LIMIT 1").fetchone() is None
+
+    # NOTE: no types because we'd have to globally import Docs
+    def load(self, with_texts: bool = True):
+        """Build a paperqa Docs instance from the stored documents.
+
+        Without texts, only the documents are loaded. This is all that's needed
+        to add, update or remove documents, as the texts of a document are
+        found through the `texts_dockey` index.
+        """
+        from paperqa import Docs
+        from paperqa.types import Text
+
+        matrix = self.embeddings.open()
+        docs = {
+            dockey: pickle.loads(doc)
+            for dockey, doc in self.connection.execute("SELECT dockey, doc FROM docs")
+        }
+        texts = (
+            [
+                Text(
+                    text=text,
+                    name=name,
+                    doc=docs[dockey],
+                    embedding=None if row is None else matrix[row].tolist(),
+                )
+                for dockey, name, text, row in self.connection.execute(
+                    "SELECT dockey, name, text, row FROM texts ORDER BY dockey, seq"
+                )
+                if dockey in docs
+            ]
+            if with_texts
+            else []
+        )
+        return Docs(
+            docs=docs,
+            texts=texts,
+            docnames={doc.docname for doc in docs.values()},
+        )
+
+    def get_rows(self, dockeys: Optional[Iterable[str]] = None) -> Any:
+        """Get the embedding matrix rows of all stored texts, or those of `dockeys`."""
+        import numpy as np
+
+        if dockeys is None:
+            rows: Iterable[Tuple[int]] = self.connection.execute(
+                "SELECT row FROM texts WHERE row IS NOT NULL ORDER BY row"
+            )
+        else:
+            rows = (
+                row
+                for dockey in dockeys
+                for row in self.connection.execute(
+                    "SELECT row FROM texts WHERE dockey = ? AND row IS NOT NULL",
+                    (dockey,),
+                )
+            )
+        return np.sort(np.fromiter((row for (row,) in rows), dtype=np.int64))
+
+    def match_postings(self, field: Optional[str], prefix: str) -> Set[str]:
+        """Get the dockeys with a term starting with `prefix` in `field`, or any field."""
+        pattern = prefix.replace("[", "[[]").replace("*", "[*]").replace("?", "[?]")
+        if field is None:
+            return {
+                dockey
+                for (dockey,) in self.connection.execute(
+                    "SELECT DISTINCT dockey FROM postings WHERE term GLOB ?",
+                    (pattern + "*",),
+                )
+            }
+        return {
+            dockey
+            for (dockey,) in self.connection.execute(
+                "SELECT DISTINCT dockey FROM postings WHERE field = ? AND term GLOB ?",
+                (field, pattern + "*"),
+            )
+        }
+
+    def compare_postings(
+        self, field: Optional[str], operator: str, number: int
+    ) -> Set[str]:
+        """Get the dockeys with a numeric term in `field` comparing to `number`."""
+        if operator not in ("<", "<=", ">", ">="):
+            raise ValueError(f"Unknown comparison '{operator}'")
+        condition = f"term NOT GLOB '*[^0-9]*' AND CAST(term AS INTEGER) {operator} ?"
+        if field is None:
+            return {
+                dockey
+                for (dockey,) in self.connection.execute(
+                    f"SELECT DISTINCT dockey FROM postings WHERE {condition}",
+                    (number,),
+                )
+            }
+        return {
+            dockey
+            for (dockey,) in self.connection.execute(
+                f"SELECT DISTINCT dockey FROM postings WHERE field = ? AND {condition}",
+                (field, number),
+            )
+        }
+
+    def get_texts_from_row(self, first_row: int) -> Iterator[Tuple[int, str, str]]:
+        """Get the (row, dockey, text) triples of the texts from a matrix row on."""
+        return self.connection.execute(
+            "SELECT row, dockey, text FROM texts WHERE row >= ? ORDER BY row",
+            (first_row,),
+        )
+
+    def load_texts(self, rows: Iterable[int], matrix: Any) -> Dict[int, Any]:
+        """Load the texts (and their documents) stored at the given matrix rows."""
+        from paperqa.types import Text
+
+        rows = [int(row) for row in rows]
+        placeholders = ", ".join("?" * len(rows))
+        stored_texts = self.connection.execute(
+            f"SELECT row, dockey, name, text FROM texts WHERE row IN ({placeholders})",
+            rows,
+        ).fetchall()
+
+        dockeys = list({dockey for _, dockey, _, _ in stored_texts})
+        placeholders = ", ".join("?" * len(dockeys))
+        docs = {
+            dockey: pickle.loads(doc)
+            for dockey, doc in self.connection.execute(
+                f"SELECT dockey, doc FROM docs WHERE dockey IN ({placeholders})",
+                dockeys,
+            )
+        }
+        return {
+            row: Text(
+                text=text,
+                name=name,
+                doc=docs[dockey],
+                embedding=matrix[row].tolist(),
+            )
+            for row, dockey, name, text in stored_texts
+            if dockey in docs
+        }
+
+    def save_document(self, doc: Any, texts: Iterable[Any]) -> None:
+        """Write a document and its texts, replacing any previous version."""
+        with self.connection:
+            self._write_document(doc, list(texts))
+
+    def save_doc(self, doc: Any) -> None:
+        """Write only a document's metadata, keeping its stored texts."""
+        with self.connection:
+            self._bump_generation()
+            self.connection.execute(
+                "INSERT OR REPLACE INTO docs (dockey, docname, doc) VALUES (?, ?, ?)",
+                (doc.dockey, doc.docname, pickle.dumps(doc)),
+            )
+            self._write_postings(doc)
+
+    def get_text_row(self, dockey: str, name: str) -> Optional[int]:
+        """Get the embedding matrix row of a stored text, if it has one."""
+        stored = self.connection.execute(
+            "SELECT row FROM texts WHERE dockey = ? AND name = ?", (dockey, name)
+        ).fetchone()
+        return None if stored is None else stored[0]
+
+    def has_texts(self, dockey: str) -> bool:
+        """Check whether the texts of a document are stored."""
+        return (
+            self.connection.execute(
+                "SELECT 1 FROM texts WHERE dockey = ? LIMIT 1", (dockey,)
+            ).fetchone()
+            is not None
+        )
+
+    def get_fingerprints(self) -> Dict[str, Fingerprint]:
+        """Get the fingerprints of all indexed files."""
+        return {
+            path: Fingerprint(size, mtime_ns, inode)
+            for path, size, mtime_ns, inode in self.connection.execute(
+                "SELECT path, size, mtime_ns, inode FROM files"
+            )
+        }
+
+    def save_fingerprints(
+        self, fingerprints: Iterable[Tuple[str, str, Fingerprint]]
+    ) -> None:
+        """Write the fingerprints of (file path, dockey, fingerprint) triples."""
+        with self.connection:
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO files (path, dockey, size, mtime_ns, inode)"
+                " VALUES (?, ?, ?, ?, ?)",
+                (
+                    (path, dockey, *fingerprint)
+                    for path, dockey, fingerprint in fingerprints
+                ),
+            )
+
+    def get_doc(self, dockey: str) -> Optional[Any]:
+        """Load a single document without its texts."""
+        row = self.connection.execute(
+            "SELECT doc FROM docs WHERE dockey = ?", (dockey,)
+        ).fetchone()
+        return pickle.loads(row[0]) if row else None
+
+    def get_enrichments(self) -> List[Tuple[str, Dict[str, Any]]]:
+        """Get the (dockey, query) pairs of documents waiting for metadata."""
+        return [
+            (dockey, pickle.loads(query))
+            for dockey, query in self.connection.execute(
+                "SELECT dockey, query FROM enrichment ORDER BY queued"
+            )
+        ]
+
+    def queue_enrichment(self, dockey: str, query: Dict[str, Any]) -> None:
+        """Queue a document for external metadata lookup."""
+        with self.connection:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO enrichment (dockey, query, queued)"
+                " VALUES (?, ?, ?)",
+                (dockey, pickle.dumps(query), time.time()),
+            )
+
+    def finish_enrichment(self, dockey: str) -> None:
+        """Remove a document from the metadata lookup queue."""
+        with self.connection:
+            self.connection.execute(
+                "DELETE FROM enrichment WHERE dockey = ?", (dockey,)
+            )
+
+    def delete_document(self, dockey: str) -> None:
+        """Remove a document, its texts, its fingerprint and queued lookups.
+
+        Their embeddings stay in the matrix until the index is rewritten.
+        """
+        with self.connection:
+            self.connection.execute("DELETE FROM texts WHERE dockey = ?", (dockey,))
+            self.connection.execute("DELETE FROM docs WHERE dockey = ?", (dockey,))
+            self.connection.execute("DELETE FROM files WHERE dockey = ?", (dockey,))
+            self.connection.execute(
+                "DELETE FROM enrichment WHERE dockey = ?", (dockey,)
+            )
+            self.connection.execute("DELETE FROM postings WHERE dockey = ?", (dockey,))
+            self._bump_generation()
+
+    # NOTE: no types because we'd have to globally import Docs
+    def replace_all(self, docs_index) -> None:
+        """Replace the stored documents with those of a Docs instance."""
+        texts_by_dockey: dict = {}
+        for text in docs_index.texts:
+            texts_by_dockey.setdefault(text.doc.dockey, []).append(text)
+
+        with self.connection:
+            self.connection.execute("DELETE FROM texts")
+            self.connection.execute("DELETE FROM docs")
+            self.connection.execute("DELETE FROM files")
+            self.connection.execute("DELETE FROM enrichment")
+            self.connection.execute("DELETE FROM postings")
+            self.connection.execute(
+                "DELETE FROM meta WHERE key IN ('embedding_dim', 'fulltext_next_row')"
+            )
+            self.embeddings.clear()
+            self.ann_path.unlink(missing_ok=True)
+            self.clear_quantized()
+            shutil.rmtree(self.fulltext_path, ignore_errors=True)
+            for dockey, doc in docs_index.docs.items():
+                self._write_document(doc, texts_by_dockey.get(dockey, []))
+            self._bump_generation()
+
+    def compact(self) -> Dict[str, int]:
+        """Drop what's left behind by removed documents and rewrite the index.
+
+        This removes the texts, fingerprints, queued lookups and postings of
+        documents that aren't stored, repeated chunks of the same document,
+        and the embeddings no text refers to anymore. The embedding matrix is
+        rewritten without gaps, so the nearest neighbour and full-text
+        indexes, which refer to its rows, are dropped and have to be rebuilt.
+        Returns the number of removed items by kind.
+        """
+        removed = {}
+        with self.connection:
+            for table, kind in (
+                ("texts", "orphaned texts"),
+                ("files", "orphaned file fingerprints"),
+                ("enrichment", "orphaned metadata lookups"),
+                ("postings", "orphaned metadata terms"),
+            ):
+                removed[kind] = self.connection.execute(
+                    f"DELETE FROM {table} WHERE dockey NOT IN (SELECT dockey FROM docs)"
+                ).rowcount
+            removed["duplicate texts"] = self.connection.execute(
+                "DELETE FROM texts WHERE id NOT IN"
+                " (SELECT MIN(id) FROM texts GROUP BY dockey, text)"
+            ).rowcount
+
+        texts = self.connection.execute(
+            "SELECT id, row FROM texts WHERE row IS NOT NULL ORDER BY dockey, seq"
+        ).fetchall()
+        matrix = self.embeddings.open()
+        removed["embeddings"] = len(matrix) - len(texts)
+
+        compacted = EmbeddingMatrix(self.compacted_path, self.embeddings.dim)
+        compacted.path.unlink(missing_ok=True)
+        for start in range(0, len(texts), COMPACT_BATCH_ROWS):
+            batch = texts[start : start + COMPACT_BATCH_ROWS]
+            compacted.append(matrix[[row for _, row in batch]])
+        del matrix
+
+        # The rows are remapped before the matrix is replaced, and the
+        # replacement is recorded with them, so that an interrupted run
+        # finishes it when the store is opened again
+        with self.connection:
+            self.connection.executemany(
+                "UPDATE texts SET row = ? WHERE id = ?",
+                ((row, text_id) for row, (text_id, _) in enumerate(texts)),
+            )
+            self.connection.execute("DELETE FROM meta WHERE key = 'fulltext_next_row'")
+            self.set_meta("compacted_rows", len(texts))
+            self._bump_generation()
+        self._replace_compacted_embeddings()
+
+        self.connection.execute("VACUUM")
+        self.connection.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        return removed
+
+    def _replace_compacted_embeddings(self) -> None:
+        """Replace the embedding matrix by the one written by `compact`."""
+        rows = int(self.get_meta("compacted_rows") or 0)
+        if self.compacted_path.exists():
+            self.compacted_path.replace(self.embeddings.path)
+        elif rows == 0:
+            self.embeddings.path.unlink(missing_ok=True)
+        # the indexes refer to the rows of the old matrix
+        self.ann_path.unlink(missing_ok=True)
+        self.clear_quantized()
+        shutil.rmtree(self.fulltext_path, ignore_errors=True)
+        with self.connection:
+            self.connection.execute("DELETE FROM meta WHERE key = 'compacted_rows'")
+
+    def _bump_generation(self) -> None:
+        self.connection.execute(
+            "INSERT INTO meta (key, value) VALUES ('generation', '1')"
+            " ON CONFLICT (key) DO UPDATE SET value = CAST(value AS INTEGER) + 1"
+        )
+
+    def _write_document(self, doc: Any, texts: List[Any]) -> None:
+        rows: List[Optional[int]] = [None] * len(texts)
+        embedded = [i for i, text in enumerate(texts) if text.embedding is not None]
+        if embedded:
+            # The matrix is written first, so an interrupted transaction only
+            # leaves unreferenced rows behind
+            first_row = self.embeddings.append([texts[i].embedding for i in embedded])
+            for offset, i in enumerate(embedded):
+                rows[i] = first_row + offset
+            self.set_meta("embedding_dim", self.embeddings.dim)
+
+        self.connection.execute("DELETE FROM texts WHERE dockey = ?", (doc.dockey,))
+        self._bump_generation()
+        self.connection.execute(
+            "INSERT OR REPLACE INTO docs (dockey, docname, doc) VALUES (?, ?, ?)",
+            (doc.dockey, doc.docname, pickle.dumps(doc)),
+        )
+        self.connection.executemany(
+            "INSERT INTO texts (dockey, seq, name, text, row) VALUES (?, ?, ?, ?, ?)",
+            (
+                (doc.dockey, seq, text.name, text.text, row)
+                for seq, (text, row) in enumerate(zip(texts, rows))
+            ),
+        )
+        self._write_postings(doc)
+
+    def _write_postings(self, doc: Any) -> None:
+        self.connection.execute("DELETE FROM postings WHERE dockey = ?", (doc.dockey,))
+        self.connection.executemany(
+            "INSERT INTO postings (field, term, dockey) VALUES (?, ?, ?)",
+            ((field, term, doc.dockey) for field, term in get_postings(doc)),
+        )
@@ -0,0 +1,230 @@
+"""Persistent cache of the evidence summaries of text chunks.
+
+Gathering evidence for a question asks the summary LLM to summarize every
+retrieved chunk with respect to the question. Follow-up questions retrieve
+many of the same chunks, so the summaries are cached by the chunk text, the
+question, the summary model and the summary prompts. Optionally, summaries
+made for earlier questions whose embedding is at least `similarity` similar
+to a new question are reused for it as well.
+"""
+
+import hashlib
+import json
+import sqlite3
+import time
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+import papis.logging
+
+from papis_ask.answer_cache import normalize_question
+
+logger = papis.logging.get_logger(__name__)
+
+# (summary, score, extra fields parsed from the summary)
+Summary = Tuple[str, int, Dict[str, Any]]
+
+
+def chunk_key(text: str) -> bytes:
+    return hashlib.sha256(text.encode()).digest()
+
+
+def prompt_version(*parts: Any) -> str:
+    """Identify the prompts and prompt parameters used to make summaries."""
+    return hashlib.sha256(json.dumps(parts).encode()).hexdigest()[:16]
+
+
+class SummaryCache:
+    """Persistent cache of evidence summaries.
+
+    Summaries are cached for the combination of a `model` and a prompt
+    `version` (see `prompt_version`). The least recently used summaries are
+    evicted beyond `max_bytes`. A `similarity` of 1 or more disables reusing
+    the summaries made for other questions.
+    """
+
+    SCHEMA = """
+    CREATE TABLE IF NOT EXISTS questions (
+        id INTEGER PRIMARY KEY,
+        question TEXT NOT NULL UNIQUE,
+        embedding_model TEXT,
+        embedding BLOB
+    );
+    CREATE TABLE IF NOT EXISTS summaries (
+        chunk BLOB NOT NULL,
+        question_id INTEGER NOT NULL,
+        model TEXT NOT NULL,
+        version TEXT NOT NULL,
+        summary TEXT NOT NULL,
+        score INTEGER NOT NULL,
+        extras TEXT NOT NULL,
+        last_used REAL NOT NULL,
+        PRIMARY KEY (chunk, question_id, model, version)
+    );
+    CREATE INDEX IF NOT EXISTS summaries_last_used ON summaries (last_used);
+    """
+
+    def __init__(self, path: Path, max_bytes: int, similarity: float) -> None:
+        self.max_bytes = max_bytes
+        self.similarity = similarity
+        self.connection = sqlite3.connect(path)
+        self.connection.execute("PRAGMA journal_mode = WAL")
+        self.connection.execute("PRAGMA synchronous = NORMAL")
+        with self.connection:
+            self.connection.executescript(self.SCHEMA)
+
+    @property
+    def uses_similar_questions(self) -> bool:
+        return self.similarity < 1
+
+    def close(self) -> None:
+        self.connection.close()
+
+    def get_many(
+        self,
+        chunks: Sequence[str],
+        question: str,
+        model: str,
+        version: str,
+        embedding_model: Optional[str] = None,
+        embedding: Optional[Sequence[float]] = None,
+    ) -> List[Optional[Summary]]:
+        """Look up the summaries of chunks, with `None` for those not cached.
+
+        Summaries made for the question itself are preferred, then those made
+        for the most similar questions, if an `embedding` of the question is
+        given.
+        """
+        question_ids = self._get_question_ids(question, embedding_model, embedding)
+        found: Dict[bytes, Tuple[int, Summary]] = {}
+        for question_id in reversed(question_ids):
+            for chunk, summary, score, extras in self.connection.execute(
+                "SELECT chunk, summary, score, extras FROM summaries"
+                " WHERE question_id = ? AND model = ? AND version = ?",
+                (question_id, model, version),
+            ):
+                found[chunk] = (question_id, (summary, score, json.loads(extras)))
+
+        keys = [chunk_key(chunk) for chunk in chunks]
+        now = time.time()
+        used = [
+            (now, key, found[key][0], model, version) for key in keys if key in found
+        ]
+        if used:
+            with self.connection:
+                self.connection.executemany(
+                    "UPDATE summaries SET last_used = ? WHERE chunk = ?"
+                    " AND question_id = ? AND model = ? AND version = ?",
+                    used,
+                )
+        return [found[key][1] if key in found else None for key in keys]
+
+    def put_many(
+        self,
+        chunks: Sequence[str],
+        summaries: Sequence[Summary],
+        question: str,
+        model: str,
+        version: str,
+        embedding_model: Optional[str] = None,
+        embedding: Optional[Sequence[float]] = None,
+    ) -> None:
+        """Store the summaries of chunks made for a question."""
+        import numpy as np
+
+        now = time.time()
+        with self.connection:
+            self.connection.execute(
+                "INSERT OR IGNORE INTO questions (question) VALUES (?)",
+                (normalize_question(question),),
+            )
+            if embedding is not None:
+                self.connection.execute(
+                    "UPDATE questions SET embedding_model = ?, embedding = ?"
+                    " WHERE question = ?",
+                    (
+                        embedding_model,
+                        np.asarray(embedding, dtype=np.float32).tobytes(),
+                        normalize_question(question),
+                    ),
+                )
+            (question_id,) = self.connection.execute(
+                "SELECT id FROM questions WHERE question = ?",
+                (normalize_question(question),),
+            ).fetchone()
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO summaries"
+                " (chunk, question_id, model, version, summary, score, extras,"
+                " last_used) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (
+                    (
+                        chunk_key(chunk),
+                        question_id,
+                        model,
+                        version,
+                        summary,
+                        score,
+                        json.dumps(extras),
+                        now,
+                    )
+                    for chunk, (summary, score, extras) in zip(chunks, summaries)
+                ),
+            )
+        self.evict()
+
+    def evict(self) -> None:
+        """Drop the least recently used summaries beyond the size limit."""
+        count, size = self.connection.execute(
+            "SELECT COUNT(*), COALESCE(SUM(LENGTH(summary) + LENGTH(extras)), 0)"
+            " FROM summaries"
+        ).fetchone()
+        if size <= self.max_bytes:
+            return
+
+        # summaries all have about the same size
+        excess = count - int(count * self.max_bytes / size)
+        logger.debug(f"Evicting {excess} summaries from the cache")
+        with self.connection:
+            self.connection.execute(
+                "DELETE FROM summaries WHERE rowid IN"
+                " (SELECT rowid FROM summaries ORDER BY last_used LIMIT ?)",
+                (excess,),
+            )
+            self.connection.execute(
+                "DELETE FROM questions WHERE id NOT IN"
+                " (SELECT DISTINCT question_id FROM summaries)"
+            )
+
+    def _get_question_ids(
+        self,
+        question: str,
+        embedding_model: Optional[str],
+        embedding: Optional[Sequence[float]],
+    ) -> List[int]:
+        """Get the IDs of the question and of similar questions, best first."""
+        row = self.connection.execute(
+            "SELECT id FROM questions WHERE question = ?",
+            (normalize_question(question),),
+        ).fetchone()
+        question_ids = [row[0]] if row else []
+        if not self.uses_similar_questions or embedding is None:
+            return question_ids
+
+        import numpy as np
+
+        # not normalized in place, the embedding may be the caller's array
+        query = np.asarray(embedding, dtype=np.float32)
+        query = query / (np.linalg.norm(query) or 1.0)
+        similar = []
+        for question_id, blob in self.connection.execute(
+            "SELECT id, embedding FROM questions"
+            " WHERE embedding_model = ? AND embedding IS NOT NULL",
+            (embedding_model,),
+        ):
+            other = np.frombuffer(blob, dtype=np.float32)
+            if len(other) != len(query) or question_id in question_ids:
+                continue
+            similarity = float(other @ query) / (float(np.linalg.norm(other)) or 1.0)
+            if similarity >= self.similarity:
+                similar.append((similarity, question_id))
+        return question_ids + [question_id for _, question_id in sorted(similar)[::-1]]
@@ -0,0 +1,279 @@
+"""Vector store answering questions from the memory-mapped embedding matrix."""
+
+from typing import Any, Dict, Iterable, List, Sequence, Tuple
+
+import numpy as np
+import papis.logging
+from lmi import EmbeddingModel, EmbeddingModes
+from paperqa.llms import VectorStore
+from paperqa.types import Embeddable
+
+from papis_ask.store import QUANTIZED_PRECISIONS, IndexStore
+
+logger = papis.logging.get_logger(__name__)
+
+# Number of matrix rows scored at once, to bound memory use
+SCORE_BLOCK_ROWS = 65536
+# Constant of reciprocal rank fusion, dampening the weight of the top ranks
+RRF_K = 60
+
+
+def cosine_similarities(query: Any, matrix: Any, rows: Any) -> Any:
+    """Compute the cosine similarity of a query with the given matrix rows."""
+    query = query / (np.linalg.norm(query) or 1.0)
+    scores = np.empty(len(rows), dtype=np.float32)
+    for start in range(0, len(rows), SCORE_BLOCK_ROWS):
+        block = matrix[rows[start : start + SCORE_BLOCK_ROWS]]
+        norms = np.linalg.norm(block, axis=1)
+        norms[norms == 0] = 1.0
+        scores[start : start + len(block)] = (block @ query) / norms
+    return np.nan_to_num(scores, nan=-np.inf)
+
+
+def quantized_similarities(query: Any, values: Any, scales: Any, rows: Any) -> Any:
+    """Approximate the cosine similarity of a query with the given rows.
+
+    `values` and `scales` are a reduced-precision copy of the embedding
+    matrix (see `papis_ask.store.QuantizedMatrix`).
+    """
+    query = (query / (np.linalg.norm(query) or 1.0)).astype(np.float32)
+    scores = np.empty(len(rows), dtype=np.float32)
+    for start in range(0, len(rows), SCORE_BLOCK_ROWS):
+        block_rows = rows[start : start + SCORE_BLOCK_ROWS]
+        block_scores = values[block_rows].astype(np.float32) @ query
+        if scales is not None:
+            block_scores *= scales[block_rows]
+        scores[start : start + len(block_rows)] = block_scores
+    return np.nan_to_num(scores, nan=-np.inf)
+
+
+def top_k(scores: Any, k: int) -> Any:
+    """Get the indices of the k highest scores, best first."""
+    k = min(k, len(scores))
+    if k == 0:
+        return np.zeros(0, dtype=np.int64)
+    candidates = np.argpartition(-scores, k - 1)[:k]
+    return candidates[np.argsort(-scores[candidates])]
+
+
+def reciprocal_rank_fusion(rankings: Iterable[Sequence[int]]) -> List[int]:
+    """Merge rankings of rows into one, best first."""
+    scores: Dict[int, float] = {}
+    for ranking in rankings:
+        for rank, row in enumerate(ranking):
+            scores[row] = scores.get(row, 0.0) + 1.0 / (RRF_K + rank + 1)
+    return sorted(scores, key=scores.__getitem__, reverse=True)
+
+
+class MemmapVectorStore(VectorStore):
+    """Read-only vector store backed by an index store.
+
+    Only the embedding matrix is mapped into memory. Texts and their
+    documents are loaded from the index store for the top hits only.
+
+    With `nprobe` > 0, only the rows in the `nprobe` closest clusters of the
+    approximate nearest neighbour index are scored, if there is one.
+
+    The full-text index, if there is one, is used depending on `retrieval`:
+
+    - "dense": it isn't used
+    - "prefilter": only the `fulltext_candidates` chunks best matching the
+      question's words are scored
+    - "fusion": the best chunks by score and by the question's words are
+      merged by reciprocal rank fusion
+
+    With a `precision` of "float16" or "int8", the chunks are scored with the
+    reduced-precision copy of the matrix, if it's complete, and only the
+    `rescore_factor` times as many chunks as requested are scored again
+    with the full-precision matrix.
+    """
+
+    _store: Any = None
+    _matrix: Any = None
+    _rows: Any = None
+    _ann: Any = None
+    _nprobe: int = 0
+    _fulltext: Any = None
+    _retrieval: str = "dense"
+    _fulltext_candidates: int = 0
+    _quantized: Any = None
+    _rescore_factor: int = 1
+    # embeddings of questions by question, see `embed_queries`
+    _query_embeddings: Dict[str, Any] = {}
+
+    @classmethod
+    def from_store(
+        cls,
+        store: IndexStore,
+        nprobe: int = 0,
+        retrieval: str = "dense",
+        fulltext_candidates: int = 0,
+        precision: str = "float32",
+        rescore_factor: int = 1,
+    ) -> "MemmapVectorStore":
+        from papis_ask.ann import IVFIndex
+
+        vector_store = cls()
+        vector_store._store = store
+        vector_store._matrix = store.embeddings.open()
+        vector_store._rows = store.get_rows()
+        if precision in QUANTIZED_PRECISIONS:
+            quantized = store.get_quantized(precision)
+            if len(quantized) == len(vector_store._matrix):
+                vector_store._quantized = quantized.open()
+                vector_store._rescore_factor = max(1, rescore_factor)
+            else:
+                logger.warning(
+                    f"The embeddings aren't all stored as {precision} yet,"
+                    " run 'papis ask index'"
+                )
+        if nprobe > 0:
+            ann = IVFIndex.load(store.ann_path)
+            # an outdated index (e.g. of a regenerated matrix) is ignored
+            if ann is not None and len(ann.labels) <= len(vector_store._matrix):
+                ann.set_rows(vector_store._rows)
+                vector_store._ann = ann
+                vector_store._nprobe = nprobe
+
+        if retrieval != "dense":
+            try:
+                from papis_ask.fulltext import FullTextIndex
+            except ImportError:
+                logger.warning("Install tantivy to use '%s' retrieval", retrieval)
+            else:
+                if store.fulltext_path.exists():
+                    vector_store._fulltext = FullTextIndex(store.fulltext_path)
+                    vector_store._retrieval = retrieval
+                    vector_store._fulltext_candidates = fulltext_candidates
+                else:
+                    logger.warning(
+                        "There is no full-text index yet, run 'papis ask index'"
+                    )
+        return vector_store
+
+    def restricted_to(self, rows: Any) -> "MemmapVectorStore":
+        """Get a copy only searching the given rows, e.g. of some documents.
+
+        The nearest neighbour index isn't used, so all given rows are scored.
+        """
+        vector_store = self.model_copy()
+        vector_store._rows = np.intersect1d(self._rows, rows)
+        vector_store._ann = None
+        return vector_store
+
+    def __len__(self) -> int:
+        return 0 if self._rows is None else len(self._rows)
+
+    def __contains__(self, item) -> bool:
+        """Check whether a text is stored in one of the searched rows."""
+        if self._store is None:
+            return False
+        row = self._store.get_text_row(item.doc.dockey, item.name)
+        if row is None:
+            return False
+        position = np.searchsorted(self._rows, row)
+        return position < len(self._rows) and self._rows[position] == row
+
+    async def add_texts_and_embeddings(self, texts: Iterable[Embeddable]) -> None:
+        """Do nothing, as texts are added to the index store when indexing.
+
+        `Docs.retrieve_texts` calls this before every search with the texts of
+        the `Docs` that aren't in the vector store. The texts aren't loaded
+        into the `Docs` answering questions, so there are usually none.
+        """
+        if missing := list(texts):
+            logger.debug(
+                f"Ignoring {len(missing)} text(s) not in the index store,"
+                " run 'papis ask index' to add them"
+            )
+
+    def clear(self) -> None:
+        super().clear()
+        self._rows = np.zeros(0, dtype=np.int64)
+
+    async def embed_query(self, query: str, embedding_model: EmbeddingModel) -> Any:
+        if (embedding := self._query_embeddings.get(query)) is not None:
+            return embedding
+        # this will only affect models that embedding prompts
+        embedding_model.set_mode(EmbeddingModes.QUERY)
+        embedding = (await embedding_model.embed_documents([query]))[0]
+        embedding_model.set_mode(EmbeddingModes.DOCUMENT)
+        return np.asarray(embedding, dtype=np.float32)
+
+    async def embed_queries(
+        self, queries: Sequence[str], embedding_model: EmbeddingModel
+    ) -> None:
+        """Embed many questions at once, ahead of searching for them.
+
+        Questions that were embedded already aren't embedded again.
+        """
+        queries = [
+            query
+            for query in dict.fromkeys(queries)
+            if query not in self._query_embeddings
+        ]
+        if not queries:
+            return
+        embedding_model.set_mode(EmbeddingModes.QUERY)
+        embeddings = await embedding_model.embed_documents(list(queries))
+        embedding_model.set_mode(EmbeddingModes.DOCUMENT)
+        self._query_embeddings.update(
+            (query, np.asarray(embedding, dtype=np.float32))
+            for query, embedding in zip(queries, embeddings)
+        )
+
+    async def similarity_search(
+        self, query: str, k: int, embedding_model: EmbeddingModel
+    ) -> Tuple[Sequence[Embeddable], List[float]]:
+        if len(self) == 0 or k == 0:
+            return [], []
+
+        np_query = await self.embed_query(query, embedding_model)
+        if self._retrieval == "fusion":
+            rows, _ = self._best(np_query, self._dense_candidates(np_query), k)
+            ranking = reciprocal_rank_fusion(
+                [rows.tolist(), self._fulltext_search(query, k)]
+            )
+            # the cosine similarities are reported, as paperqa expects
+            rows = np.asarray(ranking[:k], dtype=np.int64)
+            return self._load_hits(
+                rows, cosine_similarities(np_query, self._matrix, rows)
+            )
+
+        rows = self._dense_candidates(np_query)
+        if self._retrieval == "prefilter":
+            if candidates := self._fulltext_search(query, self._fulltext_candidates):
+                rows = np.sort(np.asarray(candidates, dtype=np.int64))
+        return self._load_hits(*self._best(np_query, rows, k))
+
+    def _best(self, np_query: Any, rows: Any, k: int) -> Tuple[Any, Any]:
+        """Get the k rows most similar to the query and their scores, best first."""
+        if self._quantized is not None and len(rows) > k * self._rescore_factor:
+            approximate = quantized_similarities(np_query, *self._quantized, rows)
+            rows = np.sort(rows[top_k(approximate, k * self._rescore_factor)])
+        scores = cosine_similarities(np_query, self._matrix, rows)
+        best = top_k(scores, k)
+        return rows[best], scores[best]
+
+    def _dense_candidates(self, np_query: Any) -> Any:
+        if self._ann is None:
+            return self._rows
+        return self._ann.candidates(np_query, self._nprobe)
+
+    def _fulltext_search(self, query: str, limit: int) -> List[int]:
+        """Get the rows of the stored texts best matching the question's words."""
+        rows = np.asarray(self._fulltext.search(query, limit), dtype=np.int64)
+        # the full-text index may still contain removed texts
+        positions = np.searchsorted(self._rows, rows).clip(max=len(self._rows) - 1)
+        return rows[self._rows[positions] == rows].tolist()
+
+    def _load_hits(
+        self, rows: Any, scores: Any
+    ) -> Tuple[Sequence[Embeddable], List[float]]:
+        texts = self._store.load_texts(rows, self._matrix)
+        hits = [
+            (texts[row], float(score))
+            for row, score in zip(rows.tolist(), scores)
+            if row in texts
+        ]
+        return [text for text, _ in hits], [score for _, score in hits]
@@ -0,0 +1,63 @@
+import numpy as np
+
+from papis_ask.ann import IVFIndex, normalize
+
+CLUSTERS = 4
+ROWS_PER_CLUSTER = 50
+DIM = 16
+
+
+def make_matrix(seed=0):
+    """Make embeddings in well separated clusters, cluster by cluster."""
+    rng = np.random.default_rng(seed)
+    centers = np.eye(CLUSTERS, DIM, dtype=np.float32) * 10
+    return np.concatenate(
+        [
+            center + rng.normal(scale=0.5, size=(ROWS_PER_CLUSTER, DIM))
+            for center in centers
+        ]
+    ).astype(np.float32)
+
+
+def test_candidates():
+    matrix = make_matrix()
+    index = IVFIndex.train(matrix)
+    index.set_rows(np.arange(len(matrix)))
+
+    query = matrix[7]
+    candidates = index.candidates(query, nprobe=1)
+    assert 7 in candidates
+    assert np.all(np.diff(candidates) > 0)
+    # only rows of the query's cluster
+    assert set(candidates.tolist()) <= set(range(ROWS_PER_CLUSTER))
+
+    everything = index.candidates(query, nprobe=len(index.centroids))
+    assert everything.tolist() == list(range(len(matrix)))
+
+
+def test_candidates_live_rows():
+    matrix = make_matrix()
+    index = IVFIndex.train(matrix[:150])
+    # removed rows aren't candidates, rows not assigned yet always are
+    rows = np.concatenate([np.arange(10, 150), np.arange(150, 200)])
+    index.set_rows(rows)
+
+    candidates = index.candidates(matrix[0], nprobe=1)
+    assert not set(range(10)) & set(candidates.tolist())
+    assert set(range(150, 200)) <= set(candidates.tolist())
+
+    index.update(matrix)
+    index.set_rows(rows)
+    assert not set(range(150, 200)) & set(index.candidates(matrix[0], 1).tolist())
+
+
+def test_save_and_load(tmp_path):
+    matrix = make_matrix()
+    index = IVFIndex.train(matrix)
+    index.save(tmp_path / "index.ann.npz")
+
+    loaded = IVFIndex.load(tmp_path / "index.ann.npz")
+    assert loaded.trained_rows == len(matrix)
+    assert np.array_equal(loaded.labels, index.labels)
+    assert np.allclose(normalize(loaded.centroids), loaded.centroids)
+    assert IVFIndex.load(tmp_path / "missing.ann.npz") is None
@@ -0,0 +1,94 @@
+import papis.config
+import pytest
+from paperqa import Settings
+
+from papis_ask.answer_cache import AnswerCache
+from papis_ask.config import SECTION_NAME
+from papis_ask.index import ANSWER_OPTIONS, get_answer_cache_key
+
+QUESTION = "What is known about cats?"
+OPTIONS = {"exact": False, "retrieval": "dense", "rerank_keep": 0, "filter_query": None}
+
+
+def get_key(question=QUESTION, settings=None, **options):
+    return get_answer_cache_key(
+        question, settings or Settings(), **{**OPTIONS, **options}
+    )
+
+
+def test_key_ignores_case_and_whitespace():
+    assert get_key(" what is  KNOWN about cats? ") == get_key()
+    assert get_key("What is known about dogs?") != get_key()
+
+
+@pytest.mark.parametrize(
+    "option, value",
+    [
+        ("exact", True),
+        ("retrieval", "fusion"),
+        ("rerank_keep", 5),
+        ("filter_query", "year:>2015"),
+    ],
+)
+def test_key_changes_with_query_options(option, value):
+    assert get_key(**{option: value}) != get_key()
+
+
+@pytest.mark.parametrize(
+    "change",
+    [
+        lambda settings: setattr(settings, "llm", "other-llm"),
+        lambda settings: setattr(settings, "summary_llm", "other-llm"),
+        lambda settings: setattr(settings, "embedding", "other-embedding"),
+        lambda settings: setattr(settings.answer, "evidence_k", 3),
+        lambda settings: setattr(settings.answer, "answer_max_sources", 2),
+        lambda settings: setattr(settings.answer, "answer_length", "one word"),
+        lambda settings: setattr(settings.prompts, "summary", "Summarize {text}"),
+    ],
+)
+def test_key_changes_with_settings(change):
+    settings = Settings()
+    change(settings)
+    assert get_key(settings=settings) != get_key()
+
+
+@pytest.mark.parametrize("name", ANSWER_OPTIONS)
+def test_key_changes_with_config(name):
+    key = get_key()
+    papis.config.set(name, "changed", section=SECTION_NAME)
+    try:
+        assert get_key() != key
+    finally:
+        papis.config.get_configuration().remove_option(SECTION_NAME, name)
+    assert get_key() == key
+
+
+def test_answers_expire_with_the_index_generation(tmp_path):
+    path = tmp_path / "answers.sqlite"
+    cache = AnswerCache(path, generation=1, max_bytes=10**6)
+    cache.put(b"key", {"answer": "cats"})
+    assert cache.get(b"key") == {"answer": "cats"}
+    cache.close()
+
+    cache = AnswerCache(path, generation=2, max_bytes=10**6)
+    assert cache.get(b"key") is None
+    cache.put(b"other key", {"answer": "dogs"})
+    cache.close()
+
+    # answers for earlier generations are dropped by the first new answer
+    cache = AnswerCache(path, generation=1, max_bytes=10**6)
+    assert cache.get(b"key") is None
+
+
+def test_least_recently_used_answers_are_evicted(tmp_path):
+    answer = {"answer": "x" * 1000}
+    cache = AnswerCache(tmp_path / "answers.sqlite", generation=1, max_bytes=2500)
+    cache.put(b"first", answer)
+    cache.put(b"second", answer)
+    assert cache.get(b"first") == answer
+
+    cache.put(b"third", answer)
+
+    assert cache.get(b"second") is None
+    assert cache.get(b"first") == answer
+    assert cache.get(b"third") == answer
@@ -0,0 +1,24 @@
+import json
+
+from papis_ask.answer_cache import normalize_question
+from papis_ask.main import _get_answered_questions
+
+
+def test_get_answered_questions(tmp_path):
+    output_file = tmp_path / "answers.jsonl"
+    output_file.write_text(
+        json.dumps({"question": "What is  a Cat?", "answer": "An animal."})
+        + "\n"
+        + json.dumps({"question": None})
+        + "\n"
+        + json.dumps({"answer": "No question."})
+        + "\n"
+        # cut short by interrupting the run that wrote it
+        + json.dumps({"question": "What is a dog?"})[:-4]
+    )
+
+    answered = _get_answered_questions(output_file)
+
+    assert answered == {"what is a cat?"}
+    assert normalize_question("what is a  cat?") in answered
+    assert normalize_question("What is a dog?") not in answered
@@ -0,0 +1,60 @@
+import pickle
+import socket
+import threading
+
+import pytest
+
+from papis_ask.daemon import FRAME_HEADER, DaemonError, query_daemon
+
+
+def serve_once(socket_file, frames):
+    """Answer one request with `frames` and hang up."""
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    server.bind(str(socket_file))
+    server.listen(1)
+
+    def answer():
+        connection, _ = server.accept()
+        with connection:
+            (size,) = FRAME_HEADER.unpack(connection.recv(FRAME_HEADER.size))
+            connection.recv(size)
+            connection.sendall(frames)
+        server.close()
+
+    thread = threading.Thread(target=answer)
+    thread.start()
+    return thread
+
+
+def frame(kind, value):
+    payload = pickle.dumps((kind, value))
+    return FRAME_HEADER.pack(len(payload)) + payload
+
+
+def test_query_daemon_streams_the_answer(tmp_path):
+    socket_file = tmp_path / "ask.sock"
+    thread = serve_once(socket_file, frame("token", "An ") + frame("ok", "answer"))
+    tokens = []
+    assert query_daemon(socket_file, {}, on_token=tokens.append) == "answer"
+    assert tokens == ["An "]
+    thread.join()
+
+
+@pytest.mark.parametrize(
+    "frames",
+    [
+        # the daemon stopped while answering
+        frame("token", "An "),
+        # it stopped in the middle of a frame
+        frame("token", "An ")[:-3],
+        b"\0" * (FRAME_HEADER.size - 1),
+        # it sent garbage
+        FRAME_HEADER.pack(3) + b"bad",
+    ],
+)
+def test_query_daemon_lost_connection(tmp_path, frames):
+    socket_file = tmp_path / "ask.sock"
+    thread = serve_once(socket_file, frames)
+    with pytest.raises(DaemonError):
+        query_daemon(socket_file, {}, on_token=lambda token: None)
+    thread.join()
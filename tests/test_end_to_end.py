@@ -0,0 +1,59 @@
+"""Index a synthetic library and answer a question about it, offline.
+
+A small run of `benchmarks/suite.py`: the models and Semantic Scholar are
+served by the fake server in `benchmarks/fake_server.py`.
+"""
+
+import json
+import os
+import subprocess
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).parent.parent / "benchmarks"))
+
+from fake_server import FakeServer  # noqa: E402
+from suite import get_index_stats, write_config  # noqa: E402
+from synthetic_library import make_library, make_questions  # noqa: E402
+
+DOCS = 3
+PAGES = 2
+TIMEOUT = 300  # seconds
+
+
+def test_index_and_query(tmp_path):
+    library = make_library(tmp_path / "library", DOCS, PAGES)
+    (question,) = make_questions(library, 1)
+
+    with FakeServer(library, dim=64) as server:
+        config = write_config(tmp_path, tmp_path / "library", server.url)
+        env = os.environ | {
+            "XDG_CONFIG_HOME": str(tmp_path / "config"),
+            "XDG_CACHE_HOME": str(tmp_path / "cache"),
+            "OPENAI_API_BASE": f"{server.url}/v1",
+            "OPENAI_API_KEY": "fake",
+            "LITELLM_LOCAL_MODEL_COST_MAP": "True",
+        }
+        papis = [sys.executable, "-m", "papis", "--config", str(config), "ask"]
+
+        index = subprocess.run(
+            [*papis, "index"], env=env, capture_output=True, text=True, timeout=TIMEOUT
+        )
+        assert index.returncode == 0, index.stderr
+        assert get_index_stats(tmp_path / "cache")["chunks"] >= DOCS
+
+        query = subprocess.run(
+            [*papis, "query", "-o", "json", "--no-cache", question],
+            env=env,
+            capture_output=True,
+            text=True,
+            timeout=TIMEOUT,
+        )
+        assert query.returncode == 0, query.stderr
+
+    answer = json.loads(query.stdout)
+    assert answer["question"] == question
+    assert answer["answer"]
+    assert answer["contexts"]
+    assert server.requests["semantic_scholar"] > 0
+    assert server.requests["llm"] > 0
@@ -0,0 +1,156 @@
+import time
+
+import pytest
+
+from papis_ask.enrichment import (
+    BACKOFF_BASE,
+    MetadataEnricher,
+    RateLimitError,
+    TokenBucket,
+)
+from papis_ask.store import IndexStore
+
+QUERY = {"title": "Volcanoes of Iceland"}
+
+
+class RecordingBucket(TokenBucket):
+    """Rate limiter recording its pauses instead of pausing."""
+
+    def __init__(self) -> None:
+        super().__init__(rate=0)
+        self.pauses = []
+
+    def pause(self, seconds: float) -> None:
+        self.pauses.append(seconds)
+
+
+async def enrich_all(store, enrich, rate_limiter, **options):
+    enricher = MetadataEnricher(
+        store=store,
+        enrich=enrich,
+        rate_limiter=rate_limiter,
+        concurrency=2,
+        max_attempts=options.pop("max_attempts", 3),
+        **options,
+    )
+    enricher.start()
+    enricher.enqueue("doc", QUERY)
+    await enricher.aclose()
+
+
+def make_enrich(*results):
+    """Make a lookup returning or raising the given results in turn."""
+    results = list(results)
+    calls = []
+
+    async def enrich(dockey, query):
+        calls.append((dockey, query))
+        result = results.pop(0)
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+    return enrich, calls
+
+
+@pytest.mark.asyncio
+async def test_token_bucket():
+    bucket = TokenBucket(rate=20, burst=2)
+    start = time.monotonic()
+    for _ in range(2):
+        await bucket.acquire()
+    assert time.monotonic() - start < 0.04
+
+    for _ in range(2):
+        await bucket.acquire()
+    assert time.monotonic() - start >= 0.09
+
+    bucket.pause(0.1)
+    paused = time.monotonic()
+    await bucket.acquire()
+    assert time.monotonic() - paused >= 0.1
+
+
+@pytest.mark.asyncio
+async def test_token_bucket_unlimited():
+    bucket = TokenBucket(rate=0)
+    bucket.pause(10)
+    start = time.monotonic()
+    for _ in range(100):
+        await bucket.acquire()
+    assert time.monotonic() - start < 0.1
+
+
+@pytest.mark.asyncio
+async def test_rate_limited_lookups_back_off(tmp_path):
+    store = IndexStore(tmp_path / "index.qa.sqlite")
+    bucket = RecordingBucket()
+    enrich, calls = make_enrich(RateLimitError("429"), RateLimitError("429"), True)
+
+    await enrich_all(store, enrich, bucket)
+
+    assert len(calls) == 3
+    assert bucket.pauses == [BACKOFF_BASE, 2 * BACKOFF_BASE]
+    assert store.get_enrichments() == []
+
+
+@pytest.mark.asyncio
+async def test_rate_limited_lookups_wait_as_asked(tmp_path):
+    store = IndexStore(tmp_path / "index.qa.sqlite")
+    bucket = RecordingBucket()
+    enrich, _ = make_enrich(RateLimitError("429", retry_after=7), True)
+
+    await enrich_all(store, enrich, bucket)
+
+    assert bucket.pauses == [7]
+
+
+@pytest.mark.asyncio
+async def test_lookups_still_rate_limited_stay_queued(tmp_path):
+    store = IndexStore(tmp_path / "index.qa.sqlite")
+    bucket = RecordingBucket()
+    enrich, calls = make_enrich(*[RateLimitError("429")] * 3)
+
+    await enrich_all(store, enrich, bucket, max_attempts=3)
+
+    assert len(calls) == 3
+    assert bucket.pauses == [BACKOFF_BASE, 2 * BACKOFF_BASE, 4 * BACKOFF_BASE]
+    assert store.get_enrichments() == [("doc", QUERY)]
+
+
+@pytest.mark.asyncio
+async def test_failed_lookups_stay_queued(tmp_path):
+    store = IndexStore(tmp_path / "index.qa.sqlite")
+    enrich, calls = make_enrich(ValueError("unexpected response"))
+
+    await enrich_all(store, enrich, RecordingBucket())
+
+    assert len(calls) == 1
+    assert store.get_enrichments() == [("doc", QUERY)]
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize(
+    "retry_unresolved, queued", [(False, []), (True, [("doc", QUERY)])]
+)
+async def test_unresolved_lookups(tmp_path, retry_unresolved, queued):
+    store = IndexStore(tmp_path / "index.qa.sqlite")
+    enrich, _ = make_enrich(False)
+
+    await enrich_all(
+        store, enrich, RecordingBucket(), retry_unresolved=retry_unresolved
+    )
+
+    assert store.get_enrichments() == queued
+
+
+@pytest.mark.asyncio
+async def test_lookups_left_by_earlier_runs_are_resumed(tmp_path):
+    store = IndexStore(tmp_path / "index.qa.sqlite")
+    store.queue_enrichment("earlier", {"doi": "10.1000/1"})
+    enrich, calls = make_enrich(True, True)
+
+    await enrich_all(store, enrich, RecordingBucket())
+
+    assert sorted(dockey for dockey, _ in calls) == ["doc", "earlier"]
+    assert store.get_enrichments() == []
@@ -0,0 +1,92 @@
+import pytest
+from paperqa.types import DocDetails
+
+from papis_ask.filters import FilterError, get_postings, match_filter, parse_filter
+from papis_ask.store import IndexStore
+
+
+def make_doc(title, authors, year, **other):
+    return DocDetails(title=title, authors=authors, year=year, other=other)
+
+
+@pytest.fixture
+def library(tmp_path):
+    docs = {
+        "volcanoes": make_doc(
+            "Volcanoes of Iceland", ["Ada Smith"], 2012, tags=["geology"]
+        ),
+        "glaciers": make_doc(
+            "Retreating Glaciers", ["Bo Smithson", "Cy Jones"], 2019, tags="climate"
+        ),
+        "violins": make_doc("The Violin", ["Di Jones"], 2021, file_last_indexed=2012),
+    }
+    store = IndexStore(tmp_path / "index.qa.sqlite")
+    for doc in docs.values():
+        store.save_doc(doc)
+    return store, {name: doc.dockey for name, doc in docs.items()}
+
+
+def test_parse_filter():
+    assert parse_filter("author:smith 'year:>2015' \"title:deep learning\" ml") == [
+        ("author", "smith"),
+        ("year", ">2015"),
+        ("title", "deep learning"),
+        (None, "ml"),
+    ]
+    assert parse_filter("Author:Smith :value") == [
+        ("author", "Smith"),
+        (None, ":value"),
+    ]
+
+
+def test_parse_filter_malformed():
+    with pytest.raises(FilterError):
+        parse_filter("title:'unbalanced")
+
+
+def test_get_postings():
+    postings = get_postings(make_doc("Volcanoes", ["Ada Smith"], 2012, tags=["Lava"]))
+    assert {
+        ("title", "volcanoes"),
+        ("author", "ada"),
+        ("author", "smith"),
+        ("year", "2012"),
+        ("tags", "lava"),
+    } <= postings
+
+
+@pytest.mark.parametrize(
+    "query, expected",
+    [
+        ("author:smith", {"volcanoes", "glaciers"}),
+        ("author:smith author:jones", {"glaciers"}),
+        ("author:'cy jones'", {"glaciers"}),
+        ("jones", {"glaciers", "violins"}),
+        ("year:>2015", {"glaciers", "violins"}),
+        ("year:<=2019 tags:clim", {"glaciers"}),
+        ("title:violin", {"violins"}),
+        # bookkeeping fields aren't indexed
+        ("2012", {"volcanoes"}),
+        ("author:nobody", set()),
+    ],
+)
+def test_match_filter(library, query, expected):
+    store, dockeys = library
+    assert match_filter(store, query) == {dockeys[name] for name in expected}
+
+
+def test_match_filter_unrestricted(library):
+    store, _ = library
+    assert match_filter(store, "") is None
+    assert match_filter(store, "author:-") is None
+
+
+def test_match_filter_after_update(library):
+    store, dockeys = library
+    doc = store.get_doc(dockeys["violins"])
+    doc.other["tags"] = ["music"]
+    store.save_doc(doc)
+    assert match_filter(store, "tags:music") == {dockeys["violins"]}
+
+    store.delete_document(dockeys["violins"])
+    assert match_filter(store, "tags:music") == set()
@@ -0,0 +1,57 @@
+import os
+
+from papis_ask.fingerprint import file_md5, find_changed_files, get_fingerprint
+
+
+def write_library(tmp_path):
+    files = {}
+    for name in ("unchanged", "touched", "changed", "unfingerprinted", "removed"):
+        file_path = tmp_path / f"{name}.txt"
+        file_path.write_text(f"The content of {name}")
+        files[name] = file_path
+    indexed_files = {file_path: file_md5(file_path) for file_path in files.values()}
+    fingerprints = {
+        str(file_path): get_fingerprint(file_path)
+        for name, file_path in files.items()
+        if name != "unfingerprinted"
+    }
+    return files, indexed_files, fingerprints
+
+
+def test_find_changed_files(tmp_path):
+    files, indexed_files, fingerprints = write_library(tmp_path)
+    stat = os.stat(files["touched"])
+    os.utime(files["touched"], ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+    files["changed"].write_text("New content")
+    files["removed"].unlink()
+
+    changed, touched = find_changed_files(indexed_files, fingerprints, jobs=2)
+
+    assert changed == {files["changed"]}
+    assert touched == {
+        files["touched"]: get_fingerprint(files["touched"]),
+        files["unfingerprinted"]: get_fingerprint(files["unfingerprinted"]),
+    }
+
+
+def test_find_changed_files_only_hashes_new_fingerprints(tmp_path, monkeypatch):
+    files, indexed_files, fingerprints = write_library(tmp_path)
+    # a change that keeps the fingerprint goes unnoticed, as nothing is hashed
+    indexed_files[files["unchanged"]] = "outdated"
+    hashed = []
+    monkeypatch.setattr(
+        "papis_ask.fingerprint.file_md5",
+        lambda file_path: hashed.append(file_path) or file_md5(file_path),
+    )
+
+    changed, touched = find_changed_files(indexed_files, fingerprints, jobs=1)
+
+    assert hashed == [files["unfingerprinted"]]
+    assert changed == set()
+    assert list(touched) == [files["unfingerprinted"]]
+
+
+def test_file_md5_empty(tmp_path):
+    empty = tmp_path / "empty.txt"
+    empty.touch()
+    assert file_md5(empty) == "d41d8cd98f00b204e9800998ecf8427e"
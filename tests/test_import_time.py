@@ -0,0 +1,83 @@
+"""Check the time it takes to load the plugin.
+
+Every papis command, including shell completion, loads this plugin through
+its entry point, so importing `papis_ask.main` should cost next to nothing
+on top of click and papis, and import nothing but its command line interface
+and configuration. From scratch, most of the startup time is spent importing
+papis and click, which the plugin doesn't control, so the plugin is imported
+after them, and timed with `python -X importtime`.
+"""
+
+import json
+import subprocess
+import sys
+from typing import List, Tuple
+
+PLUGIN = "papis_ask.main"
+RUNS = 5
+# in milliseconds
+MAX_PLUGIN_MS = 20.0
+# what papis has loaded anyway when it loads the plugin
+PRELOADED = (
+    "contextlib",
+    "json",
+    "pathlib",
+    "typing",
+    # click loads it to translate help texts
+    "locale",
+    "click",
+    "click_default_group",
+    "papis.cli",
+    "papis.config",
+    "papis.logging",
+)
+# all the plugin may import itself
+ALLOWED = {
+    "papis_ask",
+    "papis_ask.config",
+    "papis_ask.main",
+    # papis.config loads its own defaults when the plugin registers its own
+    "papis.defaults",
+    "papis.tui",
+}
+
+
+def import_plugin() -> Tuple[float, List[str]]:
+    """Import the plugin in a new interpreter after importing `PRELOADED`.
+
+    Returns the time spent importing the plugin in milliseconds and the
+    modules it imported.
+    """
+    code = "; ".join(
+        [
+            *(f"import {module}" for module in PRELOADED),
+            "import sys",
+            "before = set(sys.modules)",
+            f"import {PLUGIN}",
+            "print(json.dumps(sorted(set(sys.modules) - before)))",
+        ]
+    )
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", code],
+        capture_output=True,
+        text=True,
+    )
+    assert result.returncode == 0, result.stderr
+
+    # lines look like "import time:  self [us] | cumulative | imported package",
+    # where the package name is indented by its import depth
+    for line in result.stderr.splitlines():
+        fields = line.split("|")
+        if len(fields) == 3 and fields[2].strip() == PLUGIN:
+            return int(fields[1]) / 1000, json.loads(result.stdout)
+    raise AssertionError(f"Failed to find {PLUGIN} in the import times")
+
+
+def test_plugin_imports_only_its_cli():
+    _, imported = import_plugin()
+    assert set(imported) <= ALLOWED, set(imported) - ALLOWED
+
+
+def test_plugin_import_time():
+    best = min(import_plugin()[0] for _ in range(RUNS))
+    assert best < MAX_PLUGIN_MS
@@ -0,0 +1,119 @@
+import numpy as np
+import pytest
+from paperqa.types import DocDetails, Text
+
+from papis_ask.store import (
+    QUANTIZED_PRECISIONS,
+    EmbeddingMatrix,
+    IndexStore,
+    QuantizedMatrix,
+)
+
+
+def make_texts(dockey, embeddings):
+    doc = DocDetails(docname=dockey, dockey=dockey, citation=dockey, other={})
+    texts = [
+        Text(text=f"{dockey} chunk {i}", name=f"{dockey} {i}", doc=doc, embedding=e)
+        for i, e in enumerate(embeddings)
+    ]
+    return doc, texts
+
+
+def get_embeddings(store):
+    """Get the embedding of every stored text by name."""
+    matrix = store.embeddings.open()
+    return {
+        text.name: text.embedding
+        for text in store.load_texts(store.get_rows(), matrix).values()
+    }
+
+
+def fill_store(path):
+    store = IndexStore(path)
+    removed, removed_texts = make_texts("removed", [[1.0, 0.0], [0.0, 1.0]])
+    kept, kept_texts = make_texts("kept", [[0.5, 0.5], [0.25, 0.75]])
+    store.save_document(removed, removed_texts)
+    store.save_document(kept, kept_texts)
+    store.delete_document(removed.dockey)
+    return store, kept_texts
+
+
+def test_compact(tmp_path):
+    store, kept_texts = fill_store(tmp_path / "index.qa.sqlite")
+    store.ann_path.write_bytes(b"stale")
+
+    removed = store.compact()
+
+    assert removed["embeddings"] == 2
+    assert len(store.embeddings) == 2
+    assert list(store.get_rows()) == [0, 1]
+    assert get_embeddings(store) == {text.name: text.embedding for text in kept_texts}
+    assert not store.ann_path.exists()
+    assert not store.compacted_path.exists()
+
+
+def test_compact_interrupted(tmp_path, monkeypatch):
+    path = tmp_path / "index.qa.sqlite"
+    store, kept_texts = fill_store(path)
+
+    def interrupt(self):
+        raise KeyboardInterrupt
+
+    with monkeypatch.context() as m:
+        m.setattr(IndexStore, "_replace_compacted_embeddings", interrupt)
+        with pytest.raises(KeyboardInterrupt):
+            store.compact()
+    store.close()
+
+    store = IndexStore(path)
+    assert len(store.embeddings) == 2
+    assert get_embeddings(store) == {text.name: text.embedding for text in kept_texts}
+    assert store.get_meta("compacted_rows") is None
+
+
+def test_compact_everything_removed(tmp_path):
+    store = IndexStore(tmp_path / "index.qa.sqlite")
+    doc, texts = make_texts("removed", [[1.0, 0.0]])
+    store.save_document(doc, texts)
+    store.delete_document(doc.dockey)
+
+    assert store.compact()["embeddings"] == 1
+    assert not store.embeddings.path.exists()
+    assert np.asarray(store.get_rows()).size == 0
+
+
+@pytest.mark.parametrize("precision", QUANTIZED_PRECISIONS)
+def test_quantized_matrix(tmp_path, precision):
+    rng = np.random.default_rng(0)
+    embeddings = rng.normal(size=(20, 8)).astype(np.float32)
+    matrix = EmbeddingMatrix(tmp_path / "index.embeddings", None)
+    matrix.append(embeddings[:15])
+    quantized = QuantizedMatrix(
+        tmp_path / f"index.embeddings.{precision}", precision, 8
+    )
+
+    assert quantized.update(matrix.open()) == 15
+    matrix.append(embeddings[15:])
+    assert quantized.update(matrix.open()) == 5
+    assert quantized.update(matrix.open()) == 0
+
+    values, scales = quantized.open()
+    assert len(values) == 20
+    restored = values.astype(np.float32)
+    if scales is not None:
+        restored *= scales[:, None]
+    normalized = embeddings / np.linalg.norm(embeddings, axis=1, keepdims=True)
+    assert np.allclose(restored, normalized, atol=0.01)
+
+
+def test_quantized_matrix_rebuilt(tmp_path):
+    matrix = EmbeddingMatrix(tmp_path / "index.embeddings", None)
+    matrix.append(np.ones((10, 4), dtype=np.float32))
+    quantized = QuantizedMatrix(tmp_path / "index.embeddings.int8", "int8", 4)
+    quantized.update(matrix.open())
+
+    # e.g. the matrix was compacted
+    matrix.clear()
+    matrix.append(np.ones((3, 4), dtype=np.float32))
+    assert quantized.update(matrix.open()) == 3
+    assert len(quantized) == 3
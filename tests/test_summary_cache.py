@@ -0,0 +1,50 @@
+import numpy as np
+
+from papis_ask.summary_cache import SummaryCache
+
+SUMMARY = ("A summary", 8, {})
+
+
+def make_cache(tmp_path, max_bytes=10**6, similarity=0.9):
+    return SummaryCache(tmp_path / "summaries.sqlite", max_bytes, similarity)
+
+
+def test_similar_question(tmp_path):
+    cache = make_cache(tmp_path)
+    cache.put_many(
+        ["chunk"], [SUMMARY], "What about cats?", "llm", "v1", "emb", [1.0, 0.0]
+    )
+
+    embedding = np.asarray([3.0, 0.1], dtype=np.float32)
+    found = cache.get_many(
+        ["chunk", "other chunk"], "Cats?", "llm", "v1", "emb", embedding
+    )
+
+    assert found == [SUMMARY, None]
+    # the caller's embedding is left as is
+    assert embedding.tolist() == np.asarray([3.0, 0.1], dtype=np.float32).tolist()
+    assert cache.get_many(["chunk"], "Dogs?", "llm", "v1", "emb", [0.0, 1.0]) == [None]
+
+
+def test_summaries_are_cached_per_model_and_version(tmp_path):
+    cache = make_cache(tmp_path, similarity=1.0)
+    cache.put_many(["chunk"], [SUMMARY], "What about cats?", "llm", "v1")
+
+    assert cache.get_many(["chunk"], " what about CATS? ", "llm", "v1") == [SUMMARY]
+    assert cache.get_many(["chunk"], "What about cats?", "other llm", "v1") == [None]
+    assert cache.get_many(["chunk"], "What about cats?", "llm", "v2") == [None]
+    # only the question itself is used
+    assert not cache.uses_similar_questions
+    assert cache.get_many(["chunk"], "Cats?", "llm", "v1", "emb", [1.0, 0.0]) == [None]
+
+
+def test_least_recently_used_summaries_are_evicted(tmp_path):
+    summary = ("x" * 1000, 5, {})
+    cache = make_cache(tmp_path, max_bytes=2500)
+    cache.put_many(["first", "second"], [summary, summary], "Cats?", "llm", "v1")
+    assert cache.get_many(["first"], "Cats?", "llm", "v1") == [summary]
+
+    cache.put_many(["third"], [summary], "Dogs?", "llm", "v1")
+
+    assert cache.get_many(["first", "second"], "Cats?", "llm", "v1") == [summary, None]
+    assert cache.get_many(["third"], "Dogs?", "llm", "v1") == [summary]
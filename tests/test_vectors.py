@@ -0,0 +1,126 @@
+import numpy as np
+import pytest
+from paperqa import Docs, Settings
+from paperqa.types import DocDetails, Text
+from lmi import embedding_model_factory
+
+from papis_ask.store import IndexStore
+from papis_ask.vectors import MemmapVectorStore
+
+TOPICS = ["cats", "bananas", "volcanoes", "glaciers", "violins"]
+
+
+async def make_texts(embedding_model, dockey, topics):
+    doc = DocDetails(docname=dockey, dockey=dockey, citation=dockey, other={})
+    texts = [
+        Text(
+            text=f"A chunk all about {topic} and {topic}", name=f"{dockey} {i}", doc=doc
+        )
+        for i, topic in enumerate(topics)
+    ]
+    embeddings = await embedding_model.embed_documents([text.text for text in texts])
+    for text, embedding in zip(texts, embeddings):
+        text.embedding = embedding
+    return doc, texts
+
+
+@pytest.mark.asyncio
+async def test_retrieve_texts(tmp_path):
+    embedding_model = embedding_model_factory("sparse")
+    doc, texts = await make_texts(embedding_model, "doc", TOPICS)
+    store = IndexStore(tmp_path / "index.qa.sqlite")
+    store.save_document(doc, texts)
+
+    docs = Docs(texts_index=MemmapVectorStore.from_store(store))
+    matches = await docs.retrieve_texts(
+        "volcanoes", 2, Settings(embedding="sparse"), embedding_model
+    )
+
+    assert len(matches) == 2
+    assert matches[0].text == texts[2].text
+
+
+@pytest.mark.asyncio
+async def test_retrieve_texts_ignores_texts_not_in_store(tmp_path):
+    embedding_model = embedding_model_factory("sparse")
+    doc, texts = await make_texts(embedding_model, "doc", TOPICS)
+    store = IndexStore(tmp_path / "index.qa.sqlite")
+    store.save_document(doc, texts)
+    _, unstored = await make_texts(embedding_model, "other", ["volcanoes"])
+
+    docs = Docs(texts_index=MemmapVectorStore.from_store(store), texts=unstored)
+    matches = await docs.retrieve_texts(
+        "volcanoes", 2, Settings(embedding="sparse"), embedding_model
+    )
+
+    assert [match.name for match in matches][0] == texts[2].name
+    assert unstored[0].name not in {match.name for match in matches}
+
+
+@pytest.mark.asyncio
+async def test_contains(tmp_path):
+    embedding_model = embedding_model_factory("sparse")
+    doc, texts = await make_texts(embedding_model, "doc", TOPICS)
+    other_doc, other_texts = await make_texts(embedding_model, "other", TOPICS)
+    store = IndexStore(tmp_path / "index.qa.sqlite")
+    store.save_document(doc, texts)
+    store.save_document(other_doc, other_texts[:1])
+
+    vector_store = MemmapVectorStore.from_store(store)
+    assert texts[0] in vector_store
+    assert other_texts[0] in vector_store
+    assert other_texts[1] not in vector_store
+
+    restricted = vector_store.restricted_to(store.get_rows([doc.dockey]))
+    assert texts[0] in restricted
+    assert other_texts[0] not in restricted
+
+
+@pytest.mark.asyncio
+async def test_embed_queries_once(tmp_path, monkeypatch):
+    embedding_model = embedding_model_factory("sparse")
+    doc, texts = await make_texts(embedding_model, "doc", TOPICS)
+    store = IndexStore(tmp_path / "index.qa.sqlite")
+    store.save_document(doc, texts)
+    vector_store = MemmapVectorStore.from_store(store)
+
+    embedded = []
+    embed_documents = type(embedding_model).embed_documents
+
+    async def count_embeddings(self, queries):
+        embedded.extend(queries)
+        return await embed_documents(self, queries)
+
+    monkeypatch.setattr(type(embedding_model), "embed_documents", count_embeddings)
+    await vector_store.embed_queries(["volcanoes", "cats", "cats"], embedding_model)
+    await vector_store.embed_queries(["volcanoes"], embedding_model)
+    await vector_store.similarity_search("volcanoes", 2, embedding_model)
+
+    assert embedded == ["volcanoes", "cats"]
+
+
+def test_rescoring(tmp_path):
+    rng = np.random.default_rng(0)
+    embeddings = rng.normal(size=(200, 32)).astype(np.float32)
+    doc = DocDetails(docname="doc", dockey="doc", citation="doc", other={})
+    texts = [
+        Text(text=f"chunk {i}", name=f"doc {i}", doc=doc, embedding=embedding.tolist())
+        for i, embedding in enumerate(embeddings)
+    ]
+    store = IndexStore(tmp_path / "index.qa.sqlite")
+    store.save_document(doc, texts)
+    exact = MemmapVectorStore.from_store(store)
+    # the copy is only used once it has all the embeddings
+    assert MemmapVectorStore.from_store(store, precision="int8")._quantized is None
+
+    store.get_quantized("int8").update(store.embeddings.open())
+    quantized = MemmapVectorStore.from_store(store, precision="int8", rescore_factor=4)
+    assert quantized._quantized is not None
+
+    query = embeddings[3] + rng.normal(scale=0.5, size=32).astype(np.float32)
+    rows, scores = quantized._best(query, quantized._rows, 10)
+    exact_rows, exact_scores = exact._best(query, exact._rows, 10)
+    assert rows[0] == 3
+    assert rows.tolist() == exact_rows.tolist()
+    # the candidates are rescored at full precision
+    assert np.allclose(scores, exact_scores)